@@ -0,0 +1,75 @@
+''' Recorded HTTP responses replayed by the benchmark stand-in server.'''
+from urllib.parse import urlparse, parse_qsl, urlencode
+import threading
+import hashlib
+import json
+import os
+
+FIXTURES_DIR = os.path.join(os.path.dirname(__file__), 'fixtures')
+# query parameters left out of fixture keys (API keys)
+PRIVATE_PARAMS = ('key',)
+
+
+def request_key(method, host, path, query='', body=None):
+    ''' Return the key a request is recorded and replayed under.'''
+    query = sorted((k, i) for k, i in parse_qsl(query, keep_blank_values=True)
+                   if k not in PRIVATE_PARAMS)
+    if isinstance(body, str):
+        body = body.encode('utf-8')
+    body_hash = hashlib.sha1(body).hexdigest() if body else ''
+    return ' '.join([method.upper(), host, path or '/', urlencode(query),
+                     body_hash]).strip()
+
+
+def url_key(method, url, body=None):
+    ''' Return the request key of a full url.'''
+    url = urlparse(url)
+    return request_key(method, url.netloc, url.path, url.query, body)
+
+
+class FixtureStore(object):
+    ''' Directory of recorded responses, an index.json of
+        request key: {status, content_type, body file} and the bodies.
+
+    Example:
+        store = FixtureStore('benchmarks/fixtures')
+        store.add('GET api.brewerydb.com /v2/beers name=Punk', 200,
+                  'application/json', b'{}')
+        store.save()
+    '''
+
+    def __init__(self, path=FIXTURES_DIR):
+        self.path = path
+        self.lock = threading.Lock()
+        self.index = {}
+        index_path = os.path.join(path, 'index.json')
+        if os.path.exists(index_path):
+            with open(index_path) as f:
+                self.index = json.load(f)
+
+    def add(self, key, status, content_type, body):
+        ''' Store a response body under a request key.'''
+        body_file = hashlib.sha1(body).hexdigest()
+        os.makedirs(os.path.join(self.path, 'bodies'), exist_ok=True)
+        with open(os.path.join(self.path, 'bodies', body_file), 'wb') as f:
+            f.write(body)
+        with self.lock:
+            self.index[key] = {'status': status,
+                               'content_type': content_type,
+                               'body': body_file}
+
+    def get(self, key):
+        ''' Return (status, content type, body) recorded for a key.'''
+        entry = self.index.get(key)
+        if not entry:
+            return None
+        with open(os.path.join(self.path, 'bodies', entry['body']), 'rb') as f:
+            body = f.read()
+        return entry['status'], entry['content_type'], body
+
+    def save(self):
+        ''' Write the index of recorded responses.'''
+        os.makedirs(self.path, exist_ok=True)
+        with self.lock:
+            with open(os.path.join(self.path, 'index.json'), 'w') as f:
+                json.dump(self.index, f, indent=1, sort_keys=True)
@@ -0,0 +1,56 @@
+''' Record live BeerHawk, BreweryDB and RateBeer responses as benchmark
+fixtures by running a small scrape against the real sites.
+
+Example:
+    python -m benchmarks.record_fixtures --limit 50
+'''
+from benchmarks.run_benchmark import disposable_database, instrumented
+from benchmarks.run_benchmark import StageTimer
+from benchmarks.fixtures import FixtureStore, FIXTURES_DIR, url_key
+import scrape_data
+import contextlib
+import tempfile
+import argparse
+import requests
+import os
+
+
+@contextlib.contextmanager
+def recording(store):
+    ''' Store every response requests receives in a FixtureStore.'''
+    original = requests.Session.request
+
+    def request(session, method, url, *args, **kwargs):
+        resp = original(session, method, url, *args, **kwargs)
+        # key on the request as sent, before any redirects
+        sent = resp.history[0].request if resp.history else resp.request
+        store.add(url_key(sent.method, sent.url, sent.body),
+                  resp.status_code,
+                  resp.headers.get('Content-Type', 'text/html'),
+                  resp.content)
+        return resp
+    requests.Session.request = request
+    try:
+        yield store
+    finally:
+        requests.Session.request = original
+        store.save()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--fixtures', default=FIXTURES_DIR)
+    parser.add_argument('--limit', type=int, default=50,
+                        help='number of listed products to record')
+    args = parser.parse_args()
+    journal = tempfile.NamedTemporaryFile(suffix='.journal', delete=False)
+    journal.close()
+    with recording(FixtureStore(args.fixtures)), disposable_database(), \
+            instrumented(StageTimer(), args.limit):
+        scrape_data.scrape_all_products_info(journal_path=journal.name)
+        scrape_data.update_brewerydb()
+    os.remove(journal.name)
+
+
+if __name__ == '__main__':
+    main()
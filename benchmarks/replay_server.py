@@ -0,0 +1,134 @@
+''' Local HTTP server standing in for BeerHawk, BreweryDB and RateBeer.
+
+Requests are sent to http://127.0.0.1:<port>/<original host>/<path> and
+answered from a FixtureStore, with optional latency and error injection.
+'''
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse
+from benchmarks.fixtures import request_key
+import threading
+import requests
+import aiohttp
+import random
+import time
+
+
+class ReplayHandler(BaseHTTPRequestHandler):
+    ''' Answer requests from the server's fixture store.'''
+
+    def _reply(self):
+        server = self.server
+        url = urlparse(self.path)
+        host, _, path = url.path.lstrip('/').partition('/')
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else None
+        delay = server.latency + random.uniform(0, server.jitter)
+        time.sleep(delay)
+        if random.random() < server.error_rate:
+            self.send_response(503)
+            self.send_header('Retry-After', '1')
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        fixture = server.store.get(
+            request_key(self.command, host, '/' + path, url.query, body))
+        if not fixture:
+            server.misses.append('{} {}'.format(self.command, self.path))
+            self.send_error(404)
+            return
+        status, content_type, content = fixture
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    do_GET = _reply
+    do_POST = _reply
+
+    def log_message(self, *args):
+        pass
+
+
+class ReplayServer(ThreadingHTTPServer):
+    ''' Threaded stand-in server run in the background.
+
+    Parameters:
+        store: FixtureStore of recorded responses
+        latency: seconds added to every response
+        jitter: maximum random seconds added on top of latency
+        error_rate: fraction of requests answered with a 503
+
+    Example:
+        with ReplayServer(FixtureStore(), latency=0.05) as server:
+            with redirect_hosts(server.base_url):
+                scrape_all_products_info()
+    '''
+
+    daemon_threads = True
+
+    def __init__(self, store, latency=0.0, jitter=0.0, error_rate=0.0,
+                 port=0):
+        ThreadingHTTPServer.__init__(self, ('127.0.0.1', port), ReplayHandler)
+        self.store = store
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.misses = []
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+
+    @property
+    def base_url(self):
+        return 'http://127.0.0.1:{}'.format(self.server_address[1])
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.shutdown()
+        self.server_close()
+
+
+def rewrite_url(url, base_url):
+    ''' Point an absolute http(s) url at the stand-in server.'''
+    url = str(url)
+    parsed = urlparse(url)
+    if parsed.scheme not in ('http', 'https') or \
+            url.startswith(base_url):
+        return url
+    rest = url.split(parsed.netloc, 1)[1]
+    return '{}/{}{}'.format(base_url, parsed.netloc, rest)
+
+
+class redirect_hosts(object):
+    ''' Context manager sending every requests and aiohttp request
+        to the stand-in server instead of the live sites.
+    '''
+
+    def __init__(self, base_url):
+        self.base_url = base_url
+
+    def __enter__(self):
+        base_url = self.base_url
+        self.requests_request = requests.Session.request
+        self.aiohttp_request = aiohttp.ClientSession._request
+        requests_request = self.requests_request
+        aiohttp_request = self.aiohttp_request
+
+        def request(session, method, url, *args, **kwargs):
+            return requests_request(session, method,
+                                    rewrite_url(url, base_url),
+                                    *args, **kwargs)
+
+        def async_request(session, method, url, *args, **kwargs):
+            return aiohttp_request(session, method,
+                                   rewrite_url(url, base_url),
+                                   *args, **kwargs)
+        requests.Session.request = request
+        aiohttp.ClientSession._request = async_request
+        return self
+
+    def __exit__(self, *exc):
+        requests.Session.request = self.requests_request
+        aiohttp.ClientSession._request = self.aiohttp_request
@@ -0,0 +1,231 @@
+''' Offline throughput benchmark of the scrape pipeline.
+
+Replays recorded fixtures (see record_fixtures.py) from a local stand-in
+server into a disposable database and reports products/sec, per-stage
+latency percentiles and peak RSS.
+
+Example:
+    python -m benchmarks.run_benchmark --concurrency 10 --latency 0.1
+    python -m benchmarks.run_benchmark --mode update --error-rate 0.05
+    python -m benchmarks.run_benchmark --backend sqlite
+'''
+from benchmarks.replay_server import ReplayServer, redirect_hosts
+from benchmarks.fixtures import FixtureStore, FIXTURES_DIR
+from database.pymysql_API import SQLTable
+import database.database_creation as database_creation
+import scrape_data
+import contextlib
+import functools
+import itertools
+import tempfile
+import shutil
+import argparse
+import resource
+import asyncio
+import time
+import json
+import os
+
+# (module, function name, stage) timed during a benchmark run
+STAGES = [(scrape_data, 'get_beerhawk_product', 'beerhawk'),
+          (scrape_data, 'parse_beer_page', 'beerhawk'),
+          (scrape_data, 'scrape_brewerydb', 'brewerydb'),
+          (scrape_data, 'scrape_ratebeer', 'ratebeer'),
+          (SQLTable, '_execute_batch', 'sql')]
+
+
+class StageTimer(object):
+    ''' Collect latencies of each pipeline stage.'''
+
+    def __init__(self):
+        self.latencies = {}
+        self.products = 0
+
+    def add(self, stage, seconds):
+        self.latencies.setdefault(stage, []).append(seconds)
+
+    def wrap(self, func, stage):
+        ''' Return func, or coroutine function, timed as stage.'''
+        if asyncio.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def timed(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return await func(*args, **kwargs)
+                finally:
+                    self.add(stage, time.perf_counter() - start)
+        else:
+            @functools.wraps(func)
+            def timed(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    self.add(stage, time.perf_counter() - start)
+        return timed
+
+    def count(self, products, limit=None):
+        ''' Count products as they are taken from the listing.'''
+        for product in itertools.islice(products, limit):
+            self.products += 1
+            yield product
+
+    def stage_count(self, stage):
+        ''' Return the number of times a stage was run.'''
+        return len(self.latencies.get(stage, []))
+
+    def summary(self):
+        ''' Return count and latency percentiles (ms) of each stage.'''
+        stages = {}
+        for stage, values in sorted(self.latencies.items()):
+            values = sorted(values)
+            stages[stage] = {'count': len(values),
+                             'p50': percentile(values, 50),
+                             'p90': percentile(values, 90),
+                             'p99': percentile(values, 99),
+                             'max': values[-1] * 1000}
+        return stages
+
+
+def percentile(values, pct):
+    ''' Return the pct percentile of sorted values in milliseconds.'''
+    index = min(len(values) - 1, int(round(pct / 100 * (len(values) - 1))))
+    return values[index] * 1000
+
+
+def peak_rss_mb():
+    ''' Peak resident memory of this process and its children in MB.'''
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    usage += resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return usage / 1024
+
+
+@contextlib.contextmanager
+def instrumented(timer, limit=None):
+    ''' Time the pipeline stages and count listed products.'''
+    originals = [(owner, name, getattr(owner, name))
+                 for owner, name, _ in STAGES]
+    listing = scrape_data.get_all_beerhawk_products
+    for owner, name, stage in STAGES:
+        setattr(owner, name, timer.wrap(getattr(owner, name), stage))
+    scrape_data.get_all_beerhawk_products = \
+        lambda: timer.count(listing(), limit)
+    try:
+        yield timer
+    finally:
+        for owner, name, func in originals:
+            setattr(owner, name, func)
+        scrape_data.get_all_beerhawk_products = listing
+
+
+@contextlib.contextmanager
+def disposable_database(seed_from=None, backend='mysql'):
+    ''' Point open_database_table at a throwaway database, optionally
+        seeded with the rows of an existing database, and drop it after.
+    '''
+    original = database_creation.DATABASE, database_creation.BACKEND
+    if backend == 'sqlite':
+        database = os.path.join(tempfile.gettempdir(),
+                                'beers_bench_{}.sqlite3'.format(os.getpid()))
+        if seed_from:
+            shutil.copyfile(database_creation.sqlite_path(seed_from),
+                            database)
+        else:
+            database_creation.create_database(database, backend)
+    else:
+        database = 'beers_bench_{}'.format(os.getpid())
+        database_creation.create_database(database, backend)
+        if seed_from:
+            db = database_creation.connect(database, backend)
+            with db.cursor() as cursor:
+                cursor.execute('INSERT INTO CRAFT_BEERS SELECT * FROM '
+                               '{}.CRAFT_BEERS'.format(seed_from))
+            db.commit()
+            db.close()
+    database_creation.DATABASE = database
+    database_creation.BACKEND = backend
+    try:
+        yield database
+    finally:
+        database_creation.DATABASE, database_creation.BACKEND = original
+        database_creation.drop_database(database, backend)
+
+
+def run(args):
+    ''' Run the chosen pipeline against the stand-in server.'''
+    journal = tempfile.NamedTemporaryFile(suffix='.journal', delete=False)
+    journal.close()
+    try:
+        if args.mode == 'update':
+            scrape_data.update_brewerydb()
+        elif args.mode == 'update-incremental':
+            scrape_data.update_brewerydb_incremental()
+        elif args.concurrency:
+            asyncio.run(scrape_data.scrape_all_products_info_async(
+                args.concurrency, journal_path=journal.name,
+                parse_workers=args.parse_workers))
+        else:
+            scrape_data.scrape_all_products_info(journal_path=journal.name)
+    finally:
+        os.remove(journal.name)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--fixtures', default=FIXTURES_DIR)
+    parser.add_argument('--mode', default='scrape',
+                        choices=['scrape', 'update', 'update-incremental'])
+    parser.add_argument('--concurrency', '-c', type=int)
+    parser.add_argument('--parse-workers', type=int)
+    parser.add_argument('--limit', type=int,
+                        help='maximum number of listed products to scrape')
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='seconds added to every response')
+    parser.add_argument('--jitter', type=float, default=0.0,
+                        help='maximum random seconds added to latency')
+    parser.add_argument('--error-rate', type=float, default=0.0,
+                        help='fraction of requests answered with a 503')
+    parser.add_argument('--seed-database',
+                        help='database whose rows seed the update modes')
+    parser.add_argument('--backend', choices=database_creation.BACKENDS,
+                        default='mysql',
+                        help='storage backend of the disposable database')
+    parser.add_argument('--output', help='also write the report here')
+    args = parser.parse_args()
+
+    store = FixtureStore(args.fixtures)
+    timer = StageTimer()
+    server = ReplayServer(store, args.latency, args.jitter, args.error_rate)
+    with server, redirect_hosts(server.base_url), \
+            disposable_database(args.seed_database, args.backend), \
+            instrumented(timer, args.limit):
+        start = time.perf_counter()
+        run(args)
+        seconds = time.perf_counter() - start
+    if args.mode == 'scrape':
+        products = timer.products
+    else:
+        # update modes read rows from the table, not the listing, and
+        # scrape BreweryDB once per row
+        products = timer.stage_count('brewerydb')
+    report = {'mode': args.mode,
+              'backend': args.backend,
+              'concurrency': args.concurrency,
+              'parse_workers': args.parse_workers,
+              'latency': args.latency,
+              'error_rate': args.error_rate,
+              'products': products,
+              'seconds': seconds,
+              'products_per_sec': products / seconds if seconds else 0,
+              'stages_ms': timer.summary(),
+              'peak_rss_mb': peak_rss_mb(),
+              'fixture_misses': len(server.misses)}
+    text = json.dumps(report, indent=2)
+    print(text)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+
+
+if __name__ == '__main__':
+    main()
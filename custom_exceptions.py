@@ -25,6 +25,10 @@ class NonBeerProduct(Exception):
         self.product = product
         self.msg = msg
 
+    def __reduce__(self):
+        # keep product when raised in a parsing process and re-raised here
+        return (self.__class__, (self.product, self.msg))
+
 
 class RateBeerModuleFailure(Exception):
     ''' An error in ratebeer python module stops'''
@@ -32,3 +36,50 @@ class RateBeerModuleFailure(Exception):
     def __init__(self, error):
         Exception.__init__(self, error)
         self.error = error
+
+
+class OfflineCacheMiss(Exception):
+    ''' Raise if a url is not cached whilst running offline.'''
+
+    def __init__(self, url, msg=None):
+        if not msg:
+            msg = '{} is not in the response cache'.format(url)
+        Exception.__init__(self, msg)
+        self.url = url
+        self.msg = msg
+
+
+class APIKeysExhausted(Exception):
+    ''' Raise if no API key of a service has quota left.'''
+
+    def __init__(self, service, msg=None):
+        if not msg:
+            msg = 'No {} API key has any quota left'.format(service)
+        Exception.__init__(self, msg)
+        self.service = service
+        self.msg = msg
+
+
+class BreweryDBUnavailable(Exception):
+    ''' Raise if a BreweryDB request failed, as opposed to finding
+        nothing.'''
+
+    def __init__(self, request, msg=None):
+        if not msg:
+            msg = 'BreweryDB request {} failed'.format(request)
+        Exception.__init__(self, msg)
+        self.request = request
+        self.msg = msg
+
+
+class MigrationLocked(Exception):
+    ''' Raise if another connection held the schema migration lock for
+        too long.'''
+
+    def __init__(self, table, msg=None):
+        if not msg:
+            msg = 'Timed out waiting to migrate the schema of {}'.format(
+                table)
+        Exception.__init__(self, msg)
+        self.table = table
+        self.msg = msg
@@ -1,35 +1,307 @@
-from database.pymysql_API import SQLTable
+from database.pymysql_API import SQLTable, backend_of
+from database.sqlite_API import SQLiteConnection
+from datetime import datetime
+import custom_exceptions
+import collections
 import logging
 import pymysql
+import os
+
+logger = logging.getLogger('beerscraper.database')
+# name of the database opened by open_database_table, for the sqlite
+# backend a database file path, with .sqlite3 added if no extension
+DATABASE = 'beers'
+# storage backend used by open_database_table, 'mysql' or 'sqlite'
+BACKEND = 'mysql'
+BACKENDS = ('mysql', 'sqlite')
+# columns used to track when BreweryDB info was last refreshed
+BREWERYDB_TRACKING_COLUMNS = collections.OrderedDict([
+    ('brewerydb_updated', 'DATETIME'),
+    ('brewerydb_hash', 'CHAR(40)')])
+# columns used to detect BeerHawk products which changed since scraped
+BEERHAWK_TRACKING_COLUMNS = collections.OrderedDict([
+    ('beerhawk_updated', 'DATETIME'),
+    ('beerhawk_hash', 'CHAR(40)')])
+# column set by mySQL whenever a row changes, used by incremental exports
+EXPORT_TRACKING_COLUMNS = collections.OrderedDict([
+    ('updated_at', 'TIMESTAMP DEFAULT CURRENT_TIMESTAMP '
+                   'ON UPDATE CURRENT_TIMESTAMP')])
+# columns of the CRAFT_BEERS table created by create_table
+CRAFT_BEERS_COLUMNS = collections.OrderedDict([
+    ('abv', 'FLOAT'),
+    ('abvMax', 'FLOAT'),
+    ('abvMin', 'FLOAT'),
+    ('beer_hawk', 'VARCHAR(100)'),
+    ('beer_link', 'VARCHAR(100)'),
+    ('full_beer_name', 'VARCHAR(200) NOT NULL PRIMARY KEY'),
+    ('beer_name', 'VARCHAR(100) NOT NULL'),
+    ('beer_style', 'VARCHAR(25)'),
+    ('bottle_size', 'INT'),
+    ('brand_category', 'VARCHAR(50)'),
+    ('brewed_at', 'VARCHAR(50)'),
+    ('brewery', 'VARCHAR(100)'),
+    ('calories', 'INT'),
+    ('country_origin', 'VARCHAR(50)'),
+    ('customer_rating', 'FLOAT'),
+    ('fgMax', 'FLOAT'),
+    ('fgMin', 'FLOAT'),
+    ('ibu', 'FLOAT'),
+    ('ibuMax', 'FLOAT'),
+    ('ibuMin', 'FLOAT'),
+    ('img_url', 'VARCHAR(200)'),
+    ('isOrganic', 'VARCHAR(5)'),
+    ('mean_rating', 'FLOAT'),
+    ('name', 'VARCHAR(200)'),
+    ('num_ratings', 'INT'),
+    ('overall_rating', 'FLOAT'),
+    ('price', 'FLOAT'),
+    ('retired', 'VARCHAR(10)'),
+    ('seasonal', 'VARCHAR(20)'),
+    ('serving_temp', 'VARCHAR(200)'),
+    ('sku', 'VARCHAR(20)'),
+    ('srm', 'INT'),
+    ('style', 'VARCHAR(50)'),
+    ('style_rating', 'INT'),
+    ('style_url', 'VARCHAR(100)'),
+    ('url', 'VARCHAR(200)'),
+    ('weighted_avg', 'FLOAT'),
+    ('_has_fetched', 'VARCHAR(10)')])
+CRAFT_BEERS_COLUMNS.update(BREWERYDB_TRACKING_COLUMNS)
+CRAFT_BEERS_COLUMNS.update(BEERHAWK_TRACKING_COLUMNS)
+CRAFT_BEERS_COLUMNS.update(EXPORT_TRACKING_COLUMNS)
+
+# table recording the schema migrations applied to a database
+SCHEMA_TABLE = 'SCHEMA_VERSION'
+SCHEMA_COLUMNS = collections.OrderedDict([
+    ('version', 'INT NOT NULL PRIMARY KEY'),
+    ('description', 'VARCHAR(200)'),
+    ('applied', 'DATETIME')])
+# CRAFT_BEERS indexes: name: columns
+CRAFT_BEERS_INDEXES = collections.OrderedDict([
+    # update_brewerydb reads a brewery's beers together
+    ('CRAFT_BEERS_brewery', ['brewery']),
+    ('CRAFT_BEERS_beer_style', ['beer_style']),
+    ('CRAFT_BEERS_sku', ['sku']),
+    # price and ABV are queried by range
+    ('CRAFT_BEERS_price', ['price']),
+    ('CRAFT_BEERS_abv', ['abv']),
+    # stale rows for incremental BreweryDB refreshes and exports
+    ('CRAFT_BEERS_brewerydb_updated', ['brewerydb_updated']),
+    ('CRAFT_BEERS_updated_at', ['updated_at'])])
 
 
 def create_table(db):
-    ''' Create CRAFT_BEERS table in beers mySQL database.'''
-    cmd = "CREATE TABLE CRAFT_BEERS(abv INT, abvMax INT, abvMin INT, beer_hawk VARCHAR(100), beer_link VARCHAR(100), full_beer_name VARCHAR(200) NOT NULL PRIMARY KEY, beer_name VARCHAR(100) NOT NULL, beer_style VARCHAR(25), bottle_size INT, brand_category VARCHAR(50), brewed_at VARCHAR(50), brewery VARCHAR(100), calories INT, country_origin VARCHAR(50), customer_rating FLOAT, fgMax FLOAT, fgMin FLOAT, ibu FLOAT, ibuMax FLOAT, ibuMin FLOAT, img_url VARCHAR(200), isOrganic VARCHAR(5), mean_rating FLOAT, name VARCHAR(200), num_ratings INT, overall_rating FLOAT, price FLOAT, retired VARCHAR(10), seasonal VARCHAR(20), serving_temp VARCHAR(200), sku VARCHAR(20), srm INT, style VARCHAR(50), style_rating INT, style_url VARCHAR(100), url VARCHAR(200), weighted_avg FLOAT, _has_fetched VARCHAR(10))"
-    db.cursor().execute(cmd)
+    ''' Create CRAFT_BEERS table in the beers database.'''
+    backend = backend_of(db)
+    with db.cursor() as cursor:
+        for cmd in backend.create_table_cmds('CRAFT_BEERS',
+                                             CRAFT_BEERS_COLUMNS):
+            cursor.execute(cmd)
+    db.commit()
+
+
+def missing_column_cmds(table, columns):
+    ''' Commands adding the given {column: type} to an SQLTable if not
+        present.
+    '''
+    existing = {x[0] for x in table.describe()}
+    cmds = []
+    for column, sql_type in columns.items():
+        if column not in existing:
+            logger.info('Adding column %s to table %s', column, table.table)
+            cmds += table.backend.add_column_cmds(table.table, column,
+                                                  sql_type)
+    return cmds
+
+
+def add_missing_columns(table, columns):
+    ''' Add the given {column: type} to an SQLTable if not present.'''
+    with table.db.cursor() as cursor:
+        for cmd in missing_column_cmds(table, columns):
+            cursor.execute(cmd)
+    table.db.commit()
+
+
+def _add_tracking_columns(table, cursor):
+    columns = collections.OrderedDict()
+    for tracking in (BREWERYDB_TRACKING_COLUMNS, BEERHAWK_TRACKING_COLUMNS,
+                     EXPORT_TRACKING_COLUMNS):
+        columns.update(tracking)
+    return missing_column_cmds(table, columns)
+
+
+def _float_abv_columns(table, cursor):
+    # ABVs such as 4.5% were truncated by INT columns
+    types = dict(table.describe())
+    columns = collections.OrderedDict(
+        (x, CRAFT_BEERS_COLUMNS[x]) for x in ('abv', 'abvMin', 'abvMax')
+        if types.get(x, '').startswith('int'))
+    if not columns:
+        return []
+    return table.backend.alter_column_cmds(cursor, table.table, columns)
+
+
+def _keep_updated_at(table, cursor):
+    # lets refresh times be touched without the row counting as changed
+    return table.backend.keep_timestamp_cmds(table.table, 'updated_at')
+
+
+def _local_updated_at(table, cursor):
+    return table.backend.local_timestamp_cmds(cursor, table.table,
+                                              'updated_at')
+
 
+def _add_indexes(table, cursor):
+    existing = table.backend.index_names(cursor, table.table)
+    cmds = []
+    for name, columns in CRAFT_BEERS_INDEXES.items():
+        if name not in existing:
+            cmds += table.backend.create_index_cmds(table.table, name,
+                                                    columns)
+    return cmds
 
-def create_database():
-    ''' Create a beers mySQL database.'''
-    db = pymysql.connect(host='localhost', user='root',
-                         password='database', use_unicode=True,
-                         charset='utf8')
-    command = 'CREATE DATABASE beers'
+
+# schema migrations of the CRAFT_BEERS table, in the order they are
+# applied: (version, description, function returning the commands to
+# run given the SQLTable and a cursor). Functions only return commands
+# for changes not already made, so tables created from
+# CRAFT_BEERS_COLUMNS, or loaded from beers_db.sql, can be migrated.
+MIGRATIONS = [
+    (1, 'Add BreweryDB, BeerHawk and export tracking columns',
+     _add_tracking_columns),
+    (2, 'Store abv, abvMin and abvMax as FLOAT', _float_abv_columns),
+    (3, 'Index brewery, beer_style, sku, price, abv and update times',
+     _add_indexes),
+    (4, 'Let updates of refresh times keep updated_at', _keep_updated_at),
+    (5, 'Set updated_at to the local time on SQLite', _local_updated_at)]
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+
+def schema_version(db):
+    ''' Return the newest schema migration applied to a database.'''
+    with db.cursor() as cursor:
+        cursor.execute('SELECT MAX(version) FROM {}'.format(SCHEMA_TABLE))
+        return cursor.fetchone()[0] or 0
+
+
+def migrate(table):
+    ''' Apply the MIGRATIONS newer than the schema version of an
+        SQLTable's database, recording each one in SCHEMA_VERSION.
+        Connections migrating the same database at once wait for
+        each other. Returns the number of migrations applied.
+    '''
+    db, backend = table.db, table.backend
+    with db.cursor() as cursor:
+        for cmd in backend.create_table_cmds(SCHEMA_TABLE, SCHEMA_COLUMNS,
+                                             if_not_exists=True):
+            cursor.execute(cmd)
+    db.commit()
+    applied = 0
+    with db.cursor() as cursor:
+        cursor.execute(backend.begin_migration)
+        # mySQL's GET_LOCK returns 0 on timeout and NULL on error, SQLite's
+        # BEGIN IMMEDIATE returns no row and raises on timeout instead
+        locked = cursor.fetchone()
+        if locked is not None and locked[0] != 1:
+            raise custom_exceptions.MigrationLocked(table.table)
+        try:
+            # read once holding the lock, another connection may
+            # have migrated the database whilst it waited
+            version = schema_version(db)
+            for number, description, func in MIGRATIONS:
+                if number <= version:
+                    continue
+                logger.info('Applying schema migration %s to %s: %s',
+                            number, table.table, description)
+                for cmd in func(table, cursor):
+                    cursor.execute(cmd)
+                cursor.execute('INSERT INTO {} (version, description, '
+                               'applied) VALUES (%s, %s, %s)'.format(
+                                   SCHEMA_TABLE),
+                               (number, description, datetime.now()))
+                applied += 1
+            db.commit()
+        except Exception:
+            db.rollback()
+            raise
+        finally:
+            if backend.end_migration:
+                cursor.execute(backend.end_migration)
+    return applied
+
+
+def sqlite_path(database=None):
+    ''' Return the SQLite file of a database name.'''
+    database = database or DATABASE
+    if os.path.splitext(database)[1]:
+        return database
+    return database + '.sqlite3'
+
+
+def connect(database=None, backend=None):
+    ''' Connect to the local mySQL server, optionally selecting a database,
+        or open a SQLite database file.
+    '''
+    if (backend or BACKEND) == 'sqlite':
+        return SQLiteConnection(sqlite_path(database))
+    kwargs = {'db': database} if database else {}
+    return pymysql.connect(host='localhost', user='root',
+                           password='database', use_unicode=True,
+                           charset='utf8', **kwargs)
+
+
+def create_database(database=None, backend=None):
+    ''' Create a beers database.'''
+    database = database or DATABASE
+    if (backend or BACKEND) == 'sqlite':
+        db = connect(database, 'sqlite')
+        create_table(db)
+        db.close()
+        return
+    db = connect()
+    command = 'CREATE DATABASE {}'.format(database)
     db.cursor().execute(command)
+    db.select_db(database)
     create_table(db)
+    db.close()
 
 
-def open_database_table():
+def drop_database(database, backend=None):
+    ''' Delete a database, used to clean up disposable databases.'''
+    if (backend or BACKEND) == 'sqlite':
+        path = sqlite_path(database)
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(path + suffix):
+                os.remove(path + suffix)
+        return
+    db = connect()
+    db.cursor().execute('DROP DATABASE IF EXISTS {}'.format(database))
+    db.close()
+
+
+def open_database_table(database=None, backend=None):
     ''' Open the beers database object and return.'''
+    database = database or DATABASE
+    backend = backend or BACKEND
+    if backend == 'sqlite':
+        # the database file is created on connecting
+        db = connect(database, backend)
+    else:
+        try:
+            db = connect(database)
+        except (pymysql.err.InternalError,
+                pymysql.err.OperationalError) as e:
+            logger.info('Database %s does not exist. Creating...',
+                        database)
+            create_database(database)
+            db = connect(database)
     try:
-        db = pymysql.connect(host='localhost', user='root',
-                             password='database', db='beers',
-                             use_unicode=True, charset='utf8')
         table = SQLTable(db, 'CRAFT_BEERS')
-        return table
-    except pymysql.err.InternalError as e:
-        logging.info('Database beers does not exist. Creating...')
-        create_database()
-    except pymysql.err.ProgrammingError as e:
-        logging.info('Table CRAFT_BEERS does not exist. creating...')
-        create_table()
+    except backend_of(db).missing_table_error as e:
+        logger.info('Table CRAFT_BEERS does not exist. creating...')
+        create_table(db)
+        table = SQLTable(db, 'CRAFT_BEERS')
+    # bring tables created by older versions, or loaded from
+    # beers_db.sql, up to date
+    migrate(table)
+    return table
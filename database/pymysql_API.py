@@ -1,18 +1,125 @@
 ''' Classes to ease the pain of interacting with mySQL DataBases and Tables.'''
 # https://www.tutorialspoint.com/python3/python_database_access.htm
 from tabulate import tabulate
+import pymysql.cursors
 import logging
 import pandas as pd
 import collections
+import datetime
 import custom_exceptions
+import metrics
 import sys
 
+logger = logging.getLogger('beerscraper.database')
+
+
+class MySQLBackend(object):
+    ''' The mySQL flavour of the SQL sent by DataBase and SQLTable.
+        Other storage backends subclass it, see sqlite_API.py, and are
+        picked up from the backend attribute of their connection.
+    '''
+
+    name = 'mysql'
+    # quote wrapped around string values by Dict2Command
+    quote = '"'
+    # raised when a query names a table which does not exist
+    missing_table_error = pymysql.err.ProgrammingError
+    # INSERT which skips rows whose primary key already exists
+    insert_ignore = 'INSERT IGNORE'
+    # starts a transaction which will write
+    begin_write = 'START TRANSACTION'
+    # clause locking selected rows, skipping those other
+    # transactions have locked
+    skip_locked = 'FOR UPDATE SKIP LOCKED'
+    # statements holding off other connections' schema migrations
+    begin_migration = "SELECT GET_LOCK('beerscraper_migration', 300)"
+    end_migration = "SELECT RELEASE_LOCK('beerscraper_migration')"
+
+    def stream_cursor(self, db):
+        ''' Return an unbuffered server-side cursor.'''
+        return db.cursor(pymysql.cursors.SSCursor)
+
+    def describe(self, cursor, table):
+        ''' Return a list of (column name, lower case SQL type, is
+            primary key) of a table.
+        '''
+        cursor.execute('DESCRIBE {}'.format(table))
+        # newer mySQL servers return the type as bytes
+        return [(x[0], (x[1].decode() if isinstance(x[1], bytes)
+                        else x[1]).lower(), x[3] == 'PRI')
+                for x in cursor.fetchall()]
+
+    def upsert_clause(self, columns, primary_key):
+        ''' Clause turning an INSERT into an update of existing rows.'''
+        updates = ', '.join('{0} = VALUES({0})'.format(x) for x in columns)
+        return 'ON DUPLICATE KEY UPDATE {}'.format(updates)
+
+    def column_ddl(self, sql_type):
+        ''' Return the column definition used for a mySQL column type.'''
+        return sql_type
+
+    def create_table_cmds(self, table, columns, if_not_exists=False):
+        ''' Commands creating a table from a dict of {column: type}.'''
+        definitions = ', '.join('{} {}'.format(k, self.column_ddl(i))
+                                for k, i in columns.items())
+        return ['CREATE TABLE {}{}({})'.format(
+            'IF NOT EXISTS ' if if_not_exists else '', table, definitions)]
+
+    def add_column_cmds(self, table, column, sql_type):
+        ''' Commands adding a column to an existing table.'''
+        return ['ALTER TABLE {} ADD COLUMN {} {}'.format(
+            table, column, self.column_ddl(sql_type))]
+
+    def alter_column_cmds(self, cursor, table, columns):
+        ''' Commands changing the types of existing columns of a table
+            to those of a dict of {column: type}.
+        '''
+        changes = ', '.join('MODIFY COLUMN {} {}'.format(k, self.column_ddl(i))
+                            for k, i in columns.items())
+        return ['ALTER TABLE {} {}'.format(table, changes)]
+
+    def index_names(self, cursor, table):
+        ''' Return the set of names of a table's indexes.'''
+        cursor.execute('SHOW INDEX FROM {}'.format(table))
+        return {x[2] for x in cursor.fetchall()}
+
+    def create_index_cmds(self, table, name, columns):
+        ''' Commands creating an index on a list of columns.'''
+        return ['CREATE INDEX {} ON {} ({})'.format(name, table,
+                                                    ', '.join(columns))]
+
+    def keep_timestamp(self, column):
+        ''' Assignment leaving an automatic timestamp column unchanged
+            by an UPDATE of other columns.
+        '''
+        # mySQL only sets a column ON UPDATE if it isn't assigned
+        return '{0} = {0}'.format(column)
+
+    def keep_timestamp_cmds(self, table, column):
+        ''' Commands letting keep_timestamp work on an existing table.'''
+        return []
+
+    def local_timestamp_cmds(self, cursor, table, column):
+        ''' Commands making an existing automatic timestamp column take
+            the local time, which mySQL's already does.
+        '''
+        return []
+
+
+MYSQL = MySQLBackend()
+
+
+def backend_of(db):
+    ''' Return the backend of a connection, mySQL for pymysql ones.'''
+    return getattr(db, 'backend', MYSQL)
+
 
 class DataBase(object):
     ''' Represents a mySQL database.
 
     Parameters:
-        db: a pymysql.connect() object
+        db: a pymysql.connect() object, or a connection with a backend
+            attribute such as sqlite_API.SQLiteConnection
 
     Example:
         db = pymysql.connect(host='localhost', user='root',
@@ -24,7 +131,9 @@ class DataBase(object):
 
     def __init__(self, db):
         self.db = db
+        self.backend = backend_of(db)
 
+    @metrics.timed('sql')
     def cmd(self, command):
         ''' Parse a command to MySQL and commit it.'''
         with self.db.cursor() as cursor:
@@ -32,7 +141,7 @@ class DataBase(object):
                 cursor.execute(command)
                 self.db.commit()
             except Exception as e:
-                logging.exception('message')
+                logger.exception('message')
                 self.db.rollback()
                 self.close()
                 sys.exit()
@@ -48,6 +157,7 @@ class Dict2Command(object):
         self.table = SQL table to apply the command to
         self.command = command type e.g. insert, update etc.
         self.where = a dict for WHERE command (key is column)
+        self.quote = quote wrapped around string values
 
     Example:
         d = {'abv': 5, 'seasonal': 'N', 'srm': None}
@@ -60,7 +170,9 @@ class Dict2Command(object):
         WHERE full_beer_name = "Brewdog Punk IPA", brewery = "Brewdog"
         '''
 
-    def __init__(self, dictionary, table, command='insert', conditions=None):
+    def __init__(self, dictionary, table, command='insert', conditions=None,
+                 quote='"'):
+        self.quote = quote
         self.dictionary = self._correct_items(dictionary)
         self.table = table
         self.command = command
@@ -93,7 +205,8 @@ class Dict2Command(object):
             elif not i:
                 i = 'NULL'
             elif isinstance(i, str):
-                i = '"{}"'.format(i.replace("'", "").replace('"', ''))
+                i = '{0}{1}{0}'.format(
+                    self.quote, i.replace("'", "").replace('"', ''))
             dictionary[k] = i
         return dictionary
 
@@ -144,19 +257,39 @@ class SQLTable(DataBase):
                              password='pass', db='beers')
         beers = SQLTable(db, 'Test Beer')
         beers.exists('beer_name', 'Punk IPA')
+        beers.load_index('beer_name')
+        beers.exists_many('beer_name', ['Punk IPA', 'Elvis Juice'])
+        beers.insert_many([{'beer_name': 'Punk IPA', 'abv': 5.6},
+                           {'beer_name': 'Dead Pony Club', 'abv': 3.8}])
+        for beer_name, abv in beers.iter_rows(['beer_name', 'abv']):
+            print(beer_name, abv)
     '''
 
-    def __init__(self, db, table):
+    def __init__(self, db, table, batch_size=100):
         DataBase.__init__(self, db)
         self.table = table
         # keys, items filled during dict2cmd
         self.keys = None
         self.items = None
+        # rows waiting to be written by flush()
+        self.batch_size = batch_size
+        self.pending = {'insert': [], 'upsert': []}
+        self.failed_rows = []
+        # column: set of values, filled by load_index
+        self.indexes = {}
+        # column: Counter of values in indexes only because rows holding
+        # them are queued, removed again if those rows fail to be written
+        self.queued = {}
+        # functions called with each list of rows committed by _write_batch
+        self.write_hooks = []
+        # filled by primary_key()
+        self._primary_key = None
         self._valid_table()
 
     def _valid_table(self):
         ''' Raise an exception if table doesn't exist.'''
-        command = "SELECT * FROM {}".format(self.table)
+        # LIMIT 0 checks the table without reading its rows
+        command = "SELECT * FROM {} LIMIT 0".format(self.table)
         with self.db.cursor() as cursor:
             cursor.execute(command)
 
@@ -165,43 +298,340 @@ class SQLTable(DataBase):
             the keys are column names in table and items are values.
         '''
         sql_cmd = Dict2Command(dictionary=dictionary, table=self.table,
-                               command=command, conditions=conditions)
+                               command=command, conditions=conditions,
+                               quote=self.backend.quote)
         return str(sql_cmd)
 
-    def print(self, command):
-        ''' Print the command.'''
+    @staticmethod
+    def _param_value(value):
+        ''' Convert an item to a query parameter, empty items become NULL.'''
+        if isinstance(value, (int, float, datetime.datetime)):
+            return value
+        elif not value:
+            return None
+        elif isinstance(value, str):
+            return value
+        return str(value)
+
+    def _many_cmd(self, columns, upsert=False, key=None, keep=()):
+        ''' Parameterized mySQL INSERT command for the given columns,
+            or an UPDATE of rows matching the last column if key given,
+            leaving the automatic timestamp columns in keep unchanged.
+        '''
+        if key:
+            set_str = ', '.join(['{} = %s'.format(x) for x in columns[:-1]] +
+                                [self.backend.keep_timestamp(x)
+                                 for x in keep])
+            return 'UPDATE {} SET {} WHERE {} = %s'.format(
+                self.table, set_str, key)
+        sql_cmd = 'INSERT INTO {} ({}) VALUES ({})'.format(
+            self.table, ', '.join(columns), ', '.join(['%s'] * len(columns)))
+        if upsert:
+            sql_cmd += ' ' + self.backend.upsert_clause(columns,
+                                                        self.primary_key())
+        return sql_cmd
+
+    @metrics.timed('sql')
+    def _execute_batch(self, rows, upsert=False, key=None, keep=()):
+        ''' Send rows in one executemany per column set and commit once.'''
+        groups = collections.OrderedDict()
+        for row in rows:
+            columns = tuple(row.keys())
+            if key:
+                # key column moved last to fill the WHERE placeholder
+                columns = tuple(x for x in columns if x != key) + (key,)
+            values = tuple(self._param_value(row[x]) for x in columns)
+            groups.setdefault(columns, []).append(values)
         with self.db.cursor() as cursor:
-            cursor.execute(command)
-            tupled_table = cursor.fetchall()
-            cursor.execute('DESCRIBE {}'.format(self.table))
-            column_names = [x[0] for x in cursor.fetchall()]
-            table = tabulate(tupled_table, column_names)
-            print(table)
+            for columns, values in groups.items():
+                cursor.executemany(
+                    self._many_cmd(columns, upsert, key, keep), values)
+        self.db.commit()
+
+    def _write_batch(self, rows, upsert=False, key=None, keep=()):
+        ''' Write a batch of rows. If the batch fails it is rolled back
+            and retried row by row so only the bad rows are lost.
+            Returns the number of rows written.
+        '''
+        try:
+            self._execute_batch(rows, upsert, key, keep)
+            self._written(rows)
+            return len(rows)
+        except Exception:
+            self.db.rollback()
+            logger.warning(
+                'Batch of %s rows failed, retrying rows individually',
+                len(rows))
+        written = 0
+        for row in rows:
+            try:
+                self._execute_batch([row], upsert, key, keep)
+                self._written([row])
+                written += 1
+            except Exception:
+                self.db.rollback()
+                logger.exception('Failed to write row %s', row)
+                self.failed_rows.append(row)
+                self._settle_indexes([row], written=False)
+                metrics.ROWS_FAILED.inc(table=self.table)
+        return written
+
+    def insert_many(self, rows, batch_size=None, upsert=False):
+        ''' Insert a list of dicts, where the keys are column names,
+            in batches. Returns the number of rows written.
+        '''
+        batch_size = batch_size or self.batch_size
+        rows = list(rows)
+        written = 0
+        for i in range(0, len(rows), batch_size):
+            written += self._write_batch(rows[i:i + batch_size], upsert)
+        return written
+
+    def upsert_many(self, rows, batch_size=None):
+        ''' Insert a list of dicts, updating rows whose primary
+            key already exists. Returns the number of rows written.
+        '''
+        return self.insert_many(rows, batch_size, upsert=True)
+
+    def update_many(self, rows, key, batch_size=None, keep=()):
+        ''' Update the rows matching each dicts key column value with
+            the dicts other items, in batches, leaving the automatic
+            timestamp columns in keep unchanged. Returns the number of
+            rows written.
+        '''
+        batch_size = batch_size or self.batch_size
+        rows = list(rows)
+        written = 0
+        for i in range(0, len(rows), batch_size):
+            written += self._write_batch(rows[i:i + batch_size], key=key,
+                                         keep=keep)
+        return written
+
+    def delete_many(self, column, values, chunk_size=500):
+        ''' Delete the rows whose column holds one of the given values.
+            Returns the number of rows deleted.
+        '''
+        values = list(values)
+        deleted = 0
+        with self.db.cursor() as cursor:
+            for i in range(0, len(values), chunk_size):
+                chunk = values[i:i + chunk_size]
+                command = 'DELETE FROM {} WHERE {} IN ({})'.format(
+                    self.table, column, ', '.join(['%s'] * len(chunk)))
+                deleted += cursor.execute(command, chunk)
+        self.db.commit()
+        return deleted
+
+    def buffer(self, row, upsert=False):
+        ''' Queue a row to be written, writing the queue once it
+            reaches batch_size.
+        '''
+        pending = self.pending['upsert' if upsert else 'insert']
+        pending.append(row)
+        # queued rows count as existing so they are not scraped twice
+        self._queue_indexes(row)
+        if len(pending) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        ''' Write all queued rows. Returns the number of rows written.'''
+        inserts, upserts = self.pending['insert'], self.pending['upsert']
+        self.pending = {'insert': [], 'upsert': []}
+        written = self.insert_many(inserts)
+        written += self.upsert_many(upserts)
+        return written
+
+    def print(self, command, chunk_size=1000):
+        ''' Print the command's results, a table per chunk_size rows.'''
+        for columns, rows in self._stream(command, chunk_size=chunk_size):
+            print(tabulate(rows, columns))
+
+    def select(self, columns, where=None, params=None):
+        ''' Return the given columns of rows matching an optional
+            parameterized WHERE clause as a list of tuples.
+        '''
+        with self.db.cursor() as cursor:
+            cursor.execute(self._select_cmd(columns, where), params)
+            return list(cursor.fetchall())
+
+    def _stream(self, command, params=None, chunk_size=1000):
+        ''' Execute a query on an unbuffered server-side cursor and
+            yield (column names, list of row tuples) for every chunk_size
+            rows, so only one chunk is held in memory at a time.
+
+            The connection can't run other queries until every chunk
+            has been read or the generator is closed.
+        '''
+        cursor = self.backend.stream_cursor(self.db)
+        try:
+            cursor.execute(command, params)
+            columns = [x[0] for x in cursor.description]
+            while True:
+                rows = cursor.fetchmany(chunk_size)
+                if not rows:
+                    break
+                yield columns, list(rows)
+        finally:
+            # closing reads and discards any rows left unfetched
+            cursor.close()
+
+    def _select_cmd(self, columns=None, where=None):
+        ''' mySQL SELECT command for the given columns, all if None.'''
+        command = 'SELECT {} FROM {}'.format(
+            ', '.join(columns) if columns else '*', self.table)
+        if where:
+            command += ' WHERE {}'.format(where)
+        return command
+
+    def iter_chunks(self, columns=None, where=None, params=None,
+                    chunk_size=1000):
+        ''' Yield lists of up to chunk_size row tuples holding the given
+            columns, all if None, of rows matching an optional
+            parameterized WHERE clause, streamed from the server.
+        '''
+        command = self._select_cmd(columns, where)
+        for _, rows in self._stream(command, params, chunk_size):
+            yield rows
+
+    def iter_rows(self, columns=None, where=None, params=None,
+                  chunk_size=1000):
+        ''' Yield the given columns, all if None, of rows matching an
+            optional parameterized WHERE clause as tuples, streamed
+            from the server chunk_size rows at a time.
+        '''
+        for rows in self.iter_chunks(columns, where, params, chunk_size):
+            yield from rows
+
+    def describe(self):
+        ''' Return a list of (column name, lower case SQL type).'''
+        with self.db.cursor() as cursor:
+            columns = self.backend.describe(cursor, self.table)
+        return [x[:2] for x in columns]
+
+    def primary_key(self):
+        ''' Return the primary key column names.'''
+        if self._primary_key is None:
+            with self.db.cursor() as cursor:
+                self._primary_key = [
+                    x[0] for x in self.backend.describe(cursor, self.table)
+                    if x[2]]
+        return self._primary_key
 
     def column2list(self, column):
         ''' Return all values in a given column as a list.'''
-        with self.db.cursor() as cursor:
-            cursor.execute('SELECT {} FROM {}'.format(column, self.table))
-            column_values = [x[0] for x in cursor.fetchall()]
-            return column_values
+        return [x[0] for x in self.iter_rows([column])]
+
+    @staticmethod
+    def _index_key(value):
+        ''' Normalise a value the way the case insensitive
+            table collation compares it.
+        '''
+        if isinstance(value, str):
+            return value.strip().lower()
+        return value
+
+    def load_index(self, column):
+        ''' Load all values in a given column into an in-memory set
+            which exists and exists_many then use instead of querying.
+        '''
+        self.indexes[column] = {self._index_key(x[0])
+                                for x in self.iter_rows([column])}
+        self.queued.pop(column, None)
+        return self.indexes[column]
+
+    def _written(self, rows):
+        ''' Update indexes and call the write hooks with committed rows.'''
+        self._settle_indexes(rows, written=True)
+        self._update_indexes(rows)
+        metrics.ROWS_WRITTEN.inc(len(rows), table=self.table)
+        for hook in self.write_hooks:
+            hook(rows)
+
+    def _update_indexes(self, rows):
+        ''' Add the values of written rows to the loaded indexes.'''
+        for column, index in self.indexes.items():
+            for row in rows:
+                if row.get(column) is not None:
+                    index.add(self._index_key(row[column]))
+
+    def _queue_indexes(self, row):
+        ''' Add the values of a queued row to the loaded indexes,
+            noting those not already there.
+        '''
+        for column, index in self.indexes.items():
+            if row.get(column) is None:
+                continue
+            key = self._index_key(row[column])
+            queued = self.queued.setdefault(column, collections.Counter())
+            if key in queued or key not in index:
+                index.add(key)
+                queued[key] += 1
+
+    def _settle_indexes(self, rows, written):
+        ''' Stop tracking the values of queued rows once written, or
+            remove them from the indexes if no other queued row holds
+            them when the rows failed to be written.
+        '''
+        for column, queued in self.queued.items():
+            for row in rows:
+                key = self._index_key(row.get(column))
+                if key not in queued:
+                    continue
+                queued[key] -= 1
+                if written:
+                    del queued[key]
+                elif queued[key] <= 0:
+                    del queued[key]
+                    self.indexes[column].discard(key)
 
     def exists(self, column, query):
         ''' Checks if a query is present within a given table
             column. Returns a Boolean.
         '''
-        num2bool = {1: True, 0: False}
-        base_command = "SELECT * FROM {} WHERE {} = '{}'"
-        command = base_command.format(self.table, column, query)
+        if column in self.indexes:
+            return self._index_key(query) in self.indexes[column]
+        command = 'SELECT 1 FROM {} WHERE {} = %s LIMIT 1'.format(
+            self.table, column)
         with self.db.cursor() as cursor:
-            exist = cursor.execute(command)
-            return num2bool.get(exist)
+            cursor.execute(command, (query,))
+            return cursor.fetchone() is not None
 
-    def to_pandas(self):
-        ''' Convert a database table to pandas DataFrame.'''
-        command = 'SELECT * FROM {}'.format(self.table)
-        df = pd.read_sql(command, con=self.db)
+    def exists_many(self, column, queries, chunk_size=500):
+        ''' Checks which queries are present within a given table
+            column. Returns a dict of query: Boolean.
+        '''
+        queries = list(queries)
+        if column in self.indexes:
+            index = self.indexes[column]
+            return {x: self._index_key(x) in index for x in queries}
+        found = set()
+        with self.db.cursor() as cursor:
+            for i in range(0, len(queries), chunk_size):
+                chunk = queries[i:i + chunk_size]
+                command = 'SELECT {} FROM {} WHERE {} IN ({})'.format(
+                    column, self.table, column, ', '.join(['%s'] * len(chunk)))
+                cursor.execute(command, chunk)
+                found.update(self._index_key(x[0]) for x in cursor.fetchall())
+        return {x: self._index_key(x) in found for x in queries}
+
+    def to_pandas(self, chunksize=None, columns=None, where=None,
+                  params=None):
+        ''' Convert a database table to pandas DataFrame, or if chunksize
+            is given a generator of DataFrames of up to chunksize rows
+            streamed from the server.
+        '''
+        command = self._select_cmd(columns, where)
+        if chunksize:
+            return self._iter_frames(command, params, chunksize)
+        df = pd.read_sql(command, con=self.db, params=params)
         return df
 
+    def _iter_frames(self, command, params, chunksize):
+        for columns, rows in self._stream(command, params, chunksize):
+            yield pd.DataFrame.from_records(rows, columns=columns)
+
     def close(self):
-        ''' Close the database object.'''
+        ''' Write any queued rows and close the database object.'''
+        if any(self.pending.values()):
+            self.flush()
         self.db.close()
@@ -0,0 +1,185 @@
+''' Export the CRAFT_BEERS table to typed, compressed Parquet or Arrow IPC
+snapshots, optionally only the rows changed since the last export.
+
+Example:
+    python -m database.snapshot_export snapshots/ --incremental
+'''
+from database.database_creation import open_database_table, BACKENDS
+from datetime import datetime
+import log_config
+import pyarrow.parquet as pq
+import pyarrow as pa
+import argparse
+import logging
+import json
+import os
+
+logger = logging.getLogger('beerscraper.database')
+# file in the export directory recording the last exported updated_at
+STATE_FILE = '_export_state.json'
+FORMATS = {'parquet': '.parquet', 'arrow': '.arrow'}
+# rows read from mySQL and written per Parquet row group / Arrow batch
+ROW_GROUP_SIZE = 10000
+
+
+def arrow_type(sql_type):
+    ''' Return the Arrow type of a lower case mySQL column type.'''
+    if sql_type.startswith(('tinyint', 'smallint', 'mediumint',
+                            'int', 'bigint')):
+        return pa.int64()
+    if sql_type.startswith(('float', 'double', 'decimal')):
+        return pa.float64()
+    if sql_type.startswith(('datetime', 'timestamp')):
+        return pa.timestamp('s')
+    if sql_type.startswith('date'):
+        return pa.date32()
+    return pa.string()
+
+
+def table_schema(table):
+    ''' Return the Arrow schema of an SQLTable.'''
+    return pa.schema([(name, arrow_type(sql_type))
+                      for name, sql_type in table.describe()])
+
+
+def rows2batch(rows, schema):
+    ''' Convert a list of row tuples to an Arrow RecordBatch.'''
+    columns = list(zip(*rows))
+    arrays = [pa.array(values, type=field.type)
+              for values, field in zip(columns, schema)]
+    return pa.RecordBatch.from_arrays(arrays, schema=schema)
+
+
+def load_state(out_dir):
+    ''' Return the export state of a directory, empty if never exported.'''
+    path = os.path.join(out_dir, STATE_FILE)
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_state(out_dir, state):
+    path = os.path.join(out_dir, STATE_FILE)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(state, f, indent=2)
+    os.replace(path + '.tmp', path)
+
+
+class SnapshotWriter(object):
+    ''' Write RecordBatches to a Parquet or Arrow IPC file.
+
+    Parameters:
+        path: file to write
+        schema: Arrow schema of the batches
+        file_format: 'parquet' (zstd compressed) or 'arrow'
+                     (lz4 compressed IPC file, which can be memory mapped)
+    '''
+
+    def __init__(self, path, schema, file_format='parquet'):
+        if file_format == 'parquet':
+            self.writer = pq.ParquetWriter(path, schema, compression='zstd')
+        else:
+            options = pa.ipc.IpcWriteOptions(compression='lz4')
+            self.writer = pa.ipc.new_file(path, schema, options=options)
+        self.file_format = file_format
+
+    def write(self, batch):
+        if self.file_format == 'parquet':
+            # every batch becomes its own row group
+            self.writer.write_table(pa.Table.from_batches([batch]))
+        else:
+            self.writer.write_batch(batch)
+
+    def close(self):
+        self.writer.close()
+
+
+def export_snapshot(table, out_dir, incremental=False, file_format='parquet',
+                    row_group_size=ROW_GROUP_SIZE):
+    ''' Stream an SQLTable into a new snapshot file in out_dir and
+        return its path, or None if an incremental export found no
+        changed rows. The table needs the updated_at column added by
+        database_creation.migrate.
+
+        Incremental exports only hold rows whose updated_at is at or
+        after the newest one previously exported. Rows changed within
+        that same second may appear in two snapshots, so readers should
+        keep the latest row per full_beer_name. Deleted rows are not
+        tracked.
+    '''
+    os.makedirs(out_dir, exist_ok=True)
+    state = load_state(out_dir)
+    where, params = None, None
+    if incremental and state.get('watermark'):
+        where, params = 'updated_at >= %s', (state['watermark'],)
+    schema = table_schema(table)
+    updated_at = schema.names.index('updated_at')
+    kind = 'incremental' if where else 'full'
+    # microseconds keep exports made within the same second apart
+    name = '{}-{}-{}{}'.format(table.table.lower(),
+                               datetime.now().strftime('%Y%m%dT%H%M%S%f'),
+                               kind, FORMATS[file_format])
+    path = os.path.join(out_dir, name)
+    if os.path.exists(path):
+        raise FileExistsError('Snapshot {} already exists'.format(path))
+    tmp = path + '.tmp'
+    writer = SnapshotWriter(tmp, schema, file_format)
+    num_rows = 0
+    watermark = state.get('watermark')
+    try:
+        for rows in table.iter_chunks(schema.names, where, params,
+                                      row_group_size):
+            writer.write(rows2batch(rows, schema))
+            num_rows += len(rows)
+            newest = max((x[updated_at] for x in rows
+                          if x[updated_at] is not None), default=None)
+            if newest and (watermark is None or
+                           newest.isoformat(' ') > watermark):
+                watermark = newest.isoformat(' ')
+    except BaseException:
+        # leave no partial snapshot behind
+        try:
+            writer.close()
+        finally:
+            os.remove(tmp)
+        raise
+    writer.close()
+    if not num_rows and where:
+        os.remove(tmp)
+        logger.info('No rows changed since %s', state['watermark'])
+        return None
+    os.replace(tmp, path)
+    state['watermark'] = watermark
+    state.setdefault('snapshots', []).append(
+        {'file': name, 'kind': kind, 'rows': num_rows,
+         'exported': datetime.now().isoformat(' ', 'seconds')})
+    save_state(out_dir, state)
+    logger.info('Exported %s rows of %s to %s', num_rows, table.table, path)
+    return path
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('out_dir', help='directory to write snapshots to')
+    parser.add_argument('--incremental', '-i', action='store_true',
+                        help='only export rows changed since the last export')
+    parser.add_argument('--format', choices=sorted(FORMATS),
+                        default='parquet')
+    parser.add_argument('--row-group-size', type=int, default=ROW_GROUP_SIZE,
+                        help='rows per Parquet row group or Arrow batch')
+    parser.add_argument('--database',
+                        help='database name, or SQLite file, to export from')
+    parser.add_argument('--backend', choices=BACKENDS)
+    args = parser.parse_args()
+    log_config.setup_logging(path=None)
+    table = open_database_table(args.database, args.backend)
+    try:
+        export_snapshot(table, args.out_dir, args.incremental, args.format,
+                        args.row_group_size)
+    finally:
+        table.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,224 @@
+''' Embedded SQLite storage usable wherever DataBase and SQLTable expect a
+    pymysql connection.
+'''
+from database.pymysql_API import MySQLBackend
+import datetime
+import sqlite3
+import re
+
+# store datetimes as text and parse DATETIME/TIMESTAMP columns back
+sqlite3.register_adapter(datetime.datetime, lambda x: x.isoformat(' '))
+sqlite3.register_converter(
+    'DATETIME', lambda x: datetime.datetime.fromisoformat(x.decode()))
+sqlite3.register_converter(
+    'TIMESTAMP', lambda x: datetime.datetime.fromisoformat(x.decode()))
+
+# mySQL automatic timestamp clauses which SQLite replaces with triggers
+AUTO_UPDATE = re.compile(r'\s+(DEFAULT CURRENT_TIMESTAMP|ON UPDATE '
+                         r'CURRENT_TIMESTAMP)', re.IGNORECASE)
+TEXT_TYPE = re.compile(r'^\s*(VAR)?CHAR\b', re.IGNORECASE)
+# SQLite's CURRENT_TIMESTAMP is UTC, whereas mySQL's and the datetime.now()
+# times written by the scrapers are local
+LOCAL_TIMESTAMP = "datetime('now', 'localtime')"
+
+
+class SQLiteBackend(MySQLBackend):
+    ''' The SQLite flavour of the SQL sent by DataBase and SQLTable.'''
+
+    name = 'sqlite'
+    # double quotes are identifiers in SQLite
+    quote = "'"
+    missing_table_error = sqlite3.OperationalError
+    insert_ignore = 'INSERT OR IGNORE'
+    # SQLite has one writer at a time, so the write lock taken at the
+    # start of the transaction stands in for row locks
+    begin_write = 'BEGIN IMMEDIATE'
+    skip_locked = ''
+    # migrations run in one write transaction, ended by their commit
+    begin_migration = 'BEGIN IMMEDIATE'
+    end_migration = None
+
+    def stream_cursor(self, db):
+        # SQLite cursors already step through rows as they are fetched
+        return db.cursor()
+
+    def describe(self, cursor, table):
+        cursor.execute('PRAGMA table_info({})'.format(table))
+        return [(x[1], x[2].lower(), x[5] > 0) for x in cursor.fetchall()]
+
+    def upsert_clause(self, columns, primary_key):
+        updates = ', '.join('{0} = excluded.{0}'.format(x) for x in columns)
+        return 'ON CONFLICT({}) DO UPDATE SET {}'.format(
+            ', '.join(primary_key), updates)
+
+    def column_ddl(self, sql_type):
+        ''' Return the SQLite column definition of a mySQL column type.
+            Text compares case insensitively, as mySQL's default
+            collation does, and automatic timestamps become triggers.
+        '''
+        sql_type = AUTO_UPDATE.sub('', sql_type)
+        if TEXT_TYPE.match(sql_type):
+            sql_type = re.sub(r'\)', ') COLLATE NOCASE', sql_type, count=1)
+        return sql_type
+
+    def timestamp_triggers(self, table, column):
+        ''' Triggers setting column to the current time whenever a row
+            is inserted or updated without setting it.
+        '''
+        body = ('BEGIN UPDATE {0} SET {1} = {2} '
+                'WHERE rowid = NEW.rowid; END').format(table, column,
+                                                       LOCAL_TIMESTAMP)
+        return ['CREATE TRIGGER IF NOT EXISTS {0}_{1}_insert AFTER INSERT '
+                'ON {0} FOR EACH ROW WHEN NEW.{1} IS NULL {2}'.format(
+                    table, column, body),
+                'CREATE TRIGGER IF NOT EXISTS {0}_{1}_update AFTER UPDATE '
+                'ON {0} FOR EACH ROW WHEN NEW.{1} IS OLD.{1} {2}'.format(
+                    table, column, body)] + \
+            self.keep_timestamp_cmds(table, column)
+
+    def keep_timestamp(self, column):
+        # a trigger can't tell a column assigned its own value from one
+        # left out, so NULL is assigned and the keep trigger restores it
+        return '{} = NULL'.format(column)
+
+    def local_timestamp_cmds(self, cursor, table, column):
+        ''' Commands replacing the triggers of tables created when they
+            set UTC times, converting the times already set.
+        '''
+        cursor.execute("SELECT sql FROM sqlite_master WHERE type = "
+                       "'trigger' AND name = %s",
+                       ('{}_{}_update'.format(table, column),))
+        trigger = cursor.fetchone()
+        if not trigger or 'CURRENT_TIMESTAMP' not in trigger[0]:
+            return []
+        cmds = ['DROP TRIGGER IF EXISTS {}_{}_{}'.format(table, column, x)
+                for x in ('insert', 'update', 'keep')]
+        # the triggers are dropped, so the conversion doesn't fire them
+        cmds.append("UPDATE {0} SET {1} = datetime({1}, 'localtime') "
+                    'WHERE {1} IS NOT NULL'.format(table, column))
+        return cmds + self.timestamp_triggers(table, column)
+
+    def keep_timestamp_cmds(self, table, column):
+        return ['CREATE TRIGGER IF NOT EXISTS {0}_{1}_keep AFTER UPDATE '
+                'ON {0} FOR EACH ROW WHEN NEW.{1} IS NULL AND OLD.{1} IS '
+                'NOT NULL BEGIN UPDATE {0} SET {1} = OLD.{1} WHERE rowid = '
+                'NEW.rowid; END'.format(table, column)]
+
+    def create_table_cmds(self, table, columns, if_not_exists=False):
+        cmds = MySQLBackend.create_table_cmds(self, table, columns,
+                                              if_not_exists)
+        for column, sql_type in columns.items():
+            if AUTO_UPDATE.search(sql_type):
+                cmds += self.timestamp_triggers(table, column)
+        return cmds
+
+    def add_column_cmds(self, table, column, sql_type):
+        cmds = MySQLBackend.add_column_cmds(self, table, column, sql_type)
+        if AUTO_UPDATE.search(sql_type):
+            # as mySQL does, existing rows take the current time
+            cmds.append('UPDATE {} SET {} = {}'.format(table, column,
+                                                       LOCAL_TIMESTAMP))
+            cmds += self.timestamp_triggers(table, column)
+        return cmds
+
+    def alter_column_cmds(self, cursor, table, columns):
+        ''' SQLite can't change column types, so the table is copied to
+            a new one with the changed types which then replaces it,
+            recreating the table's indexes and triggers.
+        '''
+        cursor.execute("SELECT sql FROM sqlite_master WHERE type = 'table' "
+                       'AND name = %s', (table,))
+        create = cursor.fetchone()[0]
+        for column, sql_type in columns.items():
+            create = re.sub(
+                r'(\b{}\s+)\w+(\s*\([\d,\s]*\))?'.format(re.escape(column)),
+                lambda x: x.group(1) + self.column_ddl(sql_type), create,
+                count=1)
+        create = re.sub(r'^CREATE TABLE\s+["`]?\w+["`]?',
+                        'CREATE TABLE {}_migrating'.format(table), create)
+        cursor.execute("SELECT sql FROM sqlite_master WHERE tbl_name = %s "
+                       "AND type IN ('index', 'trigger') AND sql IS NOT NULL",
+                       (table,))
+        recreate = [x[0] for x in cursor.fetchall()]
+        return [create,
+                'INSERT INTO {0}_migrating SELECT * FROM {0}'.format(table),
+                'DROP TABLE {}'.format(table),
+                'ALTER TABLE {0}_migrating RENAME TO {0}'.format(table)] + \
+            recreate
+
+    def index_names(self, cursor, table):
+        cursor.execute('PRAGMA index_list({})'.format(table))
+        return {x[1] for x in cursor.fetchall()}
+
+
+SQLITE = SQLiteBackend()
+
+
+class SQLiteCursor(object):
+    ''' sqlite3 cursor taking pymysql style %s placeholders which can be
+        used as a context manager.
+    '''
+
+    def __init__(self, cursor):
+        self.cursor = cursor
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.cursor.close()
+
+    def __getattr__(self, name):
+        return getattr(self.cursor, name)
+
+    def execute(self, command, params=None):
+        if params is None:
+            self.cursor.execute(command)
+        else:
+            self.cursor.execute(command.replace('%s', '?'), params)
+        return self.cursor.rowcount
+
+    def executemany(self, command, params):
+        self.cursor.executemany(command.replace('%s', '?'), params)
+        return self.cursor.rowcount
+
+
+class SQLiteConnection(object):
+    ''' SQLite database file opened with the parts of the pymysql
+        connection interface used by DataBase and SQLTable.
+
+        The database uses write-ahead logging, so readers don't block
+        the writer, and each batch of rows written by SQLTable is a
+        single transaction.
+
+    Parameters:
+        path: database file, created if missing
+        timeout: seconds to wait for another connection's write lock
+
+    Example:
+        db = SQLiteConnection('beers.sqlite3')
+        beers = SQLTable(db, 'CRAFT_BEERS')
+    '''
+
+    backend = SQLITE
+
+    def __init__(self, path, timeout=30):
+        self.path = path
+        self.conn = sqlite3.connect(path, timeout=timeout,
+                                    detect_types=sqlite3.PARSE_DECLTYPES,
+                                    check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        # with WAL, commits only wait for the log write, not an fsync
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+
+    def cursor(self, *args):
+        return SQLiteCursor(self.conn.cursor())
+
+    def commit(self):
+        self.conn.commit()
+
+    def rollback(self):
+        self.conn.rollback()
+
+    def close(self):
+        self.conn.close()
@@ -0,0 +1,128 @@
+''' Non-blocking logging: records are queued by the logging thread and
+    written to the console and a rotating log file by a background thread.
+'''
+from logging.handlers import QueueHandler, QueueListener
+from logging.handlers import RotatingFileHandler
+import custom_exceptions
+import logging
+import atexit
+import queue
+import copy
+import json
+
+LOG_PATH = 'beerscraper.log'
+# pipeline stages which can be given their own verbosity, each one
+# logs through the beerscraper.<stage> logger
+STAGES = ('pipeline', 'beerhawk', 'brewerydb', 'ratebeer', 'http',
+          'database', 'journal', 'queue', 'metrics')
+TEXT_FORMAT = '%(asctime)s %(levelname)s %(name)s: %(message)s'
+
+_LISTENER = None
+
+
+def configured():
+    ''' Return True once setup_logging has been called.'''
+    return _LISTENER is not None
+
+
+def stage_logger(stage):
+    ''' Return the logger of a pipeline stage.'''
+    return logging.getLogger('beerscraper.{}'.format(stage))
+
+
+class _QueueHandler(QueueHandler):
+    ''' QueueHandler which keeps a record's traceback apart from its
+        message, so it can be given its own JSON field.
+    '''
+
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.message = record.getMessage()
+        record.msg, record.args = record.message, None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(
+                record.exc_info)
+            record.exc_info = None
+        return record
+
+
+class JSONFormatter(logging.Formatter):
+    ''' Format records as one JSON object per line.'''
+
+    def format(self, record):
+        entry = {'time': self.formatTime(record),
+                 'level': record.levelname,
+                 'stage': record.name.rpartition('.')[2],
+                 'message': record.getMessage()}
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry['exception'] = record.exc_text
+        return json.dumps(entry)
+
+
+def setup_logging(path=LOG_PATH, level='INFO', stage_levels=None,
+                  json_lines=False, max_bytes=10 * 1024 * 1024,
+                  backup_count=5, console=True):
+    ''' Route all logging through a queue to a background thread which
+        writes to the console and a size rotated log file. Only the
+        first call has any effect.
+
+    Args:
+        path: log file, None to only log to the console
+        level: level of the root logger, e.g. 'INFO'
+        stage_levels: dict of {stage: level} overriding level for the
+                      loggers of the given STAGES
+        json_lines: write the log file as JSON lines
+        max_bytes: size at which the log file is rotated
+        backup_count: number of rotated log files kept
+        console: also log to the console
+    '''
+    global _LISTENER
+    if _LISTENER:
+        return _LISTENER
+    handlers = []
+    if path:
+        handler = RotatingFileHandler(path, maxBytes=max_bytes,
+                                      backupCount=backup_count)
+        handler.setFormatter(JSONFormatter() if json_lines
+                             else logging.Formatter(TEXT_FORMAT))
+        handlers.append(handler)
+    if console:
+        handler = logging.StreamHandler()
+        handler.setFormatter(logging.Formatter(TEXT_FORMAT))
+        handlers.append(handler)
+    records = queue.SimpleQueue()
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    root.addHandler(_QueueHandler(records))
+    root.setLevel(level)
+    for stage, stage_level in (stage_levels or {}).items():
+        stage_logger(stage).setLevel(stage_level)
+    # ignores non-critical logging from urllib3 library
+    logging.getLogger('urllib3').setLevel(logging.CRITICAL)
+    _LISTENER = QueueListener(records, *handlers)
+    _LISTENER.start()
+    # write any records still queued when the interpreter exits
+    atexit.register(stop_logging)
+    return _LISTENER
+
+
+def stop_logging():
+    ''' Write any queued records and stop the background thread.'''
+    global _LISTENER
+    if _LISTENER:
+        _LISTENER.stop()
+        _LISTENER = None
+
+
+def parse_stage_levels(values):
+    ''' Parse STAGE=LEVEL strings into {stage: level}.'''
+    levels = {}
+    for value in values or []:
+        stage, _, level = value.partition('=')
+        if stage not in STAGES:
+            raise custom_exceptions.InvalidChoice(stage, STAGES)
+        levels[stage] = level.upper()
+    return levels
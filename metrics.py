@@ -0,0 +1,293 @@
+''' Counters and latency histograms for the scrape pipeline, exported as
+    periodic JSON summaries and Prometheus text.
+'''
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse
+import contextlib
+import threading
+import logging
+import bisect
+import json
+import time
+import os
+
+logger = logging.getLogger('beerscraper.metrics')
+# upper bounds, in seconds, of the latency histogram buckets
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+           1.0, 2.5, 5.0, 10.0, 30.0, float('inf'))
+
+
+def _label_str(names, values):
+    ''' Format label values as Prometheus {name="value"} text.'''
+    if not names:
+        return ''
+    pairs = ['{}="{}"'.format(k, str(i).replace('"', '\\"'))
+             for k, i in zip(names, values)]
+    return '{' + ','.join(pairs) + '}'
+
+
+class Counter(object):
+    ''' Monotonic count per combination of label values.
+
+    Example:
+        rows = Counter('rows_written_total', 'Rows written', ['table'])
+        rows.inc(10, table='CRAFT_BEERS')
+    '''
+
+    kind = 'counter'
+
+    def __init__(self, name, doc, labels=()):
+        self.name = name
+        self.doc = doc
+        self.labels = tuple(labels)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(str(labels.get(x, '')) for x in self.labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def summary(self):
+        with self.lock:
+            return {','.join(k) or 'total': i for k, i in self.values.items()}
+
+    def prometheus(self):
+        with self.lock:
+            return ['{}{} {}'.format(self.name, _label_str(self.labels, k), i)
+                    for k, i in sorted(self.values.items())]
+
+
+class Histogram(object):
+    ''' Bucketed latency distribution per combination of label values.
+
+    Example:
+        latency = Histogram('stage_seconds', 'Stage latency', ['stage'])
+        latency.observe(0.2, stage='ratebeer')
+    '''
+
+    kind = 'histogram'
+
+    def __init__(self, name, doc, labels=(), buckets=BUCKETS):
+        self.name = name
+        self.doc = doc
+        self.labels = tuple(labels)
+        self.buckets = buckets
+        # label values: [bucket counts, sum, count]
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def observe(self, seconds, **labels):
+        key = tuple(str(labels.get(x, '')) for x in self.labels)
+        index = bisect.bisect_left(self.buckets, seconds)
+        with self.lock:
+            value = self.values.setdefault(
+                key, [[0] * len(self.buckets), 0.0, 0])
+            value[0][index] += 1
+            value[1] += seconds
+            value[2] += 1
+
+    def _quantile(self, counts, total, q):
+        ''' Estimate a quantile as the upper bound of its bucket.'''
+        rank = q * total
+        cumulative = 0
+        for bound, count in zip(self.buckets, counts):
+            cumulative += count
+            if cumulative >= rank:
+                return bound
+        return self.buckets[-1]
+
+    def summary(self):
+        summary = {}
+        with self.lock:
+            for key, (counts, total, count) in self.values.items():
+                summary[','.join(key) or 'total'] = {
+                    'count': count,
+                    'sum': total,
+                    'mean': total / count,
+                    'p50': self._quantile(counts, count, 0.5),
+                    'p90': self._quantile(counts, count, 0.9),
+                    'p99': self._quantile(counts, count, 0.99)}
+        return summary
+
+    def prometheus(self):
+        lines = []
+        with self.lock:
+            for key, (counts, total, count) in sorted(self.values.items()):
+                cumulative = 0
+                for bound, bucket in zip(self.buckets, counts):
+                    cumulative += bucket
+                    le = '+Inf' if bound == float('inf') else str(bound)
+                    labels = _label_str(self.labels + ('le',), key + (le,))
+                    lines.append('{}_bucket{} {}'.format(
+                        self.name, labels, cumulative))
+                labels = _label_str(self.labels, key)
+                lines.append('{}_sum{} {}'.format(self.name, labels, total))
+                lines.append('{}_count{} {}'.format(self.name, labels, count))
+        return lines
+
+
+class Registry(object):
+    ''' Collection of metrics which can be rendered together.'''
+
+    def __init__(self):
+        self.metrics = []
+
+    def counter(self, name, doc, labels=()):
+        metric = Counter(name, doc, labels)
+        self.metrics.append(metric)
+        return metric
+
+    def histogram(self, name, doc, labels=()):
+        metric = Histogram(name, doc, labels)
+        self.metrics.append(metric)
+        return metric
+
+    def to_dict(self):
+        ''' Return a JSON serialisable summary of every metric.'''
+        return {x.name: x.summary() for x in self.metrics}
+
+    def to_prometheus(self):
+        ''' Return every metric in the Prometheus text format.'''
+        lines = []
+        for metric in self.metrics:
+            lines.append('# HELP {} {}'.format(metric.name, metric.doc))
+            lines.append('# TYPE {} {}'.format(metric.name, metric.kind))
+            lines.extend(metric.prometheus())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+STAGE_SECONDS = REGISTRY.histogram(
+    'beerscraper_stage_seconds', 'Time spent in each pipeline stage',
+    ['stage'])
+HTTP_REQUESTS = REGISTRY.counter(
+    'beerscraper_http_requests_total', 'HTTP responses by host and status',
+    ['host', 'status'])
+HTTP_SECONDS = REGISTRY.histogram(
+    'beerscraper_http_request_seconds', 'HTTP request latency by host',
+    ['host'])
+HTTP_RETRIES = REGISTRY.counter(
+    'beerscraper_http_retries_total', 'HTTP request retries by host',
+    ['host'])
+BREWERYDB_KEY_REQUESTS = REGISTRY.counter(
+    'beerscraper_brewerydb_key_requests_total',
+    'BreweryDB requests sent with each API key index', ['key'])
+HTTP_THROTTLED = REGISTRY.counter(
+    'beerscraper_http_throttled_total',
+    'HTTP responses asking us to slow down (429 or 503) by host', ['host'])
+CACHE_LOOKUPS = REGISTRY.counter(
+    'beerscraper_cache_lookups_total',
+    'Response cache lookups by host and result (hit or miss)',
+    ['host', 'result'])
+ROWS_WRITTEN = REGISTRY.counter(
+    'beerscraper_rows_written_total', 'Rows committed to each table',
+    ['table'])
+ROWS_FAILED = REGISTRY.counter(
+    'beerscraper_rows_failed_total', 'Rows which failed to be written',
+    ['table'])
+
+
+class timed(contextlib.ContextDecorator):
+    ''' Record the time spent in a block, or decorated function,
+        under the given pipeline stage.
+
+    Example:
+        @timed('ratebeer')
+        def scrape_ratebeer(beer):
+            ...
+    '''
+
+    def __init__(self, stage):
+        self.stage = stage
+
+    def _recreate_cm(self):
+        # a new instance per decorated call keeps concurrent timings apart
+        return timed(self.stage)
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        STAGE_SECONDS.observe(time.perf_counter() - self.start,
+                              stage=self.stage)
+
+
+def observe_http(link, status, seconds):
+    ''' Record the status and latency of an HTTP response.'''
+    host = urlparse(link).netloc
+    HTTP_REQUESTS.inc(host=host, status=status)
+    HTTP_SECONDS.observe(seconds, host=host)
+
+
+def observe_cache(link, hit):
+    ''' Record a response cache hit or miss.'''
+    CACHE_LOOKUPS.inc(host=urlparse(link).netloc,
+                      result='hit' if hit else 'miss')
+
+
+def _write_atomic(path, text):
+    tmp = '{}.tmp'.format(path)
+    with open(tmp, 'w') as f:
+        f.write(text)
+    os.replace(tmp, path)
+
+
+class MetricsExporter(threading.Thread):
+    ''' Background thread periodically logging a JSON summary and
+        writing it, with the Prometheus text, to <prefix>.json and
+        <prefix>.prom.
+
+    Parameters:
+        prefix: path prefix of the exported files, None to only log
+        interval: seconds between exports
+        registry: metrics to export
+    '''
+
+    def __init__(self, prefix=None, interval=60, registry=REGISTRY):
+        threading.Thread.__init__(self, daemon=True)
+        self.prefix = prefix
+        self.interval = interval
+        self.registry = registry
+        self.stopped = threading.Event()
+
+    def export(self):
+        ''' Log and write the current metrics.'''
+        summary = json.dumps(self.registry.to_dict(), sort_keys=True)
+        logger.info('METRICS: %s', summary)
+        if self.prefix:
+            _write_atomic(self.prefix + '.json', summary + '\n')
+            _write_atomic(self.prefix + '.prom',
+                          self.registry.to_prometheus())
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.export()
+
+    def stop(self):
+        ''' Stop the thread after a final export.'''
+        self.stopped.set()
+        self.export()
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = REGISTRY.to_prometheus().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def serve_metrics(port):
+    ''' Serve the Prometheus text on http://0.0.0.0:<port>/metrics
+        from a background thread.
+    '''
+    server = ThreadingHTTPServer(('0.0.0.0', port), _MetricsHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
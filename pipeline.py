@@ -0,0 +1,109 @@
+''' Streaming pipeline of stages, each run by its own worker threads and
+    connected by bounded queues.
+'''
+import threading
+import logging
+import queue
+
+logger = logging.getLogger('beerscraper.pipeline')
+# items waiting in front of a stage before its producers block
+DEFAULT_QUEUE_SIZE = 20
+# put on a stage's queue once per worker when its producers have finished
+_DONE = object()
+
+
+class Stage(object):
+    ''' A step of a Pipeline.
+
+    Parameters:
+        name: name used in logging
+        func: called with each item, returning the item passed to the
+              next stage, or None to drop it
+        workers: threads running func at once
+        queue_size: items waiting for this stage before the previous
+                    stage blocks, DEFAULT_QUEUE_SIZE if None
+    '''
+
+    def __init__(self, name, func, workers=1, queue_size=None):
+        self.name = name
+        self.func = func
+        self.workers = workers
+        self.queue_size = queue_size or DEFAULT_QUEUE_SIZE
+
+
+class Pipeline(object):
+    ''' Pass items through a list of Stages, every stage working on
+        different items at the same time.
+
+        The queues in front of each stage are bounded, so a slow stage
+        blocks the stages feeding it instead of letting items pile up,
+        and the slowest stage sets the pace of the whole pipeline.
+        An item whose stage raises an exception is logged and dropped.
+
+    Example:
+        pipeline = Pipeline([Stage('parse', parse, workers=4),
+                             Stage('write', write)])
+        pipeline.run(products)
+    '''
+
+    def __init__(self, stages):
+        self.stages = stages
+        self.queues = [queue.Queue(x.queue_size) for x in stages]
+        # set when the run is interrupted, workers then drop their items
+        self.stopped = threading.Event()
+        self.threads = []
+
+    def _work(self, index):
+        stage = self.stages[index]
+        inbox = self.queues[index]
+        outbox = self.queues[index + 1] if index + 1 < len(self.stages) \
+            else None
+        while True:
+            item = inbox.get()
+            if item is _DONE:
+                break
+            if self.stopped.is_set():
+                continue
+            try:
+                result = stage.func(item)
+            except Exception:
+                logger.exception('FAILED: %s stage on %s', stage.name, item)
+                continue
+            if result is not None and outbox is not None:
+                outbox.put(result)
+
+    def start(self):
+        for index, stage in enumerate(self.stages):
+            threads = [threading.Thread(target=self._work, args=(index,),
+                                        name='{}-{}'.format(stage.name, x),
+                                        daemon=True)
+                       for x in range(stage.workers)]
+            for thread in threads:
+                thread.start()
+            self.threads.append(threads)
+
+    def join(self):
+        ''' Wait for every stage to finish, in order, once the first
+            stage has been given its last item.
+        '''
+        for index, threads in enumerate(self.threads):
+            for _ in threads:
+                self.queues[index].put(_DONE)
+            for thread in threads:
+                thread.join()
+
+    def run(self, items):
+        ''' Feed items to the first stage and wait until all of them
+            have passed through the pipeline. If feeding is interrupted
+            each item in the pipeline is dropped once its current stage
+            has finished with it.
+        '''
+        self.start()
+        try:
+            for item in items:
+                self.queues[0].put(item)
+        except BaseException:
+            self.stopped.set()
+            raise
+        finally:
+            self.join()
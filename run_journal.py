@@ -0,0 +1,98 @@
+''' Append-only journal of each product's progress through a scrape run.'''
+import threading
+import logging
+import json
+import os
+
+logger = logging.getLogger('beerscraper.journal')
+JOURNAL_PATH = 'beerscraper.journal'
+# stages a product moves through, skipped and written are final
+STAGES = ('listed', 'parsed', 'enriched', 'written', 'skipped')
+FINAL_STAGES = ('written', 'skipped')
+
+
+class RunJournal(object):
+    ''' Record the stage each product has reached as JSON lines so an
+        interrupted run can resume where it stopped.
+
+    Parameters:
+        path: journal file
+        resume: load the existing journal instead of starting a new one
+
+    Example:
+        journal = RunJournal(resume=True)
+        if not journal.finished(link):
+            journal.record(link, 'parsed', beer.__dict__)
+    '''
+
+    def __init__(self, path=JOURNAL_PATH, resume=False):
+        self.path = path
+        # link: [stage, data saved with the latest stage that had data]
+        self.products = {}
+        self.lock = threading.Lock()
+        if resume and os.path.exists(path):
+            self._load()
+            logger.info('RESUMING: %s products found in journal %s',
+                        len(self.products), path)
+        self.file = open(path, 'a' if resume else 'w')
+
+    def _load(self):
+        ''' Read the journal, ignoring a partially written last line.'''
+        with open(self.path) as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue
+                product = self.products.setdefault(entry['link'],
+                                                   [None, None])
+                product[0] = entry['stage']
+                if entry.get('data') is not None:
+                    product[1] = entry['data']
+
+    def record(self, link, stage, data=None):
+        ''' Append the stage reached by a product, with any data
+            needed to resume from that stage.
+        '''
+        self.record_many([(link, stage, data)])
+
+    def record_many(self, entries):
+        ''' Append a list of (link, stage, data) entries, syncing the
+            file to disk at most once.
+        '''
+        lines = [json.dumps({'link': link, 'stage': stage, 'data': data},
+                            default=str) for link, stage, data in entries]
+        with self.lock:
+            for link, stage, data in entries:
+                product = self.products.setdefault(link, [None, None])
+                product[0] = stage
+                if data is not None:
+                    product[1] = data
+            self.file.write(''.join(x + '\n' for x in lines))
+            self.file.flush()
+            # fetched data must survive a crash before it is written
+            if any(x[1] in ('enriched', 'written') for x in entries):
+                os.fsync(self.file.fileno())
+
+    def record_written(self, rows):
+        ''' Mark the products of rows committed to the database, with
+            one sync per committed batch.
+        '''
+        self.record_many([(x['beer_link'], 'written', None) for x in rows
+                          if x.get('beer_link')])
+
+    def stage(self, link):
+        ''' Return the last stage recorded for a product.'''
+        return self.products.get(link, [None, None])[0]
+
+    def data(self, link):
+        ''' Return the data saved with a product's last stage.'''
+        return self.products.get(link, [None, None])[1]
+
+    def finished(self, link):
+        ''' Check whether a product needs no more work.'''
+        return self.stage(link) in FINAL_STAGES
+
+    def close(self):
+        ''' Close the journal file.'''
+        self.file.close()
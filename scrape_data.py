@@ -1,31 +1,55 @@
-from scrapers.beerhawk import BeerHawkProduct
+from scrapers.beerhawk import BeerHawkProduct, BEERHAWK_URL, LISTING_URL
+from scrapers.beerhawk import iter_listing_products, ListingProduct
+from scrapers.beerhawk import page_specs, product_hash
+from scrapers.async_client import AsyncFetcher
 from database.database_creation import open_database_table
+import database.database_creation as database_creation
+from run_journal import RunJournal, JOURNAL_PATH
+from work_queue import WorkQueue
+from pipeline import Pipeline, Stage
 from scrapers.rate_beer import get_info_dict
-from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import datetime, timedelta
 import scrapers.brewerydb as brewerydb
+import scrapers.rate_beer as rate_beer
+import scrapers.rate_limiter as rate_limiter
+import scrapers.http_cache as http_cache
 import custom_exceptions
-import logging
+import log_config
+import metrics
 import unidecode
+import collections
+import itertools
+import threading
+import hashlib
+import json
 import argparse
-import re
+import asyncio
+import time
 
 
-def intiate_logger():
-    logging.basicConfig(filename='beerscraper.log', level=logging.DEBUG)
-    # ensure log prints to screen as well as writing to file
-    logging.getLogger().addHandler(logging.StreamHandler())
-    # ignores non-critical logging from urllib3 library
-    logging.getLogger('urllib3').setLevel(logging.CRITICAL)
+logger = log_config.stage_logger('pipeline')
+beerhawk_logger = log_config.stage_logger('beerhawk')
+brewerydb_logger = log_config.stage_logger('brewerydb')
+ratebeer_logger = log_config.stage_logger('ratebeer')
+
+
+def intiate_logger(**kwargs):
+    ''' Start logging to the console and beerscraper.log from a
+        background thread, see log_config.setup_logging for kwargs.
+    '''
+    if log_config.configured():
+        return
+    log_config.setup_logging(**kwargs)
     now = datetime.now().strftime('%d/%m/%y %H:%M:%S')
-    logging.info('Logger Intiated: {}'.format(now))
+    logger.info('Logger Intiated: %s', now)
 
 
 def get_all_beerhawk_products():
-    ''' Get a list of all beerhawk products HTML code.'''
-    link = 'https://www.beerhawk.co.uk/browse-beers?perPage=All'
-    link_text = BeerHawkProduct.get_url_text(link)
-    all_products = link_text.find_all('div', {'id': re.compile('product.*')})
-    return all_products
+    ''' Yield a ListingProduct for every beerhawk product whilst the
+        browse-beers page is still downloading.
+    '''
+    return iter_listing_products(http_cache.stream_text(LISTING_URL))
 
 
 def decode_dict_items(dictionary):
@@ -49,34 +73,44 @@ def clean_beer_dict(dictionary):
     return combined_beer_info
 
 
-def get_beerhawk_product(product):
+@metrics.timed('beerhawk')
+def get_beerhawk_product(product, beer_page=None):
     ''' Create a BeerHawkProduct object.'''
-    logging.info('-' * 85 + '\nSCRAPING: BeerHawk')
-    beer = BeerHawkProduct(product)
-    logging.info('PROCESSING: {} (beer: {}, brewery: {})'.format(
-        beer.full_beer_name, beer.beer_name, beer.brewery))
+    beerhawk_logger.debug('SCRAPING: BeerHawk %s', product.link)
+    beer = BeerHawkProduct(product, beer_page)
+    beerhawk_logger.info('PROCESSING: %s (beer: %s, brewery: %s)',
+                         beer.full_beer_name, beer.beer_name, beer.brewery)
     return beer
 
 
-def scrape_brewerydb(beer, brewery):
-    ''' Scrape BreweryDB for a parsed BeerHawkProduct.'''
-    logging.info('SCRAPING: BreweryDB....')
-    brewerydb_info = brewerydb.get_all_beer_features(
-        beer, brewery)
+@metrics.timed('brewerydb')
+def scrape_brewerydb(beer, brewery, strict=False):
+    ''' Scrape BreweryDB for a parsed BeerHawkProduct. If BreweryDB
+        couldn't be searched {} is returned, or None when strict.
+    '''
+    brewerydb_logger.debug('SCRAPING: BreweryDB %s', beer)
+    try:
+        brewerydb_info = brewerydb.get_all_beer_features(
+            beer, brewery)
+    except custom_exceptions.BreweryDBUnavailable as e:
+        brewerydb_logger.warning('FAILED: BreweryDB lookup of %s: %s',
+                                 beer, e.msg)
+        return None if strict else {}
     if not brewerydb_info:
-        msg = 'MISSING: {} not found in {} beer catalog'
-        logging.warning(msg.format(beer, brewery))
+        brewerydb_logger.warning('MISSING: %s not found in %s beer catalog',
+                                 beer, brewery)
         brewerydb_info = {}
     return brewerydb_info
 
 
+@metrics.timed('ratebeer')
 def scrape_ratebeer(beer):
     ''' Scrape RateBeer for a parsed BeerHawkProduct.'''
-    logging.info('SCRAPING: RateBeer....')
+    ratebeer_logger.debug('SCRAPING: RateBeer %s', beer)
     ratebeer_info = get_info_dict(beer, 'beers')
     if not ratebeer_info:
-        logging.warning('MISSING: No info found in RateBeer for {}'.format(
-            beer))
+        ratebeer_logger.warning('MISSING: No info found in RateBeer for %s',
+                                beer)
         ratebeer_info = {}
     else:
         # don't want brewery objects
@@ -84,65 +118,627 @@ def scrape_ratebeer(beer):
     return ratebeer_info
 
 
-def scrape_all_databases(beer):
-    ''' Search and scrape BreweryDB and RateBeer for the parsed beer.'''
-    brewerydb_info = scrape_brewerydb(beer.beer_name, beer.brewery)
-    ratebeer_info = scrape_ratebeer(beer.full_beer_name)
+def combine_beer_info(beer, brewerydb_info, ratebeer_info):
+    ''' Merge the BeerHawkProduct with its BreweryDB and RateBeer info.'''
     scrapped_data = {**brewerydb_info, **
                      ratebeer_info, **beer.__dict__}
     combined_beer_info = clean_beer_dict(scrapped_data)
     return combined_beer_info
 
 
+def scrape_all_databases(beer):
+    ''' Search and scrape BreweryDB and RateBeer for the parsed beer.'''
+    brewerydb_info = scrape_brewerydb(beer.beer_name, beer.brewery)
+    ratebeer_info = scrape_ratebeer(beer.full_beer_name)
+    return combine_beer_info(beer, brewerydb_info, ratebeer_info)
+
+
 def update_brewerydb():
     ''' Update BreweryDB entries in the CRAFT_BEERS table.'''
     intiate_logger()
     table = open_database_table()
     beers = table.column2list('full_beer_name')
     breweries = table.column2list('brewery')
-    logging.info('Updating BreweryDB entries in the CRAFT_BEER table')
-    for beer, brewery, in zip(beers, breweries):
-        logging.info('-' * 85 + '\nUPDATING: {}'.format(beer))
-        brewerydb_info = scrape_brewerydb(beer, brewery)
-        brewerydb_info = clean_beer_dict(brewerydb_info)
-        if brewerydb_info:
-            logging.info(
-                'ADDING: BreweryDB info for {} to the CRAFT_BEERS table'.format(beer))
-            # unwanted info (abv, name) excluded
-            brewerydb_info.pop('abv', None)
-            brewerydb_info.pop('name', None)
-            command = table.dict2cmd(dictionary=brewerydb_info,
-                                     command='update',
-                                     conditions={'full_beer_name': beer})
-            logging.info('SQL: {}'.format(command))
-            table.cmd(command)
-
-
-def scrape_all_products_info():
+    logger.info('Updating BreweryDB entries in the CRAFT_BEER table')
+    # grouping by brewery means each brewery catalog is requested once
+    rows = sorted(zip(beers, breweries), key=lambda x: x[1] or '')
+    for brewery, group in itertools.groupby(rows, key=lambda x: x[1]):
+        logger.info('BREWERY: %s', brewery)
+        for beer, _ in group:
+            logger.info('UPDATING: %s', beer)
+            brewerydb_info = scrape_brewerydb(beer, brewery)
+            brewerydb_info = clean_beer_dict(brewerydb_info)
+            if brewerydb_info:
+                logger.info(
+                    'ADDING: BreweryDB info for %s to the CRAFT_BEERS table', beer)
+                # unwanted info (abv, name) excluded
+                brewerydb_info.pop('abv', None)
+                brewerydb_info.pop('name', None)
+                command = table.dict2cmd(dictionary=brewerydb_info,
+                                         command='update',
+                                         conditions={'full_beer_name': beer})
+                logger.debug('SQL: %s', command)
+                table.cmd(command)
+
+
+# CRAFT_BEERS columns filled from BreweryDB by update_brewerydb
+BREWERYDB_COLUMNS = ['ibu', 'isOrganic', 'srm', 'abvMin', 'abvMax',
+                     'fgMin', 'fgMax', 'ibuMin', 'ibuMax']
+
+
+def features_hash(features):
+    ''' Return a hash of BreweryDB features used to detect changes.'''
+    dumped = json.dumps(features, sort_keys=True, default=str)
+    return hashlib.sha1(dumped.encode('utf-8')).hexdigest()
+
+
+def stale_brewerydb_rows(table, max_age_days=30, retry_missing_days=1):
+    ''' Return (beer, brewery, hash) of rows never refreshed, refreshed
+        over max_age_days ago, or with no BreweryDB info and refreshed
+        over retry_missing_days ago.
+    '''
+    now = datetime.now()
+    missing = ' AND '.join('{} IS NULL'.format(x) for x in BREWERYDB_COLUMNS)
+    where = ('brewerydb_updated IS NULL OR brewerydb_updated < %s '
+             'OR ({} AND brewerydb_updated < %s)'.format(missing))
+    params = (now - timedelta(days=max_age_days),
+              now - timedelta(days=retry_missing_days))
+    return table.select(['full_beer_name', 'brewery', 'brewerydb_hash'],
+                        where, params)
+
+
+def update_brewerydb_incremental(max_age_days=30, retry_missing_days=1):
+    ''' Refresh BreweryDB entries only for stale rows, writing
+        features only when they differ from those last fetched.
+    '''
+    intiate_logger()
+    table = open_database_table()
+    rows = stale_brewerydb_rows(table, max_age_days, retry_missing_days)
+    logger.info('Refreshing BreweryDB entries for %s stale rows', len(rows))
+    rows = sorted(rows, key=lambda x: x[1] or '')
+    changed, unchanged = [], []
+    try:
+        for brewery, group in itertools.groupby(rows, key=lambda x: x[1]):
+            for beer, _, old_hash in group:
+                brewerydb_info = scrape_brewerydb(beer, brewery, strict=True)
+                if brewerydb_info is None:
+                    # stays stale so the next run tries it again
+                    logger.warning('SKIPPING: %s, BreweryDB unavailable',
+                                   beer)
+                    continue
+                brewerydb_info = clean_beer_dict(brewerydb_info)
+                # unwanted info (abv, name) excluded
+                brewerydb_info.pop('abv', None)
+                brewerydb_info.pop('name', None)
+                new_hash = features_hash(brewerydb_info)
+                now = datetime.now()
+                if new_hash == old_hash:
+                    logger.info('UNCHANGED: %s', beer)
+                    unchanged.append({'brewerydb_updated': now,
+                                      'full_beer_name': beer})
+                    continue
+                logger.info('CHANGED: BreweryDB info for %s', beer)
+                changed.append({**brewerydb_info, 'brewerydb_hash': new_hash,
+                                'brewerydb_updated': now,
+                                'full_beer_name': beer})
+                if len(changed) >= table.batch_size:
+                    table.update_many(changed, key='full_beer_name')
+                    changed = []
+    finally:
+        table.update_many(changed, key='full_beer_name')
+        # only the refresh time of unchanged rows is touched, so they
+        # aren't exported as changed
+        table.update_many(unchanged, key='full_beer_name',
+                          keep=['updated_at'])
+        table.close()
+
+
+# columns identifying a beer, its BreweryDB and RateBeer info is only
+# fetched again by refresh_beerhawk_products when one of them changes
+IDENTITY_COLUMNS = ['full_beer_name', 'beer_name', 'brewery']
+
+
+def stored_beerhawk_rows(table):
+    ''' Return {beer_link: {column: value}} of the identity columns
+        and beerhawk_hash of each row.
+    '''
+    columns = ['beer_link', 'beerhawk_hash'] + IDENTITY_COLUMNS
+    return {x[0]: dict(zip(columns, x)) for x in table.iter_rows(columns)
+            if x[0]}
+
+
+def name_key(value):
+    ''' Normalise a name the way the case insensitive table collation
+        compares it.
+    '''
+    return str(value or '').strip().lower()
+
+
+def identity_changed(beer, stored):
+    ''' Check whether a parsed beer is identified differently to its
+        stored row.
+    '''
+    return any(name_key(getattr(beer, x)) != name_key(stored[x])
+               for x in IDENTITY_COLUMNS)
+
+
+def refresh_beerhawk_products():
+    ''' Re-parse and write only the listed products whose listing
+        fields or spec table changed since they were stored, found by
+        comparing content hashes. Changed products are enriched from
+        BreweryDB and RateBeer again only if their identity columns
+        changed, and products not yet stored are scraped in full.
+    '''
+    intiate_logger()
+    table = open_database_table()
+    stored = stored_beerhawk_rows(table)
+    table.load_index('full_beer_name')
+    logger.info('Refreshing BeerHawk products, %s stored', len(stored))
+    changed, unchanged, renamed = [], [], []
+    try:
+        for product in get_all_beerhawk_products():
+            try:
+                beer_page = http_cache.get_text(BEERHAWK_URL + product.link)
+                new_hash = product_hash(product, page_specs(beer_page))
+                old = stored.get(product.link)
+                now = datetime.now()
+                if old and old['beerhawk_hash'] == new_hash:
+                    beerhawk_logger.debug('UNCHANGED: %s', product.link)
+                    unchanged.append({'beerhawk_updated': now,
+                                      'full_beer_name': old['full_beer_name']})
+                    continue
+                beer = get_beerhawk_product(product, beer_page)
+                if (old and not identity_changed(beer, old)) or \
+                        (not old and table.exists('full_beer_name',
+                                                  beer.full_beer_name)):
+                    # only the BeerHawk columns are rewritten
+                    logger.info('CHANGED: BeerHawk info for %s',
+                                beer.full_beer_name)
+                    changed.append({**clean_beer_dict(dict(beer.__dict__)),
+                                    'beerhawk_updated': now})
+                    if len(changed) >= table.batch_size:
+                        table.update_many(changed, key='full_beer_name')
+                        changed = []
+                    continue
+                if old:
+                    logger.info('RENAMED: %s is now %s',
+                                old['full_beer_name'], beer.full_beer_name)
+                    renamed.append((old['full_beer_name'],
+                                    beer.full_beer_name))
+                else:
+                    logger.info('NEW: %s', beer.full_beer_name)
+                combined_beer_info = scrape_all_databases(beer)
+                combined_beer_info['beerhawk_updated'] = now
+                table.buffer(combined_beer_info, upsert=True)
+            except custom_exceptions.NonBeerProduct as e:
+                logger.warning(
+                    'SKIPPING: detected non-beer product %s', e.product)
+            except custom_exceptions.OfflineCacheMiss as e:
+                logger.warning('SKIPPING: %s', e.msg)
+    finally:
+        table.flush()
+        table.update_many(changed, key='full_beer_name')
+        # only the refresh time of unchanged rows is touched, so they
+        # aren't exported as changed
+        table.update_many(unchanged, key='full_beer_name',
+                          keep=['updated_at'])
+        # rows under their old names are deleted once the renamed rows
+        # replacing them are written
+        failed = {name_key(x.get('full_beer_name'))
+                  for x in table.failed_rows}
+        table.delete_many('full_beer_name', [
+            old for old, new in renamed
+            if name_key(old) != name_key(new) and
+            name_key(new) not in failed])
+        table.close()
+
+
+def resume_product(product, table, journal):
+    ''' Finish a product using the run journal if it was written,
+        skipped or enriched by a previous run. Returns True if there
+        is nothing left to scrape for the product.
+    '''
+    if journal.finished(product.link):
+        logger.info('SKIPPING: %s finished in a previous run', product.link)
+        return True
+    if journal.stage(product.link) == 'enriched':
+        logger.info('RESUMING: adding enriched %s to database table',
+                    product.link)
+        # the row may have been committed before its 'written' entry
+        # was journaled
+        table.buffer(journal.data(product.link), upsert=True)
+        return True
+    return False
+
+
+def parse_product(product, table, journal, beer=None):
+    ''' Return the BeerHawkProduct for a listed product, reusing the
+        one saved in the run journal or the given already parsed beer,
+        or None if it is already in the database table.
+    '''
+    if journal.stage(product.link) == 'parsed':
+        beer = BeerHawkProduct.from_dict(journal.data(product.link))
+    else:
+        journal.record(product.link, 'listed')
+        beer = beer or get_beerhawk_product(product)
+        journal.record(product.link, 'parsed', beer.__dict__)
+    if table.exists('full_beer_name', beer.full_beer_name):
+        logger.info('SKIPPING: %s already present in the database',
+                    beer.full_beer_name)
+        journal.record(product.link, 'skipped')
+        return None
+    return beer
+
+
+async def parse_beer_page(product, beer_page, pool=None):
+    ''' Build a BeerHawkProduct from a downloaded product page, in
+        the given process pool if there is one.
+    '''
+    if pool:
+        loop = asyncio.get_running_loop()
+        with metrics.timed('beerhawk'):
+            beer = await loop.run_in_executor(
+                pool, BeerHawkProduct, product, beer_page)
+        beerhawk_logger.info('PROCESSING: %s (beer: %s, brewery: %s)',
+                             beer.full_beer_name, beer.beer_name,
+                             beer.brewery)
+        return beer
+    return get_beerhawk_product(product, beer_page)
+
+
+def add_product(beer, combined_beer_info, table, journal):
+    ''' Journal the enriched beer info and queue it for the database.'''
+    journal.record(beer.beer_link, 'enriched', combined_beer_info)
+    logger.info('ADDING: %s to database table', beer.full_beer_name)
+    table.buffer(combined_beer_info)
+
+
+def scrape_product(product, table, journal):
+    ''' Scrape, enrich and queue a single beerhawk product.'''
+    if resume_product(product, table, journal):
+        return
+    beer = parse_product(product, table, journal)
+    if beer:
+        combined_beer_info = scrape_all_databases(beer)
+        add_product(beer, combined_beer_info, table, journal)
+
+
+def open_journaled_table(resume=False, journal_path=JOURNAL_PATH):
+    ''' Open the database table and a run journal which records
+        rows as written once they are committed.
+    '''
+    table = open_database_table()
+    table.load_index('full_beer_name')
+    journal = RunJournal(journal_path, resume=resume)
+    table.write_hooks.append(journal.record_written)
+    return table, journal
+
+
+def scrape_all_products_info(resume=False, journal_path=JOURNAL_PATH):
     ''' Scrape all beer hawk products information from
         beerhawk, brewerydb & ratebeer and insert it into
         a MySQL database tabel.
     '''
     intiate_logger()
-    table = open_database_table()
-    for product in get_all_beerhawk_products():
+    table, journal = open_journaled_table(resume, journal_path)
+    try:
+        for product in get_all_beerhawk_products():
+            try:
+                scrape_product(product, table, journal)
+            except custom_exceptions.NonBeerProduct as e:
+                logger.warning(
+                    'SKIPPING: detected non-beer product %s', e.product)
+                journal.record(product.link, 'skipped')
+                # logging.exception('message')
+                continue
+            except custom_exceptions.OfflineCacheMiss as e:
+                logger.warning('SKIPPING: %s', e.msg)
+                continue
+    finally:
+        # write rows still queued, even after an unexpected error
+        table.flush()
+        journal.close()
+
+
+def in_writer(writer, func, *args):
+    ''' Run func in the single writer thread, so database commits and
+        journal fsyncs don't stall the event loop, in the order asked.
+    '''
+    return asyncio.get_running_loop().run_in_executor(writer, func, *args)
+
+
+async def scrape_product_async(product, fetcher, table, journal, writer,
+                               pool=None):
+    ''' Scrape a beerhawk product, enrich it from BreweryDB and RateBeer
+        concurrently and insert it into the database table, writing to
+        the table and journal in the writer thread.
+    '''
+    try:
+        if await in_writer(writer, resume_product, product, table, journal):
+            return
+        beer = None
+        if journal.stage(product.link) != 'parsed':
+            beer_page = await fetcher.get_text(BEERHAWK_URL + product.link)
+            beer = await parse_beer_page(product, beer_page, pool)
+        beer = await in_writer(writer, parse_product, product, table,
+                               journal, beer)
+        if not beer:
+            return
+        brewerydb_info, ratebeer_info = await asyncio.gather(
+            fetcher.run_blocking('api.brewerydb.com', scrape_brewerydb,
+                                 beer.beer_name, beer.brewery),
+            fetcher.run_blocking('www.ratebeer.com', scrape_ratebeer,
+                                 beer.full_beer_name))
+        combined_beer_info = combine_beer_info(
+            beer, brewerydb_info, ratebeer_info)
+        await in_writer(writer, add_product, beer, combined_beer_info,
+                        table, journal)
+    except custom_exceptions.NonBeerProduct as e:
+        logger.warning('SKIPPING: detected non-beer product %s', e.product)
+        await in_writer(writer, journal.record, product.link, 'skipped')
+    except custom_exceptions.OfflineCacheMiss as e:
+        logger.warning('SKIPPING: %s', e.msg)
+    except Exception:
+        logger.exception('FAILED: %s', product.link)
+
+
+async def _product_worker(products, lock, fetcher, table, journal, writer,
+                          pool):
+    ''' Consume products from a shared iterator until it is exhausted.'''
+    loop = asyncio.get_running_loop()
+    while True:
+        # the listing is parsed, and waited for, off the event loop,
+        # by one worker at a time
+        async with lock:
+            product = await loop.run_in_executor(None, next, products, None)
+        if product is None:
+            break
+        await scrape_product_async(product, fetcher, table, journal, writer,
+                                   pool)
+
+
+async def scrape_all_products_info_async(concurrency=10, resume=False,
+                                         journal_path=JOURNAL_PATH,
+                                         parse_workers=None):
+    ''' Asynchronous version of scrape_all_products_info which
+        processes up to the given number of products at once,
+        optionally parsing product pages in parse_workers processes.
+    '''
+    intiate_logger()
+    table, journal = open_journaled_table(resume, journal_path)
+    products = iter(get_all_beerhawk_products())
+    pool = ProcessPoolExecutor(parse_workers) if parse_workers else None
+    # one thread owns the table's row buffer and writes the journal
+    writer = ThreadPoolExecutor(1, thread_name_prefix='writer')
+    lock = asyncio.Lock()
+    # each product may run its BreweryDB and RateBeer scrapes at once
+    async with AsyncFetcher(max_workers=concurrency * 2) as fetcher:
+        workers = [_product_worker(products, lock, fetcher, table, journal,
+                                   writer, pool)
+                   for _ in range(concurrency)]
         try:
-            beer = get_beerhawk_product(product)
-            exists = table.exists('full_beer_name', beer.full_beer_name)
-            if not exists:
-                combined_beer_info = scrape_all_databases(beer)
-                logging.info('ADDING: {} to database table'.format(
-                    beer.full_beer_name))
-                command = table.dict2cmd(combined_beer_info)
-                table.cmd(command)
-            else:
-                msg = 'SKIPPING: {} already present in the database'
-                logging.info(msg.format(beer.full_beer_name))
+            await asyncio.gather(*workers)
+        finally:
+            # write rows still queued, after the writes already asked for
+            await in_writer(writer, table.flush)
+            writer.shutdown()
+            journal.close()
+            if pool:
+                pool.shutdown()
+
+
+# worker threads of each stage of scrape_all_products_pipeline, the write
+# stage always has one as it owns the database table's row buffer
+PIPELINE_WORKERS = collections.OrderedDict([
+    ('parse', 4), ('brewerydb', 4), ('ratebeer', 1), ('clean', 2),
+    ('write', 1)])
+
+
+def parse_stage_workers(values):
+    ''' Parse STAGE=WORKERS strings into {stage: workers}.'''
+    stages = [x for x in PIPELINE_WORKERS if x != 'write']
+    workers = {}
+    for value in values or []:
+        stage, _, count = value.partition('=')
+        if stage not in stages:
+            raise custom_exceptions.InvalidChoice(stage, stages)
+        workers[stage] = int(count)
+    return workers
+
+
+class PipelineProduct(object):
+    ''' A product passed between the stages of the scrape pipeline.'''
+
+    def __init__(self, link, beer=None, row=None):
+        self.link = link
+        self.beer = beer
+        self.brewerydb_info = {}
+        self.ratebeer_info = {}
+        # the database row, once the product has been enriched
+        self.row = row
+
+    def __repr__(self):
+        return self.link
+
+
+def pipeline_stages(table, journal, workers=None, queue_size=None):
+    ''' Return the Stages scraping listed products into the table:
+        parse, brewerydb, ratebeer, clean and write, run by the number
+        of threads given in workers, merged with PIPELINE_WORKERS.
+    '''
+    workers = {**PIPELINE_WORKERS, **(workers or {}), 'write': 1}
+    # names of beers in the pipeline, so a beer listed under two
+    # links isn't scraped twice before its row reaches the table
+    in_flight = set()
+    lock = threading.Lock()
+
+    def parse(product):
+        if journal.finished(product.link):
+            logger.info('SKIPPING: %s finished in a previous run',
+                        product.link)
+            return None
+        if journal.stage(product.link) == 'enriched':
+            logger.info('RESUMING: adding enriched %s to database table',
+                        product.link)
+            return PipelineProduct(product.link,
+                                   row=journal.data(product.link))
+        try:
+            beer = parse_product(product, table, journal)
         except custom_exceptions.NonBeerProduct as e:
-            logging.warning(
-                'SKIPPING: detected non-beer product {}'.format(e.product))
-            # logging.exception('message')
-            continue
+            logger.warning('SKIPPING: detected non-beer product %s',
+                           e.product)
+            journal.record(product.link, 'skipped')
+            return None
+        except custom_exceptions.OfflineCacheMiss as e:
+            logger.warning('SKIPPING: %s', e.msg)
+            return None
+        if not beer:
+            return None
+        with lock:
+            name = beer.full_beer_name.strip().lower()
+            if name in in_flight:
+                logger.info('SKIPPING: %s already being scraped',
+                            beer.full_beer_name)
+                journal.record(product.link, 'skipped')
+                return None
+            in_flight.add(name)
+        return PipelineProduct(product.link, beer)
+
+    def enrich_brewerydb(item):
+        if item.beer:
+            item.brewerydb_info = scrape_brewerydb(item.beer.beer_name,
+                                                   item.beer.brewery)
+        return item
+
+    def enrich_ratebeer(item):
+        if item.beer:
+            item.ratebeer_info = scrape_ratebeer(item.beer.full_beer_name)
+        return item
+
+    def clean(item):
+        if item.row is None:
+            item.row = combine_beer_info(item.beer, item.brewerydb_info,
+                                         item.ratebeer_info)
+            journal.record(item.link, 'enriched', item.row)
+        return item
+
+    def write(item):
+        logger.info('ADDING: %s to database table',
+                    item.row['full_beer_name'])
+        # rows resumed from the journal, with no parsed beer, may have
+        # been committed before their 'written' entry was journaled
+        table.buffer(item.row, upsert=item.beer is None)
+
+    funcs = collections.OrderedDict([
+        ('parse', parse), ('brewerydb', enrich_brewerydb),
+        ('ratebeer', enrich_ratebeer), ('clean', clean), ('write', write)])
+    return [Stage(name, func, workers[name], queue_size)
+            for name, func in funcs.items()]
+
+
+def scrape_all_products_pipeline(workers=None, queue_size=None,
+                                 resume=False, journal_path=JOURNAL_PATH):
+    ''' Threaded version of scrape_all_products_info which passes
+        products through a pipeline of stages, each with its own
+        workers, so parsing, BreweryDB, RateBeer and database writes
+        all progress at once at the pace of the slowest.
+    '''
+    intiate_logger()
+    table, journal = open_journaled_table(resume, journal_path)
+    pipeline = Pipeline(pipeline_stages(table, journal, workers, queue_size))
+    try:
+        pipeline.run(get_all_beerhawk_products())
+    finally:
+        table.flush()
+        journal.close()
+
+
+def open_work_queue(lease_seconds=300, worker_id=None):
+    ''' Open the product work queue, on its own connection to the
+        beers database, creating the queue table if missing.
+    '''
+    queue = WorkQueue(database_creation.connect(database_creation.DATABASE),
+                      lease_seconds=lease_seconds, worker_id=worker_id)
+    queue.create()
+    return queue
+
+
+def coordinate_queue():
+    ''' Queue every listed beerhawk product for scrape workers.'''
+    intiate_logger()
+    # creates the beers database if it doesn't exist yet
+    open_database_table().close()
+    queue = open_work_queue()
+    try:
+        offered = queue.enqueue((x.link, x._asdict())
+                                for x in get_all_beerhawk_products())
+        logger.info('QUEUED: %s listed products, queue holds %s',
+                    offered, queue.counts())
+    finally:
+        queue.close()
+
+
+def scrape_queued_product(product, table, queue):
+    ''' Scrape, enrich and queue a claimed product for the database.'''
+    beer = get_beerhawk_product(product)
+    if table.exists('full_beer_name', beer.full_beer_name):
+        logger.info('SKIPPING: %s already present in the database',
+                    beer.full_beer_name)
+        queue.complete(product.link, 'skipped')
+        return
+    logger.info('ADDING: %s to database table', beer.full_beer_name)
+    # another node may add the same beer from a different link
+    table.buffer(scrape_all_databases(beer), upsert=True)
+
+
+def scrape_queue_worker(batch_size=10, lease_seconds=300, worker_id=None,
+                        poll_seconds=30):
+    ''' Scrape products claimed from the work queue, in batches of
+        batch_size, until no product is left pending or claimed.
+        Any number of workers, on any node, can run at once.
+    '''
+    intiate_logger()
+    table = open_database_table()
+    queue = open_work_queue(lease_seconds, worker_id)
+    # products are only finished once their rows are committed
+    table.write_hooks.append(queue.complete_rows)
+    try:
+        with queue.heartbeat():
+            try:
+                while True:
+                    claimed = queue.claim(batch_size)
+                    if not claimed:
+                        if not queue.remaining():
+                            break
+                        # wait for other workers, or their leases to expire
+                        time.sleep(poll_seconds)
+                        continue
+                    for link, payload in claimed:
+                        try:
+                            scrape_queued_product(ListingProduct(**payload),
+                                                  table, queue)
+                        except custom_exceptions.NonBeerProduct as e:
+                            logger.warning(
+                                'SKIPPING: detected non-beer product %s',
+                                e.product)
+                            queue.complete(link, 'skipped')
+                        except custom_exceptions.OfflineCacheMiss as e:
+                            logger.warning('SKIPPING: %s', e.msg)
+                            queue.fail(link, e.msg)
+                        except Exception as e:
+                            logger.exception('FAILED: %s', link)
+                            queue.fail(link, e)
+                    table.flush()
+                    # products whose rows failed to be written
+                    for link in list(queue.claimed):
+                        queue.fail(link, 'row was not written')
+            finally:
+                # commit rows so their products aren't released
+                table.flush()
+        logger.info('Work queue finished: %s', queue.counts())
+    finally:
+        table.close()
+        queue.close()
 
 
 if __name__ == '__main__':
@@ -150,8 +746,120 @@ if __name__ == '__main__':
         description='Scrape all beers and meatadata from beerhawk, brewerydb and ratebeer')
     parser.add_argument('--brewerydb', '-b',
                         help='update brewerydb information in the database', action='store_true')
+    parser.add_argument('--concurrency', '-c', type=int,
+                        help='number of products to scrape at once using asyncio')
+    parser.add_argument('--parse-workers', type=int,
+                        help='with --concurrency, processes used to parse product pages')
+    parser.add_argument('--pipeline', '-p', action='store_true',
+                        help='scrape through a threaded pipeline of stages')
+    parser.add_argument('--stage-workers', action='append', metavar='STAGE=WORKERS',
+                        help='with --pipeline, threads of one of the stages {}, may be repeated'.format(
+                            ', '.join(x for x in PIPELINE_WORKERS if x != 'write')))
+    parser.add_argument('--queue-size', type=int,
+                        help='with --pipeline, products waiting before each stage')
+    parser.add_argument('--coordinator', action='store_true',
+                        help='queue every listed product for --worker processes')
+    parser.add_argument('--worker', action='store_true',
+                        help='scrape products from the queue filled by --coordinator')
+    parser.add_argument('--batch-size', type=int, default=10,
+                        help='with --worker, products claimed at a time')
+    parser.add_argument('--lease', type=int, default=300,
+                        help='with --worker, seconds a claim lasts without a heartbeat')
+    parser.add_argument('--worker-id',
+                        help='with --worker, name recorded against claims')
+    parser.add_argument('--ratebeer-eager', action='store_true',
+                        help='fetch every RateBeer search result before matching')
+    parser.add_argument('--backend', choices=database_creation.BACKENDS,
+                        help='store beers in a mySQL server or a SQLite file')
+    parser.add_argument('--database',
+                        help='database name, or SQLite file, to store beers in')
+    parser.add_argument('--cache-dir',
+                        help='directory to cache HTTP responses in')
+    parser.add_argument('--offline', action='store_true',
+                        help='only use responses stored in the cache')
+    parser.add_argument('--catalog-cache',
+                        help='JSON file to persist BreweryDB brewery catalogs in')
+    parser.add_argument('--brewery-directory', metavar='PATH',
+                        help='JSON file to persist the prefetched BreweryDB brewery directory in')
+    parser.add_argument('--rate-limit', action='append', metavar='HOST=RATE',
+                        help='most requests per second sent to a host, may be repeated')
+    parser.add_argument('--refresh', '-r', action='store_true',
+                        help='only re-scrape products which changed on beerhawk')
+    parser.add_argument('--incremental', '-i', action='store_true',
+                        help='with --brewerydb, only refresh stale rows')
+    parser.add_argument('--max-age', type=int, default=30,
+                        help='days before BreweryDB info is considered stale')
+    parser.add_argument('--metrics-file',
+                        help='path prefix to periodically write metrics .json and .prom files to')
+    parser.add_argument('--metrics-interval', type=int, default=60,
+                        help='seconds between metrics summaries')
+    parser.add_argument('--metrics-port', type=int,
+                        help='serve Prometheus metrics on this port')
+    parser.add_argument('--log-file', default=log_config.LOG_PATH,
+                        help='file to log to, rotated once it reaches --log-max-mb')
+    parser.add_argument('--log-max-mb', type=int, default=10,
+                        help='size in MB at which the log file is rotated')
+    parser.add_argument('--log-level', default='INFO',
+                        help='logging level, e.g. DEBUG, INFO or WARNING')
+    parser.add_argument('--log-stage', action='append', metavar='STAGE=LEVEL',
+                        help='logging level of one of the stages {}, may be repeated'.format(
+                            ', '.join(log_config.STAGES)))
+    parser.add_argument('--log-json', action='store_true',
+                        help='write the log file as JSON lines')
+    parser.add_argument('--resume', action='store_true',
+                        help='continue the run recorded in the journal')
+    parser.add_argument('--journal', default=JOURNAL_PATH,
+                        help='file recording the progress of each product')
     args = vars(parser.parse_args())
-    if args['brewerydb']:
-        update_brewerydb()
-    else:
-        scrape_all_products_info()
+    intiate_logger(path=args['log_file'], level=args['log_level'].upper(),
+                   stage_levels=log_config.parse_stage_levels(
+                       args['log_stage']),
+                   json_lines=args['log_json'],
+                   max_bytes=args['log_max_mb'] * 1024 * 1024)
+    if args['ratebeer_eager']:
+        rate_beer.LAZY_FETCH = False
+    if args['backend']:
+        database_creation.BACKEND = args['backend']
+    if args['database']:
+        database_creation.DATABASE = args['database']
+    if args['rate_limit']:
+        rate_limiter.configure_limiter(
+            rate_limiter.parse_rate_limits(args['rate_limit']))
+    if args['catalog_cache']:
+        brewerydb.configure_catalog_cache(args['catalog_cache'])
+    if args['cache_dir'] or args['offline']:
+        http_cache.configure_cache(
+            args['cache_dir'] or http_cache.DEFAULT_CACHE_DIR,
+            offline=args['offline'])
+    if args['brewery_directory']:
+        # prefetched after the cache is configured so pages are cached
+        brewerydb.configure_brewery_directory(args['brewery_directory'])
+    exporter = metrics.MetricsExporter(args['metrics_file'],
+                                       args['metrics_interval'])
+    exporter.start()
+    if args['metrics_port']:
+        metrics.serve_metrics(args['metrics_port'])
+    try:
+        if args['coordinator']:
+            coordinate_queue()
+        elif args['worker']:
+            scrape_queue_worker(args['batch_size'], args['lease'],
+                                args['worker_id'])
+        elif args['refresh']:
+            refresh_beerhawk_products()
+        elif args['brewerydb'] and args['incremental']:
+            update_brewerydb_incremental(args['max_age'])
+        elif args['brewerydb']:
+            update_brewerydb()
+        elif args['pipeline']:
+            scrape_all_products_pipeline(
+                parse_stage_workers(args['stage_workers']),
+                args['queue_size'], args['resume'], args['journal'])
+        elif args['concurrency']:
+            asyncio.run(scrape_all_products_info_async(
+                args['concurrency'], args['resume'], args['journal'],
+                args['parse_workers']))
+        else:
+            scrape_all_products_info(args['resume'], args['journal'])
+    finally:
+        exporter.stop()
@@ -0,0 +1,117 @@
+''' Asynchronous HTTP client used to scrape many products at once.'''
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+import scrapers.rate_limiter as rate_limiter
+import scrapers.http_cache as http_cache
+import custom_exceptions
+import metrics
+import asyncio
+import aiohttp
+import json
+import time
+
+# maximum number of blocking scrapers run at once for each host,
+# the requests they and download_text send are paced by rate_limiter
+HOST_LIMITS = {'www.beerhawk.co.uk': 4,
+               'api.brewerydb.com': 4,
+               'www.ratebeer.com': 1}
+DEFAULT_HOST_LIMIT = 2
+
+
+class AsyncFetcher(object):
+    ''' Fetch pages asynchronously whilst keeping each host within
+        its politeness limits.
+
+    Parameters:
+        host_limits: dict of host: max concurrent blocking scrapers,
+                     merged with HOST_LIMITS
+        default_limit: max concurrent blocking scrapers for unlisted
+                       hosts
+        timeout: total seconds allowed per request
+        max_workers: threads used to run blocking scrapers
+
+    Example:
+        async with AsyncFetcher() as fetcher:
+            html = await fetcher.get_text('https://www.beerhawk.co.uk')
+            info = await fetcher.run_blocking('www.ratebeer.com',
+                                              get_info_dict, query, 'beers')
+    '''
+
+    def __init__(self, host_limits=None, default_limit=DEFAULT_HOST_LIMIT,
+                 timeout=60, max_workers=None):
+        self.host_limits = {**HOST_LIMITS, **(host_limits or {})}
+        self.default_limit = default_limit
+        self.timeout = aiohttp.ClientTimeout(total=timeout)
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.semaphores = {}
+        self.session = None
+
+    async def __aenter__(self):
+        self.session = aiohttp.ClientSession(timeout=self.timeout)
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.session.close()
+        self.executor.shutdown(wait=False)
+
+    def host_semaphore(self, host):
+        ''' Return the semaphore limiting requests to a given host.'''
+        host = urlparse(host).netloc or host
+        if host not in self.semaphores:
+            limit = self.host_limits.get(host, self.default_limit)
+            self.semaphores[host] = asyncio.Semaphore(limit)
+        return self.semaphores[host]
+
+    async def download_text(self, link, throttle_retries=3):
+        ''' Download the url text from a given link, paced by the
+            host's rate limiter.
+        '''
+        limiter = rate_limiter.LIMITER.host(link)
+        for attempt in range(throttle_retries + 1):
+            await limiter.acquire_async()
+            slot = rate_limiter.Slot(limiter)
+            try:
+                async with self.session.get(link) as resp:
+                    metrics.observe_http(link, resp.status,
+                                         time.perf_counter() - slot.start)
+                    slot.record(resp.status, resp.headers)
+                    if resp.status in rate_limiter.THROTTLE_STATUSES and \
+                            attempt < throttle_retries:
+                        continue
+                    resp.raise_for_status()
+                    return await resp.text()
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+                slot.error = True
+                raise
+            finally:
+                slot.release()
+
+    async def get_text(self, link):
+        ''' Return the url text from the response cache, downloading
+            it if missing or expired.
+        '''
+        cache = http_cache.CACHE
+        text = cache.get(link) if cache else None
+        if cache:
+            metrics.observe_cache(link, text is not None)
+        if text is None:
+            if cache and cache.offline:
+                raise custom_exceptions.OfflineCacheMiss(
+                    http_cache.cache_key(link))
+            text = await self.download_text(link)
+            if cache:
+                cache.set(link, text)
+        return text
+
+    async def get_json(self, link):
+        ''' Return the json data from a given link.'''
+        text = await self.get_text(link)
+        return json.loads(text)
+
+    async def run_blocking(self, host, func, *args):
+        ''' Run a blocking scraper function in a worker thread whilst
+            holding the given host's concurrency slot.
+        '''
+        loop = asyncio.get_running_loop()
+        async with self.host_semaphore(host):
+            return await loop.run_in_executor(self.executor, func, *args)
@@ -1,49 +1,148 @@
 ''' Classes used to scrape beer product information from BeerHawk website.'''
+from collections import namedtuple
 from string import digits
+from lxml import etree
+import scrapers.http_cache as http_cache
 import custom_exceptions
-import requests
+import itertools
+import hashlib
+import json
 import bs4
+import re
+
+BEERHAWK_URL = 'https://www.beerhawk.co.uk'
+LISTING_URL = BEERHAWK_URL + '/browse-beers?perPage=All'
+PRODUCT_ID = re.compile('product.*')
+SPEC_TABLE = re.compile(
+    r'<table[^>]*id=["\']product-attribute-specs-table["\'].*?</table>',
+    re.DOTALL | re.IGNORECASE)
+
+# lightweight record of a product div on the browse-beers page
+ListingProduct = namedtuple('ListingProduct',
+                            ['link', 'sku', 'brand', 'rating', 'price'])
+
+
+def _has_class(elem, name):
+    ''' Check whether an lxml element has the given HTML class.'''
+    return name in (elem.get('class') or '').split()
+
+
+def _listing_price(anchor):
+    ''' Extract the price from a product anchor element.'''
+    spans = [x for x in anchor.iter('span') if _has_class(x, 'regular-price')]
+    if not spans:
+        spans = [x for x in anchor.iter('span') if _has_class(x, 'old-price')]
+    if spans:
+        price = ''.join(spans[0].itertext()).replace('\n', '')
+        return float(price.replace("£", ''))
+
+
+def listing_product(div):
+    ''' Convert a product div lxml element to a ListingProduct.'''
+    anchor = next(div.iter('a'), None)
+    if anchor is None:
+        return None
+    return ListingProduct(link=anchor.get('href'),
+                          sku=anchor.get('data-sku'),
+                          brand=anchor.get('data-brand'),
+                          rating=anchor.get('data-rating'),
+                          price=_listing_price(anchor))
+
+
+def iter_listing_products(chunks):
+    ''' Incrementally parse chunks of the browse-beers page HTML and
+        yield a ListingProduct as soon as each product div is closed.
+        Parsed elements are discarded so memory use stays flat.
+    '''
+    parser = etree.HTMLPullParser(events=('start', 'end'))
+    product = None
+    for chunk in itertools.chain(chunks, [None]):
+        if chunk is None:
+            parser.close()
+        else:
+            parser.feed(chunk)
+        for event, elem in parser.read_events():
+            if event == 'start':
+                if product is None and elem.tag == 'div' and \
+                        PRODUCT_ID.search(elem.get('id') or ''):
+                    product = elem
+                continue
+            if elem is product:
+                record = listing_product(elem)
+                product = None
+                if record:
+                    yield record
+            if product is None:
+                elem.clear()
+                # drop already processed siblings from the tree
+                parent = elem.getparent()
+                while parent is not None and elem.getprevious() is not None:
+                    del parent[0]
+
+
+def page_specs(beer_page):
+    ''' Return the spec table of a product page's HTML text as a dict
+        {col: row}, parsing only the table, or None if there isn't one.
+    '''
+    match = SPEC_TABLE.search(beer_page)
+    if not match:
+        return None
+    table = etree.fromstring(match.group(0), etree.HTMLParser())
+    body = next(table.iter('tbody'), None)
+    specs = {}
+    # read the same cells as BeerHawkProduct.table2dict
+    for row in body.iter('tr') if body is not None else []:
+        col = next(row.iter('th'), None)
+        data = [x for x in row.iter('td') if _has_class(x, 'data')]
+        if col is not None and data:
+            specs[''.join(col.itertext())] = ''.join(data[0].itertext())
+    return specs
+
+
+def product_hash(product, specs):
+    ''' Return a hash of a ListingProduct and its spec table dict, used
+        to detect products which changed since they were scraped.
+    '''
+    dumped = json.dumps({'listing': product._asdict(), 'specs': specs},
+                        sort_keys=True, default=str)
+    return hashlib.sha1(dumped.encode('utf-8')).hexdigest()
 
 
 class BeerHawkProduct(object):
     ''' Container for beer product details scrapped from beer hawk.
 
     Parameters:
-        product: div element (id=product*) from beerhawk browse-beer page
+        product: ListingProduct from the beerhawk browse-beer page
+        beer_page: HTML text of the product sublink page, downloaded
+                   if not given
     '''
 
-    def __init__(self, product):
-        self.beer_hawk = 'https://www.beerhawk.co.uk'
-        self.product = product.find('a')
-        self.price = self._get_beer_price()
-        self.brand_category = self.product.get('data-brand')
-        self.customer_rating = self.product.get('data-rating')
-        self.sku = self.product.get('data-sku')
-        self.beer_link = self.product.get('href')
+    def __init__(self, product, beer_page=None):
+        self.beer_hawk = BEERHAWK_URL
+        self.price = product.price
+        self.brand_category = product.brand
+        self.customer_rating = product.rating
+        self.sku = product.sku
+        self.beer_link = product.link
         self.brewery = self._get_brewery_name()
         self.beer_name = self._get_beer_name()
-        self.dict = self.extract_beer_specs()
+        self.dict = self.extract_beer_specs(beer_page)
         self.abv = self._abv(self.dict.get('ABV'))
         self.bottle_size = self._volume_corrector(self.dict.get('Bottle Size'))
         self.country_origin = self.dict.get('Country')
         self.serving_temp = self.dict.get('Serving Temp')
         self.beer_style = self.dict.get('Style')
         self.full_beer_name = '{} {}'.format(self.brewery, self.beer_name)
+        self.beerhawk_hash = product_hash(product, self.dict)
         # Attributes no longer needed are deleted
         del self.dict
-        del self.product
-
-    def _get_beer_price(self):
-        # print(self.product)
-        price_span = self.product.find('span', {'class': 'regular-price'})
-        if not price_span:
-            price_span = self.product.find('span', {'class': 'old-price'})
-        if price_span:
-            price = price_span.text.replace('\n', '')
-            price = float(price.replace("£", ''))
-        else:
-            price = None
-        return price
+
+    @classmethod
+    def from_dict(cls, dictionary):
+        ''' Rebuild a product from the __dict__ of a parsed product.'''
+        beer = cls.__new__(cls)
+        beer.__dict__.update(dictionary)
+        return beer
 
     def _get_brewery_name(self):
         beer_split = self.beer_link.replace(
@@ -89,9 +188,12 @@ class BeerHawkProduct(object):
             d[col_text] = row_text
         return d
 
-    def extract_beer_specs(self):
+    def extract_beer_specs(self, beer_page=None):
         ''' Extract beer specs from the given product sublink HTML table.'''
-        beer_page = self.get_url_text(self.beer_hawk + self.beer_link)
+        if beer_page is None:
+            beer_page = self.get_url_text(self.beer_hawk + self.beer_link)
+        elif isinstance(beer_page, str):
+            beer_page = bs4.BeautifulSoup(beer_page, features='lxml')
         if 'gift' in beer_page.find('title').text.lower():
             raise custom_exceptions.NonBeerProduct(self.beer_link)
         try:
@@ -109,7 +211,6 @@ class BeerHawkProduct(object):
     @staticmethod
     def get_url_text(link):
         ''' Download the url text from a given link.'''
-        req = requests.get(link)
-        req.raise_for_status()
-        url = bs4.BeautifulSoup(req.text, features='lxml')
+        text = http_cache.get_text(link)
+        url = bs4.BeautifulSoup(text, features='lxml')
         return url
@@ -1,35 +1,388 @@
 ''' Scrapers functions to extract information from the BreweryDB.'''
-from fuzzywuzzy import fuzz
+from scrapers.fuzzy_matcher import FuzzyMatcher, token_sort_process
+from scrapers.http_client import get_client
+from scrapers.key_pool import KeyPool
+import scrapers.http_cache as http_cache
 import scrapers.APIkeys
+import custom_exceptions
+import metrics
+import threading
 import logging
+import atexit
 import requests
 import json
+import time
+import os
 
 # Below example gets all beer from Edinburgh, Scotland.
 # r = 'locations?region=Scotland&locality=edinburgh'
 # brewaries = get_data_request(r, key).get('data')
 
+logger = logging.getLogger('beerscraper.brewerydb')
 KEYS = scrapers.APIkeys.keys.get('BreweryDB')
+KEY_POOL = KeyPool(len(KEYS), name='BreweryDB')
+BREWERYDB_URL = 'https://api.brewerydb.com/v2/'
+# words dropped from brewery names to give the core key they are matched on
+BREWERY_WORDS = {'the', 'brewery', 'breweries', 'brewing', 'brewers',
+                 'brewhouse', 'brewco', 'company', 'co', 'ltd', 'limited',
+                 'inc', 'llc', 'beer', 'beers', 'craft'}
+# words in the error message of a refused request whose key is used up
+QUOTA_WORDS = ('limit', 'exceeded', 'quota')
+
+
+class BreweryCatalogCache(object):
+    ''' Memoize the beer catalog of each brewery so it is requested
+        at most once per run, optionally persisting it between runs.
+
+        Fetches which find no catalog, returning None, or fail, raising
+        BreweryDBUnavailable, are only remembered in memory for
+        failure_ttl so a temporary error or a used up API quota doesn't
+        blank the brewery for the full ttl. A remembered failure is
+        raised again.
+
+    Parameters:
+        path: JSON file the catalogs are persisted to
+        ttl: seconds before a persisted catalog is requested again
+        failure_ttl: seconds before a failed fetch is tried again
+        save_every: fetched catalogs between writes of the JSON file,
+                    which is also written by save() at exit
+
+    Example:
+        cache = BreweryCatalogCache('catalogs.json')
+        beers = cache.get('Brewdog', fetch_brewery_beers)
+    '''
+
+    def __init__(self, path=None, ttl=7 * 24 * 60 * 60, failure_ttl=5 * 60,
+                 save_every=20):
+        self.path = path
+        self.ttl = ttl
+        self.failure_ttl = failure_ttl
+        self.save_every = save_every
+        # brewery: [time fetched, list of beer JSON]
+        self.catalogs = {}
+        # brewery: (time of its last failed fetch, exception raised by
+        # it or None), never persisted
+        self.failures = {}
+        # catalogs fetched since the JSON file was last written
+        self.unsaved = 0
+        self.lock = threading.Lock()
+        # held while writing the JSON file
+        self.save_lock = threading.Lock()
+        self.brewery_locks = {}
+        if path and os.path.exists(path):
+            with open(path) as f:
+                # files from older versions may hold failed fetches
+                self.catalogs = {k: i for k, i in json.load(f).items()
+                                 if i[1] is not None}
+
+    def _brewery_lock(self, brewery):
+        ''' Lock ensuring concurrent lookups fetch a brewery only once.'''
+        with self.lock:
+            return self.brewery_locks.setdefault(brewery, threading.Lock())
+
+    def get(self, brewery, fetch):
+        ''' Return the catalog of a brewery, calling fetch(brewery)
+            if it is not cached or has expired.
+        '''
+        if not brewery:
+            return None
+        key = brewery.lower()
+        with self._brewery_lock(key):
+            now = time.time()
+            with self.lock:
+                entry = self.catalogs.get(key)
+                failed = self.failures.get(key)
+            if entry and now - entry[0] <= self.ttl:
+                return entry[1]
+            if failed and now - failed[0] <= self.failure_ttl:
+                if failed[1]:
+                    raise custom_exceptions.BreweryDBUnavailable(
+                        failed[1].request, failed[1].msg)
+                return None
+            try:
+                beers = fetch(brewery)
+            except custom_exceptions.BreweryDBUnavailable as e:
+                with self.lock:
+                    self.failures[key] = (time.time(), e)
+                raise
+            with self.lock:
+                if beers is None:
+                    self.failures[key] = (time.time(), None)
+                    return None
+                self.failures.pop(key, None)
+                self.catalogs[key] = [time.time(), beers]
+                self.unsaved += 1
+                save = self.unsaved >= self.save_every
+            if save:
+                self.save()
+            return beers
+
+    def save(self):
+        ''' Write the catalogs to the JSON file if one was given.'''
+        if not self.path:
+            return
+        with self.save_lock:
+            with self.lock:
+                if not self.unsaved and os.path.exists(self.path):
+                    return
+                catalogs = dict(self.catalogs)
+                self.unsaved = 0
+            # the snapshot is written outside self.lock so lookups
+            # can continue
+            tmp = '{}.tmp'.format(self.path)
+            with open(tmp, 'w') as f:
+                json.dump(catalogs, f)
+            os.replace(tmp, self.path)
+
+
+CATALOG_CACHE = BreweryCatalogCache()
+# brewery: (catalog, FuzzyMatcher of its beer names)
+_MATCHERS = {}
+
+
+def configure_catalog_cache(path=None, ttl=7 * 24 * 60 * 60):
+    ''' Replace the brewery catalog cache with one persisted to path.'''
+    global CATALOG_CACHE
+    CATALOG_CACHE = BreweryCatalogCache(path, ttl)
+    # write catalogs fetched since the last periodic save
+    atexit.register(CATALOG_CACHE.save)
+    return CATALOG_CACHE
+
+
+def brewery_keys(name):
+    ''' Return the normalised keys a brewery name is indexed under:
+        its lower cased alphanumeric tokens, and the same tokens without
+        words such as brewery or company.
+    '''
+    full = token_sort_process(name)
+    core = ' '.join(x for x in full.split() if x not in BREWERY_WORDS)
+    return [x for x in (full, core) if x]
+
+
+class BreweryDirectory(object):
+    ''' Index of every brewery in BreweryDB by normalised name, built by
+        paging through the brewery directory once and optionally
+        persisted between runs, so a brewery's id is found without
+        sending a name search per beer. Names which match no key
+        exactly are fuzzy matched against the core keys. Keys shared by
+        several breweries are left out of the index, so their names fall
+        through to the fuzzy match, or a name search by brewery_id.
+
+    Parameters:
+        path: JSON file the directory is persisted to
+        ttl: seconds before a persisted directory is fetched again
+        min_match: lowest token sort score accepted for a fuzzy match
+
+    Example:
+        directory = BreweryDirectory('breweries.json')
+        if directory.expired():
+            directory.prefetch()
+        directory.lookup('BrewDog Brewing Company')
+    '''
+
+    def __init__(self, path=None, ttl=30 * 24 * 60 * 60, min_match=90):
+        self.path = path
+        self.ttl = ttl
+        self.min_match = min_match
+        # time the directory was fetched, None until prefetched
+        self.fetched = None
+        # True if every page of the directory was fetched
+        self.complete = False
+        # normalised key: brewery id
+        self.index = {}
+        # keys shared by several breweries, which identify none of them
+        self.ambiguous = set()
+        # filled on the first fuzzy lookup: (keys, FuzzyMatcher of keys)
+        self._matcher = None
+        self.lock = threading.Lock()
+        if path and os.path.exists(path):
+            with open(path) as f:
+                saved = json.load(f)
+            self.fetched = saved['fetched']
+            self.index = saved['index']
+            # older files kept the first brewery of an ambiguous key,
+            # so are fetched again
+            self.complete = saved['complete'] and 'ambiguous' in saved
+            self.ambiguous = set(saved.get('ambiguous', []))
+
+    def __len__(self):
+        return len(set(self.index.values()))
+
+    def expired(self):
+        ''' Check whether the directory needs to be fetched.'''
+        return not self.complete or time.time() - self.fetched > self.ttl
+
+    def prefetch(self, max_pages=None):
+        ''' Request every page of the BreweryDB brewery directory,
+            or the first max_pages, and rebuild the index from them.
+            Returns the number of breweries found.
+        '''
+        index = {}
+        ambiguous = set()
+        page, pages = 1, 1
+        while page <= pages and (not max_pages or page <= max_pages):
+            result = get_data_request('breweries?p={}'.format(page))
+            if not result.get('data'):
+                logger.warning('Brewery directory page %s unavailable, '
+                               'directory incomplete', page)
+                break
+            pages = result.get('numberOfPages', 1)
+            for brewery in result['data']:
+                for name in (brewery.get('name'),
+                             brewery.get('nameShortDisplay')):
+                    for key in brewery_keys(name):
+                        if index.setdefault(key, brewery['id']) != \
+                                brewery['id']:
+                            ambiguous.add(key)
+            page += 1
+        for key in ambiguous:
+            del index[key]
+        if ambiguous:
+            logger.info('Dropped %s brewery directory keys shared by '
+                        'several breweries', len(ambiguous))
+        if not index:
+            return len(self)
+        with self.lock:
+            self.index = index
+            self.ambiguous = ambiguous
+            self.complete = page > pages
+            self.fetched = time.time()
+            self._matcher = None
+        self.save()
+        logger.info('Brewery directory holds %s breweries from %s pages',
+                    len(self), page - 1)
+        return len(self)
+
+    def is_ambiguous(self, brewery):
+        ''' Check whether a brewery name has a key shared by several
+            breweries.
+        '''
+        return any(x in self.ambiguous for x in brewery_keys(brewery))
+
+    def lookup(self, brewery):
+        ''' Return the BreweryDB id of a brewery name, or None.'''
+        keys = brewery_keys(brewery)
+        for key in keys:
+            if key in self.index:
+                return self.index[key]
+        if not keys or not self.index:
+            return None
+        with self.lock:
+            if self._matcher is None:
+                names = list(self.index)
+                self._matcher = (names, FuzzyMatcher(names, 'token_sort'))
+            names, matcher = self._matcher
+        match = matcher.best(keys[-1], self.min_match)
+        if match:
+            logger.debug('Brewery %s fuzzy matched %s', brewery,
+                         names[match[0]])
+            return self.index[names[match[0]]]
+
+    def save(self):
+        ''' Write the directory to the JSON file if one was given.'''
+        if not self.path:
+            return
+        with self.lock:
+            tmp = '{}.tmp'.format(self.path)
+            with open(tmp, 'w') as f:
+                json.dump({'fetched': self.fetched, 'complete': self.complete,
+                           'index': self.index,
+                           'ambiguous': sorted(self.ambiguous)}, f)
+            os.replace(tmp, self.path)
+
+
+DIRECTORY = BreweryDirectory()
+
+
+def configure_brewery_directory(path=None, ttl=30 * 24 * 60 * 60):
+    ''' Replace the brewery directory with one persisted to path,
+        prefetching it if it is missing, incomplete or expired.
+    '''
+    global DIRECTORY
+    DIRECTORY = BreweryDirectory(path, ttl)
+    if DIRECTORY.expired():
+        DIRECTORY.prefetch()
+    return DIRECTORY
 
 
 def get_json_data(link):
     ''' Download the json text from a given link.'''
-    req = requests.get(link)
-    req.raise_for_status()
-    data = json.loads(req.text)
+    text = http_cache.get_text(link)
+    data = json.loads(text)
     return data
 
 
-def get_data_request(request, key_num=0):
-    ''' Request something from the BreweryDB.'''
+def configure_key_pool(**kwargs):
+    ''' Replace the BreweryDB API key pool, e.g. to change its limits.'''
+    global KEY_POOL
+    KEY_POOL = KeyPool(len(KEYS), name='BreweryDB', **kwargs)
+    return KEY_POOL
+
+
+def quota_exhausted(req):
+    ''' Check whether a request refused with a 401 or 403 says its key's
+        quota is used up, by the X-Ratelimit-Remaining header or the
+        error message of the JSON body.
+    '''
+    if req.headers.get('X-Ratelimit-Remaining') == '0':
+        return True
+    try:
+        body = req.json()
+    except ValueError:
+        return False
+    message = str(body.get('errorMessage', '')) if isinstance(body, dict) \
+        else ''
+    return any(x in message.lower() for x in QUOTA_WORDS)
+
+
+def download_with_key(link):
+    ''' Download a BreweryDB link using a key from the key pool,
+        moving to another key if one is throttled or out of quota.
+    '''
+    while True:
+        key_num = KEY_POOL.acquire()
+        if key_num is None:
+            raise custom_exceptions.APIKeysExhausted('BreweryDB')
+        metrics.BREWERYDB_KEY_REQUESTS.inc(key=key_num)
+        req = get_client().get('{}&key={}'.format(link, KEYS[key_num]),
+                               keyed=True)
+        KEY_POOL.update(key_num, req.headers)
+        if req.status_code == 429:
+            retry_after = req.headers.get('Retry-After', '1')
+            KEY_POOL.block(key_num, float(retry_after)
+                           if retry_after.isdigit() else 1)
+            continue
+        if req.status_code in (401, 403) and quota_exhausted(req):
+            # other refusals, such as premium only endpoints, fail below
+            # rather than retiring every key for the day
+            KEY_POOL.block(key_num)
+            continue
+        req.raise_for_status()
+        return req.text
+
+
+def request_data(request):
+    ''' Request something from the BreweryDB, raising
+        BreweryDBUnavailable if the request fails.
+    '''
+    link = '{}{}'.format(BREWERYDB_URL, request)
     try:
-        db = 'https://api.brewerydb.com/v2/'
-        data = get_json_data('{}{}&key={}'.format(db, request, KEYS[key_num]))
-        return data
+        text = http_cache.get_text(link, download=download_with_key)
     except requests.exceptions.HTTPError as e:
-        # use another API key
-        key_num += 1
-        return get_data_request(request, key_num)
+        raise custom_exceptions.BreweryDBUnavailable(
+            request, 'BreweryDB request {} failed: {}'.format(request, e))
+    except custom_exceptions.APIKeysExhausted as e:
+        raise custom_exceptions.BreweryDBUnavailable(request, e.msg)
+    return json.loads(text)
+
+
+def get_data_request(request):
+    ''' Request something from the BreweryDB, or {} if it fails.'''
+    try:
+        return request_data(request)
+    except custom_exceptions.BreweryDBUnavailable as e:
+        logger.warning(e.msg)
+    return {}
 
 
 def get_beer_data(beer):
@@ -46,7 +399,7 @@ def get_brewery_data(brewery):
     r = 'breweries?name={}'.format(brewery)
     # only returns search result if their is an exact match
     # only premium users can use wildcards for searching
-    search_results = get_data_request(r)
+    search_results = request_data(r)
     if search_results.get('data'):
         # The index assumes only one brewery was returned from search query
         brewery_data = search_results.get('data')[0]
@@ -55,30 +408,60 @@ def get_brewery_data(brewery):
 
 def all_beers_from_brewery(brewery):
     ''' Return a list of all beers for a given brewery name.'''
+    if not brewery:
+        # rows without a brewery can't be looked up
+        return None
+    return CATALOG_CACHE.get(brewery, fetch_brewery_beers)
+
+
+def brewery_id(brewery):
+    ''' Return the BreweryDB id of a brewery name, from the prefetched
+        directory when it holds the brewery, or else a name search.
+    '''
+    found = DIRECTORY.lookup(brewery)
+    if found or (DIRECTORY.complete and not DIRECTORY.is_ambiguous(brewery)):
+        # a complete directory has every brewery a search could find,
+        # unless the name is shared by several of them
+        return found
     brewery_data = get_brewery_data(brewery)
     if brewery_data:
-        brewery_id = brewery_data.get('id')
-        r = 'brewery/{}/beers?'.format(brewery_id)
-        beers = get_data_request(r).get('data')
+        return brewery_data.get('id')
+
+
+def fetch_brewery_beers(brewery):
+    ''' Request the list of all beers for a given brewery name.'''
+    found = brewery_id(brewery)
+    if found:
+        r = 'brewery/{}/beers?'.format(found)
+        beers = request_data(r).get('data')
         return beers
 
 
+def catalog_matcher(beers, brewery):
+    ''' Return a FuzzyMatcher of the brewery corrected beer names in a
+        brewery catalog, reusing it while the catalog is unchanged.
+    '''
+    key = brewery.lower()
+    cached = _MATCHERS.get(key)
+    if cached and cached[0] is beers:
+        return cached[1]
+    names = [remove_brewery_name_from_beer(x.get('name'), brewery)
+             for x in beers]
+    matcher = FuzzyMatcher(names, scorer='token_sort')
+    _MATCHERS[key] = (beers, matcher)
+    return matcher
+
+
 def fuzzy_query_match(query, beers, brewery, min_match=75):
     ''' Find the best simple fuzzy match between a
         search query and beer name and return
         the beer name if it meets the given
         minimum partial match percentage.
     '''
-    sr = []
-    all_beer_names = [x.get('name') for x in beers]
-    for beer in all_beer_names:
-        corrected_beer = remove_brewery_name_from_beer(beer, brewery)
-        # simple ratio that doesnt care about the order of substrings
-        compare = fuzz.token_sort_ratio(query.lower(), corrected_beer)
-        sr.append(compare)
-    if max(sr) >= min_match:
-        index = sr.index(max(sr))
-        best_match = beers[index]
+    # simple ratio that doesnt care about the order of substrings
+    match = catalog_matcher(beers, brewery).best(query, min_match)
+    if match:
+        best_match = beers[match[0]]
         return best_match
 
 
@@ -119,7 +502,7 @@ def filter4data(beer_data):
     # The indexing maybe presumtious here
     beer_data = beer_data[0] if isinstance(beer_data, list) else beer_data
     beer_name = beer_data.get('name')
-    logging.info('FOUND: inspecting beer {} fro features'.format(beer_name))
+    logger.info('FOUND: inspecting beer %s fro features', beer_name)
     features = ['ibu', 'isOrganic', 'abv', 'srm']
     features1 = filter_dict(beer_data, features)
     style_features = ['abvMin', 'abvMax', 'fgMin',
@@ -134,7 +517,8 @@ def filter4data(beer_data):
 
 def get_all_beer_features(beer, brewery):
     ''' Extract all features of interest for a given beer
-        from BreweryDB and return as a dict.
+        from BreweryDB and return as a dict. Raises
+        BreweryDBUnavailable if BreweryDB couldn't be searched.
     '''
     beer_data = check_beer_in_brewery_catalog(beer, brewery)
     if beer_data:
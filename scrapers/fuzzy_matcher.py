@@ -0,0 +1,110 @@
+''' Reusable fuzzy matcher that preprocesses a set of candidate names once.'''
+from fuzzywuzzy import fuzz, utils
+from collections import Counter
+import metrics
+
+
+def token_sort_process(name):
+    ''' Lower case, strip non-alphanumerics and sort the tokens of
+        a name, as fuzz.token_sort_ratio does before comparing.
+    '''
+    tokens = utils.full_process(name or '', force_ascii=True).split()
+    return ' '.join(sorted(tokens)).strip()
+
+
+def lower_process(name):
+    ''' Lower case a name.'''
+    return (name or '').lower()
+
+
+def ratio_bound(overlap, len1, len2):
+    ''' Upper bound of fuzz.ratio given the number of characters
+        two strings have in common.
+    '''
+    return utils.intr(100 * 2 * overlap / (len1 + len2))
+
+
+def partial_ratio_bound(overlap, len1, len2):
+    ''' Upper bound of fuzz.partial_ratio given the number of
+        characters two strings have in common.
+    '''
+    overlap = min(overlap, len1, len2)
+    shorter = min(len1, len2)
+    bound = 2 * overlap / (shorter + overlap) if overlap else 0
+    return 100 if bound > .995 else utils.intr(100 * bound)
+
+
+# scorer name: (processor, scorer on processed strings, score upper bound)
+SCORERS = {'token_sort': (token_sort_process, fuzz.ratio, ratio_bound),
+           'partial': (lower_process, fuzz.partial_ratio,
+                       partial_ratio_bound)}
+
+
+class FuzzyMatcher(object):
+    ''' Find the best fuzzy match for queries against a fixed list of
+        candidate names.
+
+        Candidates are processed and indexed by their character counts
+        once. A query only scores candidates whose character overlap
+        could still beat the best score found so far, so the result is
+        identical to scoring every candidate.
+
+    Parameters:
+        names: list of candidate name strings
+        scorer: 'token_sort' (fuzz.token_sort_ratio) or
+                'partial' (fuzz.partial_ratio of lower cased names)
+
+    Example:
+        matcher = FuzzyMatcher(['Punk IPA', 'Elvis Juice'])
+        matcher.best('punk ipa', min_match=75)
+    Returns:
+        (0, 100)
+    '''
+
+    def __init__(self, names, scorer='token_sort'):
+        self.process, self.scorer, self.bound = SCORERS[scorer]
+        self.names = [self.process(x) for x in names]
+        self.index = [Counter(x) for x in self.names]
+
+    def __len__(self):
+        return len(self.names)
+
+    def _bounds(self, query):
+        ''' Return (upper bound, candidate index) for each candidate,
+            highest bound first.
+        '''
+        query_count = Counter(query)
+        bounds = []
+        for i, (name, count) in enumerate(zip(self.names, self.index)):
+            if not name or not query:
+                # empty strings are scored exactly
+                bounds.append((100, i))
+                continue
+            overlap = sum((query_count & count).values())
+            bounds.append((self.bound(overlap, len(query), len(name)), i))
+        bounds.sort(key=lambda x: (-x[0], x[1]))
+        return bounds
+
+    @metrics.timed('fuzzy_match')
+    def top(self, query, k=1, min_match=0):
+        ''' Return up to k (candidate index, score) pairs scoring at
+            least min_match, highest first and earliest first on ties.
+        '''
+        query = self.process(query)
+        found = []
+        for bound, i in self._bounds(query):
+            if bound < min_match or (len(found) >= k and
+                                     bound < found[k - 1][1]):
+                break
+            found.append((i, self.scorer(query, self.names[i])))
+            found.sort(key=lambda x: (-x[1], x[0]))
+        return [x for x in found[:k] if x[1] >= min_match]
+
+    def best(self, query, min_match=0):
+        ''' Return (candidate index, score) of the highest scoring
+            candidate, earliest first on ties, or None if the score
+            is below min_match.
+        '''
+        top = self.top(query, 1, min_match)
+        if top:
+            return top[0]
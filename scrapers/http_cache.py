@@ -0,0 +1,277 @@
+''' Persistent on-disk cache of HTTP responses shared by all scrapers.'''
+from urllib.parse import urlparse, parse_qsl, urlencode, urlunparse
+from scrapers.http_client import get_client
+import custom_exceptions
+import threading
+import tempfile
+import metrics
+import codecs
+import sqlite3
+import time
+import zlib
+import os
+
+DEFAULT_CACHE_DIR = '.http_cache'
+# seconds a cached response from each host is considered fresh
+SOURCE_TTLS = {'www.beerhawk.co.uk': 24 * 60 * 60,
+               'api.brewerydb.com': 7 * 24 * 60 * 60,
+               'www.ratebeer.com': 7 * 24 * 60 * 60}
+DEFAULT_TTL = 24 * 60 * 60
+# query parameters that should never end up in a cache key
+PRIVATE_PARAMS = ('key',)
+
+CACHE = None
+
+
+def cache_key(link):
+    ''' Return the link with private query parameters (API keys) removed.'''
+    url = urlparse(link)
+    query = [(k, i) for k, i in parse_qsl(url.query, keep_blank_values=True)
+             if k not in PRIVATE_PARAMS]
+    return urlunparse(url._replace(query=urlencode(query)))
+
+
+class ResponseCache(object):
+    ''' Size bounded LRU cache storing zlib compressed response bodies
+        in an SQLite file.
+
+    Parameters:
+        cache_dir: directory the cache file is stored in
+        ttls: dict of host: seconds a response stays fresh,
+              merged with SOURCE_TTLS
+        max_size: maximum bytes of compressed bodies kept on disk
+        offline: never touch the network, serve stale entries
+
+    Example:
+        cache = ResponseCache('.http_cache')
+        cache.set('https://www.beerhawk.co.uk', '<html>...</html>')
+        cache.get('https://www.beerhawk.co.uk')
+    '''
+
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR, ttls=None,
+                 max_size=512 * 1024 * 1024, offline=False):
+        os.makedirs(cache_dir, exist_ok=True)
+        self.ttls = {**SOURCE_TTLS, **(ttls or {})}
+        self.max_size = max_size
+        self.offline = offline
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(os.path.join(cache_dir, 'responses.db'),
+                                  check_same_thread=False)
+        self.db.execute('CREATE TABLE IF NOT EXISTS responses ('
+                        'url TEXT PRIMARY KEY, host TEXT, body BLOB, '
+                        'size INTEGER, created REAL, accessed REAL)')
+        self.db.commit()
+
+    def ttl(self, link):
+        ''' Return the number of seconds a response from link stays fresh.'''
+        return self.ttls.get(urlparse(link).netloc, DEFAULT_TTL)
+
+    def _get_body(self, link):
+        ''' Return the compressed body of link or None if absent or expired.'''
+        key = cache_key(link)
+        with self.lock:
+            row = self.db.execute(
+                'SELECT body, created FROM responses WHERE url = ?',
+                (key,)).fetchone()
+            if not row:
+                return None
+            body, created = row
+            if not self.offline and time.time() - created > self.ttl(link):
+                return None
+            self.db.execute('UPDATE responses SET accessed = ? WHERE url = ?',
+                            (time.time(), key))
+            self.db.commit()
+        return body
+
+    def get(self, link):
+        ''' Return the cached body of link or None if absent or expired.'''
+        body = self._get_body(link)
+        if body is not None:
+            return zlib.decompress(body).decode('utf-8')
+
+    def get_chunks(self, link, chunk_size=64 * 1024):
+        ''' Return a generator decompressing the cached body of link
+            in chunks, or None if absent or expired.
+        '''
+        body = self._get_body(link)
+        if body is None:
+            return None
+
+        def chunks():
+            decompressor = zlib.decompressobj()
+            decoder = codecs.getincrementaldecoder('utf-8')()
+            for i in range(0, len(body), chunk_size):
+                data = decompressor.decompress(body[i:i + chunk_size])
+                yield decoder.decode(data)
+            yield decoder.decode(decompressor.flush(), final=True)
+        return chunks()
+
+    def set(self, link, text):
+        ''' Compress and store the body of link.'''
+        self.set_compressed(link, zlib.compress(text.encode('utf-8')))
+
+    def set_compressed(self, link, body):
+        ''' Store an already zlib compressed body of link.'''
+        now = time.time()
+        with self.lock:
+            self.db.execute('REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?)',
+                            (cache_key(link), urlparse(link).netloc, body,
+                             len(body), now, now))
+            self._evict()
+            self.db.commit()
+
+    def _evict(self):
+        ''' Delete least recently used entries until under max_size.'''
+        total = self.db.execute(
+            'SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+        if total <= self.max_size:
+            return
+        rows = self.db.execute(
+            'SELECT url, size FROM responses ORDER BY accessed')
+        stale = []
+        for url, size in rows.fetchall():
+            if total <= self.max_size:
+                break
+            stale.append((url,))
+            total -= size
+        self.db.executemany('DELETE FROM responses WHERE url = ?', stale)
+
+    def close(self):
+        ''' Close the cache file.'''
+        self.db.close()
+
+
+def configure_cache(cache_dir=DEFAULT_CACHE_DIR, offline=False, **kwargs):
+    ''' Enable the process wide response cache used by get_text.'''
+    global CACHE
+    CACHE = ResponseCache(cache_dir, offline=offline, **kwargs)
+    return CACHE
+
+
+def download_text(link):
+    ''' Download the url text from a given link.'''
+    req = get_client().get(link)
+    req.raise_for_status()
+    return req.text
+
+
+def get_text(link, download=download_text):
+    ''' Return the text of a link from the cache, downloading and
+        storing it if missing or expired.
+    '''
+    if CACHE is None:
+        return download(link)
+    text = CACHE.get(link)
+    metrics.observe_cache(link, text is not None)
+    if text is None:
+        if CACHE.offline:
+            raise custom_exceptions.OfflineCacheMiss(cache_key(link))
+        text = download(link)
+        CACHE.set(link, text)
+    return text
+
+
+class BodySpool(object):
+    ''' Download a response body at network speed in a background
+        thread into a temporary file, compressing it into the cache once
+        complete, whilst the text already downloaded is read back at the
+        reader's own pace. The connection is then only held for as long
+        as the download takes, however slowly the body is consumed.
+
+    Parameters:
+        link: url to download
+        chunk_size: bytes read from the network and the file at a time
+
+    Example:
+        for text in BodySpool(LISTING_URL).chunks():
+            parser.feed(text)
+    '''
+
+    def __init__(self, link, chunk_size=64 * 1024):
+        self.link = link
+        self.chunk_size = chunk_size
+        # utf-8 encoded body downloaded so far
+        self.file = tempfile.TemporaryFile()
+        self.size = 0
+        # set when the download ended, error if it raised
+        self.done = False
+        self.error = None
+        # set when the reader stopped, the download is then abandoned
+        self.closed = False
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target=self._download, daemon=True,
+                                       name='spool-{}'.format(link))
+        self.thread.start()
+
+    def _download(self):
+        compressor = zlib.compressobj()
+        body = []
+        try:
+            with get_client().get(self.link, stream=True) as req:
+                req.raise_for_status()
+                req.encoding = req.encoding or 'utf-8'
+                for chunk in req.iter_content(self.chunk_size,
+                                              decode_unicode=True):
+                    data = chunk.encode('utf-8')
+                    if CACHE is not None:
+                        body.append(compressor.compress(data))
+                    with self.condition:
+                        if self.closed:
+                            return
+                        self.file.seek(self.size)
+                        self.file.write(data)
+                        self.size += len(data)
+                        self.condition.notify_all()
+            if CACHE is not None:
+                body.append(compressor.flush())
+                CACHE.set_compressed(self.link, b''.join(body))
+        except BaseException as e:
+            self.error = e
+        finally:
+            with self.condition:
+                self.done = True
+                self.condition.notify_all()
+                if self.closed:
+                    self.file.close()
+
+    def chunks(self):
+        ''' Yield the text of the body as it is downloaded, raising any
+            error the download met once the text before it is read.
+        '''
+        decoder = codecs.getincrementaldecoder('utf-8')()
+        position = 0
+        try:
+            while True:
+                with self.condition:
+                    while position == self.size and not self.done:
+                        self.condition.wait()
+                    if position == self.size:
+                        break
+                    self.file.seek(position)
+                    data = self.file.read(self.chunk_size)
+                position += len(data)
+                yield decoder.decode(data)
+            if self.error is not None:
+                raise self.error
+            yield decoder.decode(b'', final=True)
+        finally:
+            with self.condition:
+                self.closed = True
+                if self.done:
+                    self.file.close()
+
+
+def stream_text(link, chunk_size=64 * 1024):
+    ''' Yield the text of a link in chunks without holding the whole
+        body in memory, from the cache if present, otherwise downloaded
+        by a BodySpool and compressed into the cache as it arrives.
+    '''
+    if CACHE is not None:
+        chunks = CACHE.get_chunks(link, chunk_size)
+        metrics.observe_cache(link, chunks is not None)
+        if chunks is not None:
+            yield from chunks
+            return
+        if CACHE.offline:
+            raise custom_exceptions.OfflineCacheMiss(cache_key(link))
+    yield from BodySpool(link, chunk_size).chunks()
@@ -0,0 +1,102 @@
+''' Process wide pooled HTTP client shared by all scrapers.'''
+from scrapers.retry_requests import retry_adapter
+import scrapers.rate_limiter as rate_limiter
+import threading
+import requests
+import metrics
+import time
+
+# keep-alive connections kept open to each host
+POOL_SIZES = {'www.beerhawk.co.uk': 10,
+              'api.brewerydb.com': 10,
+              'www.ratebeer.com': 2}
+DEFAULT_POOL_SIZE = 4
+# (connect, read) timeouts in seconds
+TIMEOUT = (5, 30)
+
+_CLIENT = None
+_LOCK = threading.Lock()
+
+
+class HTTPClient(object):
+    ''' A single requests Session with retries, timeouts and a pool of
+        keep-alive connections sized for each host.
+
+    Parameters:
+        pool_sizes: dict of host: connections, merged with POOL_SIZES
+        retries: total number of retry attempts
+        backoff_factor: amount of time between attempts
+        status_forcelist: retry if response is in list
+        timeout: (connect, read) timeout in seconds
+        throttle_retries: times a request is resent, once the host's
+                          rate limiter allows it, after a 429 or 503
+
+    Example:
+        client = get_client()
+        text = client.get('https://www.beerhawk.co.uk').text
+    '''
+
+    def __init__(self, pool_sizes=None, retries=3, backoff_factor=0.3,
+                 status_forcelist=(500, 502, 504), timeout=TIMEOUT,
+                 throttle_retries=3):
+        self.timeout = timeout
+        self.throttle_retries = throttle_retries
+        self.session = requests.Session()
+        # 429 and 503 responses are left to the rate limiter, which
+        # pauses every thread sending to the host, not just this one
+        default = retry_adapter(retries, backoff_factor, status_forcelist,
+                                DEFAULT_POOL_SIZE, respect_retry_after=False)
+        self.session.mount('http://', default)
+        self.session.mount('https://', default)
+        for host, size in {**POOL_SIZES, **(pool_sizes or {})}.items():
+            adapter = retry_adapter(retries, backoff_factor,
+                                    status_forcelist, size,
+                                    respect_retry_after=False)
+            self.session.mount('http://{}/'.format(host), adapter)
+            self.session.mount('https://{}/'.format(host), adapter)
+
+    def get(self, link, stream=False, keyed=False, **kwargs):
+        ''' Send a GET request, paced by the host's rate limiter and
+            streaming the body if stream is True.
+
+            If keyed is True the link holds an API key, so a 429 refers
+            to that key: it is returned at once, for the caller to move
+            to another key, without pausing the host.
+        '''
+        kwargs.setdefault('timeout', self.timeout)
+        for attempt in range(self.throttle_retries + 1):
+            with rate_limiter.LIMITER.request(link) as slot:
+                start = time.perf_counter()
+                req = self.session.get(link, stream=stream, **kwargs)
+                metrics.observe_http(link, req.status_code,
+                                     time.perf_counter() - start)
+                slot.record(req.status_code, req.headers, keyed)
+            if req.status_code not in rate_limiter.THROTTLE_STATUSES or \
+                    (keyed and req.status_code == 429):
+                break
+            # the limiter holds back the retry until Retry-After passes
+            req.close()
+        return req
+
+    def close(self):
+        ''' Close all pooled connections.'''
+        self.session.close()
+
+
+def get_client():
+    ''' Return the process wide HTTPClient, creating it on first use.'''
+    global _CLIENT
+    with _LOCK:
+        if _CLIENT is None:
+            _CLIENT = HTTPClient()
+        return _CLIENT
+
+
+def configure_client(**kwargs):
+    ''' Replace the process wide HTTPClient with one built from kwargs.'''
+    global _CLIENT
+    with _LOCK:
+        if _CLIENT is not None:
+            _CLIENT.close()
+        _CLIENT = HTTPClient(**kwargs)
+        return _CLIENT
@@ -0,0 +1,126 @@
+''' Quota aware scheduling of requests across a pool of API keys.'''
+from collections import deque
+from datetime import datetime, timedelta, timezone
+import threading
+import logging
+import time
+
+logger = logging.getLogger('beerscraper.http')
+
+
+def next_daily_reset():
+    ''' Return the epoch time of the next UTC midnight.'''
+    now = datetime.now(timezone.utc)
+    midnight = (now + timedelta(days=1)).replace(
+        hour=0, minute=0, second=0, microsecond=0)
+    return midnight.timestamp()
+
+
+class KeyQuota(object):
+    ''' Remaining daily and per second quota of a single API key.'''
+
+    def __init__(self, index, daily_limit, per_second):
+        self.index = index
+        self.daily_limit = daily_limit
+        self.remaining = daily_limit
+        self.per_second = per_second
+        # send times of requests within the last second
+        self.recent = deque()
+        self.blocked_until = 0
+        self.reset_at = next_daily_reset()
+
+    def wait_time(self, now, reserve):
+        ''' Seconds until this key can send a request.'''
+        if now >= self.reset_at:
+            self.remaining = self.daily_limit
+            self.reset_at = next_daily_reset()
+        while self.recent and now - self.recent[0] >= 1:
+            self.recent.popleft()
+        if self.blocked_until > now:
+            return self.blocked_until - now
+        if self.remaining is not None and self.remaining <= reserve:
+            return self.reset_at - now
+        if len(self.recent) >= self.per_second:
+            return 1 - (now - self.recent[0])
+        return 0
+
+
+class KeyPool(object):
+    ''' Hand out API keys so requests are spread across all keys
+        before any runs out, throttling to each key's per second
+        limit and parking callers when every key is used up.
+
+    Parameters:
+        num_keys: number of keys in the pool, referred to by index
+        daily_limit: requests per day allowed for each key
+        per_second: requests per second allowed for each key
+        reserve: requests left on a key when it is treated as used up
+        park_timeout: seconds a caller may wait for a key before
+                      acquire gives up and returns None
+        name: service name used in log messages
+
+    Example:
+        pool = KeyPool(len(KEYS), name='BreweryDB')
+        key_num = pool.acquire()
+        req = requests.get(url + '&key={}'.format(KEYS[key_num]))
+        pool.update(key_num, req.headers)
+    '''
+
+    def __init__(self, num_keys, daily_limit=400, per_second=10, reserve=0,
+                 park_timeout=300, name='API'):
+        self.name = name
+        self.keys = [KeyQuota(x, daily_limit, per_second)
+                     for x in range(num_keys)]
+        self.reserve = reserve
+        self.park_timeout = park_timeout
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        ''' Return the index of the key with the most quota left,
+            waiting while none can be used, or None after park_timeout.
+        '''
+        deadline = time.time() + self.park_timeout
+        while True:
+            with self.lock:
+                now = time.time()
+                waits = [(x.wait_time(now, self.reserve), x)
+                         for x in self.keys]
+                ready = [x for wait, x in waits if wait <= 0]
+                if ready:
+                    key = max(ready, key=lambda x: (x.remaining or 0,
+                                                    -len(x.recent)))
+                    key.recent.append(now)
+                    if key.remaining is not None:
+                        key.remaining -= 1
+                    return key.index
+                wait = min(x[0] for x in waits) if waits else None
+            if wait is None or now + wait > deadline:
+                logger.warning('%s keys exhausted, giving up', self.name)
+                return None
+            if wait > 1:
+                logger.warning('All %s keys used up, parking for %.0fs',
+                               self.name, wait)
+            time.sleep(min(wait, max(deadline - now, 0)))
+
+    def update(self, index, headers):
+        ''' Update a key's quota from X-Ratelimit response headers.'''
+        remaining = headers.get('X-Ratelimit-Remaining')
+        limit = headers.get('X-Ratelimit-Limit')
+        with self.lock:
+            key = self.keys[index]
+            if remaining is not None and remaining.isdigit():
+                key.remaining = int(remaining)
+            if limit is not None and limit.isdigit():
+                key.daily_limit = int(limit)
+
+    def block(self, index, seconds=None):
+        ''' Stop using a key for the given seconds, or until the daily
+            quota resets if the key was refused.
+        '''
+        with self.lock:
+            key = self.keys[index]
+            if seconds is None:
+                key.blocked_until = key.reset_at
+                key.remaining = 0
+            else:
+                key.blocked_until = time.time() + seconds
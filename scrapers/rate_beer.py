@@ -1,17 +1,59 @@
 ''' Functions to query ratebeer.com'''
-from fuzzywuzzy import fuzz
+from scrapers.fuzzy_matcher import FuzzyMatcher
+import scrapers.rate_limiter as rate_limiter
+import scrapers.http_cache as http_cache
 import custom_exceptions
+import requests
 import logging
 import ratebeer
-import time
+import bs4
 
+logger = logging.getLogger('beerscraper.ratebeer')
 RB = ratebeer.RateBeer()
+RATEBEER_HOST = 'www.ratebeer.com'
+# only fetch the search results whose names best match the query
+LAZY_FETCH = True
+# most search results fetched for a query when LAZY_FETCH is set
+MAX_FETCH = 3
+# runners up are fetched if within this many points of the best match
+SCORE_MARGIN = 5
+
+
+def download_page(link):
+    ''' Download a RateBeer page, raising PageNotFound, so nothing is
+        cached, if RateBeer answers with its missing page.
+    '''
+    try:
+        text = http_cache.download_text(link)
+    except requests.exceptions.HTTPError as e:
+        if e.response is not None and e.response.status_code == 404:
+            raise ratebeer.rb_exceptions.PageNotFound(link)
+        raise
+    if 'ratebeer robot oops' in text.lower():
+        raise ratebeer.rb_exceptions.PageNotFound(link)
+    return text
+
+
+def get_soup(url):
+    ''' Fetch a RateBeer page for the ratebeer library through the
+        shared response cache and rate limiter.
+    '''
+    if not url.startswith('http'):
+        url = ratebeer.soup._BASE_URL + url
+    text = http_cache.get_text(url, download=download_page)
+    return bs4.BeautifulSoup(text, 'lxml')
+
+
+# the library fetches beer and brewery pages with ratebeer.soup._get_soup,
+# its searches are POST requests which are paced but not cached
+ratebeer.soup._get_soup = get_soup
 
 
 def query_ratebeer(query):
     ''' Search ratebeer for a given query.'''
     try:
-        results = RB.search(query)
+        with rate_limiter.LIMITER.request(RATEBEER_HOST):
+            results = RB.search(query)
         return results
     except AttributeError as e:
         raise custom_exceptions.RateBeerModuleFailure(e)
@@ -22,15 +64,24 @@ def fuzzy_query_match(query, beers):
         search query and beer object and return
         the beer object.
     '''
-    pr = []
-    for beer in beers:
-        compare = fuzz.partial_ratio(query.lower(), beer.name.lower())
-        pr.append(compare)
-    index = pr.index(max(pr))
+    matcher = FuzzyMatcher([x.name for x in beers], scorer='partial')
+    index, score = matcher.best(query)
     best_match = beers[index]
     return best_match
 
 
+def shortlist(query, results, top_k=MAX_FETCH, margin=SCORE_MARGIN):
+    ''' Rank search results by how well their names match the query
+        and return the best, plus up to top_k - 1 runners up whose
+        score is within margin of it.
+    '''
+    # search results already hold names, so this fetches nothing
+    matcher = FuzzyMatcher([x.name for x in results], scorer='partial')
+    ranked = matcher.top(query, top_k)
+    best_score = ranked[0][1]
+    return [results[i] for i, score in ranked if best_score - score <= margin]
+
+
 def check_choice_error(choice):
     ''' Raise an error if choice is not beers or breweries.'''
     valid = ['beers', 'breweries']
@@ -38,23 +89,26 @@ def check_choice_error(choice):
         raise custom_exceptions.InvalidChoice(choice, valid)
 
 
-def fetch_data(data, key):
+def fetch_data(data, key, query=None):
     ''' Fetch the search results from ratebeer.
     Args:
         data: ratebeer search results
         key: 'beers' or 'breweries'
+        query: search query, if given with LAZY_FETCH only the
+               best matching results are fetched
     '''
-    # ensure at least 1 second between requests to ratebeer
-    time.sleep(1)
     check_choice_error(key)
     breweries = data.get(key)
     fetched_data = []
+    if breweries and query and LAZY_FETCH:
+        breweries = shortlist(query, breweries)
     if breweries:
         func = RB.get_beer if key == 'beers' else RB.get_brewery
         for x in breweries:
             try:
                 # fetch boolean required to ensure all
                 # beer metadata is obtained
+                # get_soup paces the page requests
                 brewery = func(x.url, fetch=True)
             except ratebeer.rb_exceptions.AliasedBeer as e:
                 continue
@@ -72,7 +126,7 @@ def get_info_dict(query, choice):
     try:
         check_choice_error(choice)
         search_results = query_ratebeer(query)
-        beers = fetch_data(search_results, choice)
+        beers = fetch_data(search_results, choice, query)
         if beers:
             if len(beers) > 1 or not all(x.name is None for x in beers):
                 beer_match = fuzzy_query_match(query, beers)
@@ -81,10 +135,9 @@ def get_info_dict(query, choice):
             beer = beer_match.__dict__
             return beer
         else:
-            logging.warning(
-                'No {} info for {} in RateBeer'.format(choice, query))
+            logger.warning('No %s info for %s in RateBeer', choice, query)
     except ratebeer.rb_exceptions.PageNotFound:
-        logging.warning('No {} info for {} in RateBeer'.format(choice, query))
+        logger.warning('No %s info for %s in RateBeer', choice, query)
 
 
 #
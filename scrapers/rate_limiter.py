@@ -0,0 +1,219 @@
+''' Adaptive per-host rate limiting shared by every scraper.'''
+from urllib.parse import urlparse
+import contextlib
+import threading
+import logging
+import asyncio
+import metrics
+import time
+
+logger = logging.getLogger('beerscraper.http')
+# token bucket and concurrency settings for each host:
+#   rate: starting requests per second, max_rate/min_rate bound it
+#   concurrency: starting requests in flight, max_concurrency bounds it
+#   target_latency: slower responses count as congestion
+HOST_CONFIGS = {
+    'www.beerhawk.co.uk': {'rate': 5, 'max_rate': 20, 'concurrency': 4,
+                           'max_concurrency': 10},
+    'api.brewerydb.com': {'rate': 5, 'max_rate': 10, 'concurrency': 4,
+                          'max_concurrency': 10},
+    'www.ratebeer.com': {'rate': 1, 'max_rate': 2, 'concurrency': 1,
+                         'max_concurrency': 2}}
+DEFAULT_CONFIG = {'rate': 2, 'max_rate': 10, 'min_rate': 0.1,
+                  'concurrency': 2, 'min_concurrency': 1,
+                  'max_concurrency': 4, 'target_latency': 5.0,
+                  'decrease': 0.5}
+# statuses telling us the host wants us to slow down
+THROTTLE_STATUSES = (429, 503)
+
+
+class HostLimiter(object):
+    ''' Token bucket with an AIMD (additive increase, multiplicative
+        decrease) adjusted rate and concurrency limit for one host.
+
+    Parameters:
+        host: host name, used in log messages
+        config: dict of settings, see HOST_CONFIGS and DEFAULT_CONFIG
+    '''
+
+    def __init__(self, host, config):
+        config = {**DEFAULT_CONFIG, **config}
+        self.host = host
+        self.rate = float(min(config['rate'], config['max_rate']))
+        self.min_rate = config['min_rate']
+        self.max_rate = config['max_rate']
+        self.concurrency = float(config['concurrency'])
+        self.min_concurrency = config['min_concurrency']
+        self.max_concurrency = config['max_concurrency']
+        self.target_latency = config['target_latency']
+        self.decrease = config['decrease']
+        self.tokens = 1.0
+        self.updated = time.monotonic()
+        self.in_flight = 0
+        self.paused_until = 0
+        self.lock = threading.Lock()
+
+    def try_acquire(self):
+        ''' Take a token and concurrency slot if available. Returns 0
+            on success, otherwise the seconds to wait before retrying.
+        '''
+        with self.lock:
+            now = time.monotonic()
+            if now < self.paused_until:
+                return self.paused_until - now
+            burst = max(1.0, self.rate)
+            self.tokens = min(burst, self.tokens +
+                              (now - self.updated) * self.rate)
+            self.updated = now
+            if self.in_flight >= int(self.concurrency):
+                return 0.05
+            if self.tokens < 1:
+                return (1 - self.tokens) / self.rate
+            self.tokens -= 1
+            self.in_flight += 1
+            return 0
+
+    def acquire(self):
+        ''' Block until a request may be sent.'''
+        wait = self.try_acquire()
+        while wait:
+            time.sleep(wait)
+            wait = self.try_acquire()
+
+    async def acquire_async(self):
+        ''' Wait, without blocking the event loop, until a request
+            may be sent.
+        '''
+        wait = self.try_acquire()
+        while wait:
+            await asyncio.sleep(wait)
+            wait = self.try_acquire()
+
+    def release(self, status=None, latency=0.0, retry_after=None,
+                error=False, adapt=True):
+        ''' Free the slot and, if adapt is True, adapt the limits to
+            the response.
+        '''
+        with self.lock:
+            self.in_flight -= 1
+            if not adapt:
+                return
+            throttled = status in THROTTLE_STATUSES
+            if throttled or error or (status or 0) >= 500 or \
+                    latency > self.target_latency:
+                self.rate = max(self.min_rate, self.rate * self.decrease)
+                self.concurrency = max(self.min_concurrency,
+                                       self.concurrency * self.decrease)
+                if throttled:
+                    pause = retry_after if retry_after is not None \
+                        else 1 / self.rate
+                    self.paused_until = time.monotonic() + pause
+                    logger.warning(
+                        'THROTTLED: %s returned %s, pausing %.1fs '
+                        '(rate %.2f/s, concurrency %d)', self.host, status,
+                        pause, self.rate, self.concurrency)
+            else:
+                # grows by about one request per second, and one
+                # concurrent request, per window of successful requests
+                self.rate = min(self.max_rate, self.rate + 1 / self.rate)
+                self.concurrency = min(self.max_concurrency,
+                                       self.concurrency +
+                                       1 / self.concurrency)
+
+
+def parse_retry_after(headers):
+    ''' Return the seconds of a Retry-After header, if any.'''
+    value = (headers or {}).get('Retry-After')
+    if value and value.strip().isdigit():
+        return float(value)
+
+
+class RateLimiter(object):
+    ''' Registry of a HostLimiter for every host.
+
+    Example:
+        with LIMITER.request('https://www.ratebeer.com/beer/1/') as slot:
+            req = requests.get(url)
+            slot.record(req.status_code, req.headers)
+    '''
+
+    def __init__(self, configs=None):
+        self.configs = {**HOST_CONFIGS, **(configs or {})}
+        self.hosts = {}
+        self.lock = threading.Lock()
+
+    def host(self, link):
+        ''' Return the HostLimiter of a url or host name.'''
+        host = urlparse(link).netloc or link
+        with self.lock:
+            if host not in self.hosts:
+                self.hosts[host] = HostLimiter(host,
+                                               self.configs.get(host, {}))
+            return self.hosts[host]
+
+    @contextlib.contextmanager
+    def request(self, link):
+        ''' Hold a request slot for link, adapting the host's limits to
+            what the caller records, or to any connection error raised.
+        '''
+        limiter = self.host(link)
+        limiter.acquire()
+        slot = Slot(limiter)
+        try:
+            yield slot
+        except OSError:
+            # requests' connection errors and timeouts are OSErrors
+            slot.error = True
+            raise
+        finally:
+            slot.release()
+
+
+class Slot(object):
+    ''' A request in flight, recording the outcome for its HostLimiter.'''
+
+    def __init__(self, limiter):
+        self.limiter = limiter
+        self.start = time.perf_counter()
+        self.status = None
+        self.retry_after = None
+        self.error = False
+        self.keyed = False
+
+    def record(self, status, headers=None, keyed=False):
+        ''' Record the response status and any Retry-After header. If
+            keyed is True the request held an API key, and a 429 only
+            limits that key, so it doesn't slow down the host.
+        '''
+        self.status = status
+        self.retry_after = parse_retry_after(headers)
+        self.keyed = keyed
+
+    def release(self):
+        adapt = not (self.keyed and self.status == 429)
+        self.limiter.release(self.status, time.perf_counter() - self.start,
+                             self.retry_after, self.error, adapt)
+        if self.status in THROTTLE_STATUSES:
+            metrics.HTTP_THROTTLED.inc(host=self.limiter.host)
+
+
+def parse_rate_limits(values):
+    ''' Parse HOST=MAX_RATE strings into {host: settings}.'''
+    configs = {}
+    for value in values or []:
+        host, _, rate = value.partition('=')
+        configs[host] = {**HOST_CONFIGS.get(host, {}),
+                         'max_rate': float(rate)}
+    return configs
+
+
+LIMITER = RateLimiter()
+
+
+def configure_limiter(configs):
+    ''' Replace the shared RateLimiter, merging configs of
+        {host: settings} with HOST_CONFIGS.
+    '''
+    global LIMITER
+    LIMITER = RateLimiter(configs)
+    return LIMITER
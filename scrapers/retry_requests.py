@@ -1,6 +1,44 @@
 import requests
 from requests.adapters import HTTPAdapter
 from requests.packages.urllib3.util.retry import Retry
+import metrics
+
+
+class CountingRetry(Retry):
+    ''' Retry policy which records every retry in the metrics.'''
+
+    def increment(self, method=None, url=None, *args, **kwargs):
+        pool = kwargs.get('_pool')
+        metrics.HTTP_RETRIES.inc(host=getattr(pool, 'host', ''))
+        return Retry.increment(self, method, url, *args, **kwargs)
+
+
+def retry_adapter(retries=3, backoff_factor=0.3,
+                  status_forcelist=(500, 502, 504), pool_maxsize=10,
+                  respect_retry_after=True, raise_on_status=False):
+    ''' Define an adapter with request retry attempts and a pool of
+        keep-alive connections.
+
+    Args:
+        retries: total number of retry attempts
+        backoff_factor: amount of time between attempts
+        status_forcelist: retry if response is in list
+        pool_maxsize: connections kept open to a host
+        respect_retry_after: retry 413, 429 and 503 responses after
+                             their Retry-After header
+        raise_on_status: raise a RetryError once status retries run
+                         out, rather than returning the last response
+                         so callers can use raise_for_status
+    '''
+    retry = CountingRetry(total=retries,
+                          read=retries,
+                          connect=retries,
+                          backoff_factor=backoff_factor,
+                          status_forcelist=status_forcelist,
+                          raise_on_status=raise_on_status,
+                          respect_retry_after_header=respect_retry_after)
+    return HTTPAdapter(max_retries=retry, pool_connections=1,
+                       pool_maxsize=pool_maxsize)
 
 
 def requests_retry_session(url, retries=3, backoff_factor=0.3,
@@ -23,12 +61,8 @@ def requests_retry_session(url, retries=3, backoff_factor=0.3,
         https://www.peterbe.com/plog/best-practice-with-retries-with-requests
     '''
     session = session or requests.Session()
-    retry = Retry(total=retries,
-                  read=retries,
-                  connect=retries,
-                  backoff_factor=backoff_factor,
-                  status_forcelist=status_forcelist)
-    adapter = HTTPAdapter(max_retries=retry)
+    adapter = retry_adapter(retries, backoff_factor, status_forcelist,
+                            raise_on_status=True)
     session.mount('http://', adapter)
     session.mount('https://', adapter)
     return session.get(url)
@@ -0,0 +1,72 @@
+''' Tests that FuzzyMatcher finds the same matches as scoring every
+    candidate with fuzzywuzzy.
+'''
+from scrapers.fuzzy_matcher import FuzzyMatcher
+from fuzzywuzzy import fuzz
+import random
+import pytest
+
+WORDS = ['punk', 'ipa', 'elvis', 'juice', 'dead', 'pony', 'club', 'hazy',
+         'jane', 'stout', 'double', 'brewdog', 'pale', 'ale', 'lager',
+         'Ünited', 'craft', '&', 'no.', '5']
+# scoring every candidate, as the matcher replaces
+SCORERS = {'token_sort': fuzz.token_sort_ratio,
+           'partial': lambda x, y: fuzz.partial_ratio(x.lower(), y.lower())}
+
+
+def random_names(rng, count):
+    return [' '.join(rng.choice(WORDS) for _ in range(rng.randint(1, 4)))
+            for _ in range(count)]
+
+
+def scan(names, query, scorer, k=1, min_match=0):
+    ''' Expected top k, highest score first and earliest first on ties.'''
+    scores = sorted(((i, SCORERS[scorer](query, x))
+                     for i, x in enumerate(names)),
+                    key=lambda x: (-x[1], x[0]))
+    return [x for x in scores[:k] if x[1] >= min_match]
+
+
+@pytest.mark.parametrize('scorer', sorted(SCORERS))
+def test_best_matches_full_scan(scorer):
+    rng = random.Random(6)
+    names = random_names(rng, 80)
+    matcher = FuzzyMatcher(names, scorer)
+    for query in random_names(rng, 60):
+        for min_match in (0, 75, 90):
+            expected = scan(names, query, scorer, 1, min_match)
+            assert matcher.best(query, min_match) == \
+                (expected[0] if expected else None)
+
+
+@pytest.mark.parametrize('scorer', sorted(SCORERS))
+def test_top_matches_full_scan(scorer):
+    rng = random.Random(7)
+    names = random_names(rng, 80)
+    matcher = FuzzyMatcher(names, scorer)
+    for query in random_names(rng, 30):
+        for k in (1, 3, 10):
+            assert matcher.top(query, k, 60) == \
+                scan(names, query, scorer, k, 60)
+
+
+def test_ties_pick_earliest_candidate():
+    matcher = FuzzyMatcher(['IPA Punk', 'Elvis Juice', 'punk ipa'])
+    assert matcher.best('Punk IPA') == (0, 100)
+    assert matcher.top('Punk IPA', 3)[:2] == [(0, 100), (2, 100)]
+
+
+def test_min_match_is_inclusive():
+    names = ['Punk IPA', 'Punk IPL']
+    score = fuzz.token_sort_ratio('punk ipa', 'Punk IPL')
+    matcher = FuzzyMatcher(names[1:])
+    assert matcher.best('punk ipa', score) == (0, score)
+    assert matcher.best('punk ipa', score + 1) is None
+
+
+def test_empty_names_and_queries():
+    matcher = FuzzyMatcher(['', None, 'Punk IPA'])
+    assert matcher.best('', 0) == scan(['', '', 'Punk IPA'], '',
+                                       'token_sort')[0]
+    assert matcher.best('Punk IPA') == (2, 100)
+    assert FuzzyMatcher([]).best('Punk IPA') is None
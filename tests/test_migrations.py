@@ -0,0 +1,84 @@
+''' Tests of the CRAFT_BEERS schema migrations on SQLite databases.'''
+from database.sqlite_API import SQLiteConnection, SQLITE
+from database.pymysql_API import SQLTable
+import database.database_creation as database_creation
+import collections
+import threading
+import pytest
+
+# the tracking columns added by migration 1
+TRACKING_COLUMNS = ['brewerydb_updated', 'brewerydb_hash', 'beerhawk_updated',
+                    'beerhawk_hash', 'updated_at']
+
+
+@pytest.fixture
+def db_path(tmp_path):
+    return str(tmp_path / 'beers.sqlite3')
+
+
+def create_legacy_table(db_path):
+    ''' Create CRAFT_BEERS as it was before any migration, with INT ABVs
+        and no tracking columns or indexes, holding one row.
+    '''
+    columns = collections.OrderedDict(
+        (k, 'INT' if k in ('abv', 'abvMin', 'abvMax') else i)
+        for k, i in database_creation.CRAFT_BEERS_COLUMNS.items()
+        if k not in TRACKING_COLUMNS)
+    db = SQLiteConnection(db_path)
+    with db.cursor() as cursor:
+        for cmd in SQLITE.create_table_cmds('CRAFT_BEERS', columns):
+            cursor.execute(cmd)
+        cursor.execute("INSERT INTO CRAFT_BEERS (full_beer_name, beer_name, "
+                       "brewery, abv) VALUES ('Brewdog Punk IPA', "
+                       "'Punk IPA', 'Brewdog', 5)")
+    db.commit()
+    return db
+
+
+def open_table(db_path):
+    return SQLTable(SQLiteConnection(db_path), 'CRAFT_BEERS')
+
+
+def test_new_database_is_at_latest_version(db_path):
+    table = database_creation.open_database_table(db_path, 'sqlite')
+    assert database_creation.schema_version(table.db) == \
+        database_creation.SCHEMA_VERSION
+    assert database_creation.migrate(table) == 0
+
+
+def test_legacy_table_is_migrated(db_path):
+    create_legacy_table(db_path).close()
+    table = open_table(db_path)
+    applied = database_creation.migrate(table)
+    assert applied == len(database_creation.MIGRATIONS)
+    types = dict(table.describe())
+    assert set(TRACKING_COLUMNS) <= set(types)
+    assert types['abv'].startswith('float')
+    # rows survive the table being rebuilt for the FLOAT columns
+    assert table.select(['full_beer_name', 'abv']) == \
+        [('Brewdog Punk IPA', 5.0)]
+    table.update_many([{'full_beer_name': 'Brewdog Punk IPA', 'abv': 5.4}],
+                      key='full_beer_name')
+    assert table.select(['abv'])[0][0] == pytest.approx(5.4)
+    with table.db.cursor() as cursor:
+        indexes = SQLITE.index_names(cursor, 'CRAFT_BEERS')
+    assert set(database_creation.CRAFT_BEERS_INDEXES) <= indexes
+    with table.db.cursor() as cursor:
+        cursor.execute('SELECT version FROM SCHEMA_VERSION ORDER BY version')
+        versions = [x[0] for x in cursor.fetchall()]
+    assert versions == [x[0] for x in database_creation.MIGRATIONS]
+
+
+def test_concurrent_migrations_apply_once(db_path):
+    create_legacy_table(db_path).close()
+    tables = [open_table(db_path) for _ in range(4)]
+    applied = []
+
+    def run(table):
+        applied.append(database_creation.migrate(table))
+    threads = [threading.Thread(target=run, args=(x,)) for x in tables]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert sorted(applied) == [0, 0, 0, len(database_creation.MIGRATIONS)]
@@ -0,0 +1,86 @@
+''' Tests of the WorkQueue leases on a SQLite database.'''
+from database.sqlite_API import SQLiteConnection
+from work_queue import WorkQueue
+import pytest
+
+
+@pytest.fixture
+def db_path(tmp_path):
+    return str(tmp_path / 'queue.sqlite3')
+
+
+def make_queue(db_path, worker_id, **kwargs):
+    queue = WorkQueue(SQLiteConnection(db_path), worker_id=worker_id,
+                      **kwargs)
+    queue.create()
+    return queue
+
+
+def expire_leases(queue):
+    ''' Move every lease into the past, as if its worker had died.'''
+    with queue.db.cursor() as cursor:
+        cursor.execute("UPDATE {} SET lease_until = '2000-01-01 00:00:00' "
+                       "WHERE status = 'claimed'".format(queue.table))
+    queue.db.commit()
+
+
+def test_claims_are_not_shared(db_path):
+    first = make_queue(db_path, 'first')
+    second = make_queue(db_path, 'second')
+    first.enqueue([('/beer-{}'.format(x), {'n': x}) for x in range(5)])
+    claimed = first.claim(3) + second.claim(3)
+    assert sorted(x[0] for x in claimed) == \
+        sorted('/beer-{}'.format(x) for x in range(5))
+    assert first.claim(3) == [] and second.claim(3) == []
+
+
+def test_expired_lease_is_reclaimed(db_path):
+    first = make_queue(db_path, 'first')
+    second = make_queue(db_path, 'second')
+    first.enqueue([('/punk-ipa', {'sku': '1'})])
+    assert first.claim() == [('/punk-ipa', {'sku': '1'})]
+    assert second.claim() == []
+    expire_leases(first)
+    assert second.claim() == [('/punk-ipa', {'sku': '1'})]
+    # the first worker no longer holds the item, so can't finish it
+    first.complete('/punk-ipa')
+    assert second.counts() == {'claimed': 1}
+    second.complete('/punk-ipa')
+    assert second.counts() == {'done': 1}
+
+
+def test_item_on_last_attempt_remains_until_failed(db_path):
+    first = make_queue(db_path, 'first', max_attempts=2)
+    second = make_queue(db_path, 'second', max_attempts=2)
+    first.enqueue([('/punk-ipa', {})])
+    first.claim()
+    expire_leases(first)
+    second.claim()
+    # claimed on its final attempt, it is still remaining so workers
+    # keep claiming until its lease runs out
+    assert second.remaining() == 1
+    expire_leases(second)
+    assert first.claim() == []
+    assert first.counts() == {'failed': 1}
+    assert first.remaining() == 0
+
+
+def test_fail_retries_until_max_attempts(db_path):
+    queue = make_queue(db_path, 'worker', max_attempts=2)
+    queue.enqueue([('/punk-ipa', {})])
+    queue.claim()
+    queue.fail('/punk-ipa', 'timed out')
+    assert queue.counts() == {'pending': 1}
+    queue.claim()
+    queue.fail('/punk-ipa', 'timed out')
+    assert queue.counts() == {'failed': 1}
+    assert queue.remaining() == 0
+
+
+def test_release_refunds_attempt(db_path):
+    queue = make_queue(db_path, 'worker', max_attempts=1)
+    queue.enqueue([('/punk-ipa', {})])
+    queue.claim()
+    queue.release()
+    assert queue.counts() == {'pending': 1}
+    assert queue.claim() == [('/punk-ipa', {})]
@@ -0,0 +1,271 @@
+''' Database-backed queue of products shared by scrape workers on any node.'''
+from database.pymysql_API import backend_of
+from datetime import datetime, timedelta
+import collections
+import contextlib
+import threading
+import logging
+import socket
+import json
+import os
+
+logger = logging.getLogger('beerscraper.queue')
+QUEUE_TABLE = 'SCRAPE_QUEUE'
+QUEUE_COLUMNS = collections.OrderedDict([
+    ('link', 'VARCHAR(200) NOT NULL PRIMARY KEY'),
+    ('product', 'TEXT'),
+    ('status', "VARCHAR(10) NOT NULL DEFAULT 'pending'"),
+    ('worker', 'VARCHAR(100)'),
+    ('lease_until', 'DATETIME'),
+    ('attempts', 'INT NOT NULL DEFAULT 0'),
+    ('error', 'VARCHAR(200)'),
+    ('updated', 'DATETIME')])
+# statuses a queued item can have, done, skipped and failed are final
+STATUSES = ('pending', 'claimed', 'done', 'skipped', 'failed')
+
+
+def default_worker_id():
+    ''' Identify this process as <hostname>:<pid>.'''
+    return '{}:{}'.format(socket.gethostname(), os.getpid())
+
+
+class WorkQueue(object):
+    ''' Queue of links, each with a JSON payload, in a database table.
+
+        Workers claim batches of pending items, holding a lease on them
+        which a heartbeat thread renews. Items whose lease runs out, as
+        when their worker crashes, can be claimed by any other worker.
+        Claims lock rows with SELECT ... FOR UPDATE SKIP LOCKED on mySQL
+        so concurrent workers never claim the same item.
+
+        Lease times come from each node's clock, so nodes should keep
+        their clocks in sync.
+
+    Parameters:
+        db: pymysql or SQLiteConnection connection used only by the queue
+        table: name of the queue table
+        lease_seconds: time a claimed item is held without a heartbeat
+        max_attempts: claims of an item before it is left as failed
+        worker_id: name recorded against claimed items
+
+    Example:
+        queue = WorkQueue(database_creation.connect())
+        queue.create()
+        queue.enqueue([('/punk-ipa', {'sku': '1'})])
+        with queue.heartbeat():
+            for link, payload in queue.claim(10):
+                ...
+                queue.complete(link)
+    '''
+
+    def __init__(self, db, table=QUEUE_TABLE, lease_seconds=300,
+                 max_attempts=3, worker_id=None):
+        self.db = db
+        self.backend = backend_of(db)
+        self.table = table
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.worker_id = worker_id or default_worker_id()
+        # links this worker has claimed and not yet finished
+        self.claimed = set()
+        # the connection is shared with the heartbeat thread
+        self.lock = threading.RLock()
+
+    def exists(self):
+        ''' Check whether the queue table exists.'''
+        with self.lock, self.db.cursor() as cursor:
+            try:
+                cursor.execute('SELECT 1 FROM {} LIMIT 0'.format(self.table))
+                return True
+            except self.backend.missing_table_error:
+                self.db.rollback()
+                return False
+
+    def create(self):
+        ''' Create the queue table if it doesn't exist.'''
+        if self.exists():
+            return
+        cmds = self.backend.create_table_cmds(self.table, QUEUE_COLUMNS)
+        cmds.append('CREATE INDEX {0}_status ON {0} (status, lease_until)'
+                    .format(self.table))
+        with self.lock, self.db.cursor() as cursor:
+            for cmd in cmds:
+                cursor.execute(cmd)
+            self.db.commit()
+
+    def enqueue(self, items, batch_size=500):
+        ''' Add (link, payload) items, ignoring links already queued.
+            Returns the number of items offered.
+        '''
+        command = '{} INTO {} (link, product, status, updated) VALUES ' \
+                  "(%s, %s, 'pending', %s)".format(self.backend.insert_ignore,
+                                                   self.table)
+        total = 0
+        batch = []
+        for link, payload in items:
+            batch.append((link, json.dumps(payload), datetime.now()))
+            if len(batch) >= batch_size:
+                total += self._insert(command, batch)
+                batch = []
+        if batch:
+            total += self._insert(command, batch)
+        return total
+
+    def _insert(self, command, rows):
+        with self.lock, self.db.cursor() as cursor:
+            cursor.executemany(command, rows)
+            self.db.commit()
+        return len(rows)
+
+    def claim(self, batch_size=10):
+        ''' Lease up to batch_size pending items, or items whose lease
+            ran out, to this worker. Returns a list of (link, payload).
+        '''
+        now = datetime.now()
+        lease_until = now + timedelta(seconds=self.lease_seconds)
+        select = ("SELECT link, product FROM {} WHERE (status = 'pending' "
+                  "OR (status = 'claimed' AND lease_until < %s)) "
+                  'AND attempts < %s ORDER BY updated LIMIT %s {}').format(
+                      self.table, self.backend.skip_locked)
+        with self.lock, self.db.cursor() as cursor:
+            try:
+                cursor.execute(self.backend.begin_write)
+                # items abandoned on their last attempt won't be retried
+                cursor.execute(
+                    "UPDATE {} SET status = 'failed', error = 'lease "
+                    "expired' WHERE status = 'claimed' AND lease_until < %s "
+                    'AND attempts >= %s'.format(self.table),
+                    (now, self.max_attempts))
+                cursor.execute(select, (now, self.max_attempts, batch_size))
+                rows = list(cursor.fetchall())
+                if rows:
+                    update = ("UPDATE {} SET status = 'claimed', worker = %s, "
+                              'lease_until = %s, attempts = attempts + 1, '
+                              'updated = %s WHERE link IN ({})').format(
+                                  self.table, ', '.join(['%s'] * len(rows)))
+                    cursor.execute(update, [self.worker_id, lease_until,
+                                            now] + [x[0] for x in rows])
+                self.db.commit()
+            except Exception:
+                self.db.rollback()
+                raise
+            self.claimed.update(x[0] for x in rows)
+        return [(link, json.loads(product)) for link, product in rows]
+
+    def renew(self):
+        ''' Extend the lease of every item this worker holds.'''
+        with self.lock:
+            links = list(self.claimed)
+            if not links:
+                return
+            lease_until = datetime.now() + timedelta(
+                seconds=self.lease_seconds)
+            command = ('UPDATE {} SET lease_until = %s WHERE worker = %s '
+                       "AND status = 'claimed' AND link IN ({})").format(
+                           self.table, ', '.join(['%s'] * len(links)))
+            with self.db.cursor() as cursor:
+                cursor.execute(command,
+                               [lease_until, self.worker_id] + links)
+            self.db.commit()
+
+    @contextlib.contextmanager
+    def heartbeat(self, interval=None):
+        ''' Renew this worker's leases from a background thread, every
+            third of the lease by default, and release them on exit.
+        '''
+        interval = interval or self.lease_seconds / 3
+        stopped = threading.Event()
+
+        def beat():
+            while not stopped.wait(interval):
+                try:
+                    self.renew()
+                except Exception:
+                    logger.exception('Failed to renew queue leases')
+        thread = threading.Thread(target=beat, daemon=True)
+        thread.start()
+        try:
+            yield self
+        finally:
+            stopped.set()
+            thread.join()
+            self.release()
+
+    def _finish(self, links, status, error=None, refund=False):
+        ''' Set the status of claimed links, giving back the attempt
+            used by the claim if refund is True.
+        '''
+        links = list(links)
+        if not links:
+            return
+        command = ('UPDATE {} SET status = %s, error = %s, lease_until = '
+                   'NULL, updated = %s{} WHERE worker = %s AND link IN ({})'
+                   ).format(self.table,
+                            ', attempts = attempts - 1' if refund else '',
+                            ', '.join(['%s'] * len(links)))
+        with self.lock:
+            with self.db.cursor() as cursor:
+                cursor.execute(command, [status, error, datetime.now(),
+                                         self.worker_id] + links)
+            self.db.commit()
+            self.claimed.difference_update(links)
+
+    def complete(self, link, status='done'):
+        ''' Mark a claimed item as finished, done or skipped.'''
+        self._finish([link], status)
+
+    def complete_rows(self, rows):
+        ''' Mark the items of rows committed to the beers table as done,
+            for use as an SQLTable write hook.
+        '''
+        self._finish([x['beer_link'] for x in rows
+                      if x.get('beer_link') in self.claimed], 'done')
+
+    def fail(self, link, error):
+        ''' Return a claimed item to the queue to be retried, or leave
+            it failed once it has had max_attempts.
+        '''
+        with self.lock, self.db.cursor() as cursor:
+            cursor.execute('SELECT attempts FROM {} WHERE link = %s'.format(
+                self.table), (link,))
+            row = cursor.fetchone()
+        attempts = row[0] if row else self.max_attempts
+        status = 'failed' if attempts >= self.max_attempts else 'pending'
+        self._finish([link], status, str(error)[:200])
+
+    def release(self):
+        ''' Return every item this worker still holds to the queue,
+            without counting the claim as an attempt.
+        '''
+        with self.lock:
+            links = list(self.claimed)
+        if links:
+            logger.info('Releasing %s claimed queue items', len(links))
+        self._finish(links, 'pending', refund=True)
+
+    def remaining(self):
+        ''' Number of items which are claimed, or pending with attempts
+            left. Claimed items count whatever their attempts, so that
+            workers keep claiming, and failing an item left on its last
+            attempt once its lease runs out.
+        '''
+        with self.lock, self.db.cursor() as cursor:
+            cursor.execute("SELECT COUNT(*) FROM {} WHERE status = 'claimed' "
+                           "OR (status = 'pending' AND attempts < %s)".format(
+                               self.table), (self.max_attempts,))
+            count = cursor.fetchone()[0]
+            # ends the read so the next one sees other workers' commits
+            self.db.commit()
+        return count
+
+    def counts(self):
+        ''' Return {status: number of items}.'''
+        with self.lock, self.db.cursor() as cursor:
+            cursor.execute('SELECT status, COUNT(*) FROM {} GROUP BY '
+                           'status'.format(self.table))
+            counts = dict(cursor.fetchall())
+            self.db.commit()
+        return counts
+
+    def close(self):
+        self.db.close()